@@ -21,12 +21,16 @@ class Runner:
     where single-qubit gate pulses play on adjacent qubits which is not currently constrained by the SMT solver.
     """
 
-    def __init__(self, name: str, dir: str, qc, num_qubits: int):
+    def __init__(
+        self, name: str, dir: str, qc, num_qubits: int, incremental: bool = False
+    ):
         self.dir = dir
         self.name = name
         self.with_steane = False
         self.qc = qc
         self.num_qubits = num_qubits
+        # reuse the previous SMT solution up to the first changed gate
+        self.incremental = incremental
 
     def decompose(self):
         DPQAtranspile(
@@ -102,7 +106,14 @@ class Runner:
         tmp.setArchitecture([16, 16, 16, 16])
         tmp.setProgram(twos_unindexed)
         tmp.hybrid_strategy()
-        tmp.solve(save_file=True)
+
+        # the smt_ file is rewritten by singles_reinsert, so keep a clean copy
+        cache_json = self.dir + "cache_smt_" + self.name
+        if self.incremental and os.path.exists(cache_json):
+            tmp.setIncremental(cache_json)
+        result = tmp.solve(save_file=True)
+        with open(cache_json, "w") as f:
+            json.dump(result, f)
 
     def singles_reinsert(self):
         """
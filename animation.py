@@ -1,39 +1,38 @@
 from matplotlib.animation import FFMpegWriter, FuncAnimation
-from typing import Sequence, Mapping, Any, Union
+from typing import Sequence, Mapping, Any, Union, Iterator, Tuple
 from raman import rx, ry, rz
+from hardware import AOD_SEP, SITE_WIDTH, X_SITE_SEP, Y_SITE_SEP
+from hardware import T_RYDBERG, T_ACTIVATE, move_duration
+from codeformat import readCode, encodeDelta, encodeDeltaStream, writeBinary
+from codeformat import KEYFRAME_INTERVAL, DELTA_FORMAT, TRAILER
 import matplotlib.pyplot as plt
+import numpy as np
 import matplotlib.patches as patches
 import json
 import matplotlib
 import networkx as nx
 import argparse
+import multiprocessing
+import re
 from abc import ABC, abstractmethod
 import copy
 
 
-# physics constants
-R_B = 6  # rydberg range
-AOD_SEP = 4  # min AOD separation
-RYD_SEP = 15  # sufficient distance to avoid Rydberg
-SITE_SLMS = 2  # number of SLMs in a site
-SLM_SEP = AOD_SEP  # separation of SLMs inside a site
-SITE_WIDTH = 4  # total width of SLMs in a site
-X_SITE_SEP = RYD_SEP + SITE_WIDTH  # separation of sites in X direction
-Y_SITE_SEP = RYD_SEP  # separation of sites in Y direction
-
 # padding of the figure
 X_LOW_PAD = 2 * AOD_SEP
 Y_LOW_PAD = 4 * AOD_SEP
 X_HIGH_PAD = 2 * AOD_SEP
 Y_HIGH_PAD = 4 * AOD_SEP
 
+# verification levels of CodeGen: none, every Inst as it is built, and also
+# a replay of the written code, see verifier.py
+VERIFY_LEVELS = ("off", "fast", "full")
+
 # constants for animation
 FPS = 24  # frames per second
 INIT_FRM = 24  # initial empty frames
 PT_MICRON = 8  # scaling factor: points per micron
 MUS_PER_FRM = 8  # microseconds per frame
-T_RYDBERG = 0.15  # microseconds for Rydberg
-T_ACTIVATE = 50  # microseconds for (de)activating AOD
 
 # constants for circuit animation
 RECTANGLE_TOP_0 = 33  # rectangle initial top padding
@@ -49,28 +48,260 @@ BARRIER_WIDTH = 28.5  # width of each barrier
 # class for physical entities: qubits and AOD rows/cols
 
 
+def integral(values: Any) -> np.ndarray:
+    """coordinates as an integer array. All the traps and AOD positions are
+    on an integer um grid, so a fractional coordinate is an error."""
+    array = np.asarray(values)
+    if array.dtype.kind == "f":
+        if not np.all(array == np.round(array)):
+            raise ValueError(f"coordinates {values} are not integers.")
+        array = array.astype(np.int64)
+    return array
+
+
+class EntityList(list):
+    """list of the Qubit, Row, or Col views of a MachineState."""
+
+    def __init__(self, views: Sequence[Any], state: "MachineState"):
+        super().__init__(views)
+        self.state = state
+
+
+class MachineState:
+    """state of DPQA as arrays: qubits, AOD cols, and AOD rows. Qubit, Row,
+    and Col are views of one entry, so the instructions can operate on
+    and verify all the entries at once with numpy."""
+
+    def __init__(self, n_q: int, n_c: int, n_r: int):
+        self.q_x = np.full(n_q, -X_LOW_PAD - 1, dtype=np.int64)  # um
+        self.q_y = np.full(n_q, -Y_LOW_PAD - 1, dtype=np.int64)  # um
+        self.q_c = np.full(n_q, -1, dtype=np.int64)  # AOD column index
+        self.q_r = np.full(n_q, -1, dtype=np.int64)  # AOD row index
+        self.q_aod = np.zeros(n_q, dtype=bool)  # in AOD, or in SLM
+        self.c_x = np.full(n_c, -X_LOW_PAD - 1, dtype=np.int64)
+        self.c_active = np.zeros(n_c, dtype=bool)
+        self.r_y = np.full(n_r, -Y_LOW_PAD - 1, dtype=np.int64)
+        self.r_active = np.zeros(n_r, dtype=bool)
+        self.cache = None  # arrays and entries of the last snapshot
+        self.verify_insts = True  # whether Insts verify, see CodeGen
+        self.make_views()
+
+    @classmethod
+    def from_snapshot(cls, snapshot: Mapping[str, Any]) -> "MachineState":
+        """the MachineState of a state in the code, see snapshot."""
+        qubits = snapshot["qubits"]
+        state = cls(len(qubits), len(snapshot["cols"]), len(snapshot["rows"]))
+        state.q_x[:] = [q["x"] for q in qubits]
+        state.q_y[:] = [q["y"] for q in qubits]
+        state.q_c[:] = [q["c"] for q in qubits]
+        state.q_r[:] = [q["r"] for q in qubits]
+        state.q_aod[:] = [q["array"] == "AOD" for q in qubits]
+        state.c_x[:] = [c["x"] for c in snapshot["cols"]]
+        state.c_active[:] = [c["active"] for c in snapshot["cols"]]
+        state.r_y[:] = [r["y"] for r in snapshot["rows"]]
+        state.r_active[:] = [r["active"] for r in snapshot["rows"]]
+        return state
+
+    def make_views(self):
+        self.qubits = EntityList([Qubit(i, self) for i in range(len(self.q_x))], self)
+        self.cols = EntityList([Col(i, self) for i in range(len(self.c_x))], self)
+        self.rows = EntityList([Row(i, self) for i in range(len(self.r_y))], self)
+
+    def copy(self) -> "MachineState":
+        state = copy.copy(self)
+        for k, v in vars(self).items():
+            if isinstance(v, np.ndarray):
+                setattr(state, k, v.copy())
+        state.cache = None
+        state.make_views()
+        return state
+
+    def snapshot(self) -> Mapping[str, Any]:
+        """the state in the code of every Inst, see Inst.write_code. Only the
+        entries changed since the last snapshot are new dicts, the others
+        are shared with it, so the snapshots must not be modified."""
+        arrays = (
+            (self.q_x, self.q_y, self.q_aod, self.q_c, self.q_r),
+            (self.c_active, self.c_x),
+            (self.r_active, self.r_y),
+        )
+        if self.cache is None:
+            lists = tuple([None] * len(group[0]) for group in arrays)
+            changed = [np.arange(len(group[0])) for group in arrays]
+        else:
+            last_arrays, last_lists = self.cache
+            lists = tuple(list(entries) for entries in last_lists)
+            changed = [
+                np.flatnonzero(
+                    np.logical_or.reduce([a != b for a, b in zip(group, last)])
+                )
+                for group, last in zip(arrays, last_arrays)
+            ]
+
+        qubits, cols, rows = lists
+        ids = changed[0]
+        for i, x, y, aod, c, r in zip(
+            ids.tolist(),
+            self.q_x[ids].tolist(),
+            self.q_y[ids].tolist(),
+            self.q_aod[ids].tolist(),
+            self.q_c[ids].tolist(),
+            self.q_r[ids].tolist(),
+        ):
+            qubits[i] = {
+                "id": i,
+                "x": x,
+                "y": y,
+                "array": "AOD" if aod else "SLM",
+                "c": c,
+                "r": r,
+            }
+        ids = changed[1]
+        for i, active, x in zip(
+            ids.tolist(), self.c_active[ids].tolist(), self.c_x[ids].tolist()
+        ):
+            cols[i] = {"id": i, "active": active, "x": x}
+        ids = changed[2]
+        for i, active, y in zip(
+            ids.tolist(), self.r_active[ids].tolist(), self.r_y[ids].tolist()
+        ):
+            rows[i] = {"id": i, "active": active, "y": y}
+
+        self.cache = (
+            tuple(tuple(a.copy() for a in group) for group in arrays),
+            lists,
+        )
+        return {"qubits": qubits, "cols": cols, "rows": rows}
+
+
+def machineState(objs: Sequence[Any]) -> MachineState:
+    # the MachineState behind a list of Qubit, Row, or Col views
+    if isinstance(objs, EntityList):
+        return objs.state
+    if objs:
+        return objs[0].state
+    raise ValueError("no MachineState for an empty list of objects.")
+
+
+def aodConflict(
+    pos: np.ndarray, active: np.ndarray, i: int, value: int
+) -> Union[Tuple[int, bool], None]:
+    """the first active AOD col (row) too close to col (row) i at value.
+
+    Returns:
+        Union[Tuple[int, bool], None]: id of the conflicting col (row) and
+            whether it is before i, or None if there is no conflict.
+    """
+    before = np.flatnonzero(active[:i] & (pos[:i] > value - AOD_SEP))
+    if len(before):
+        return before[0].item(), True
+    after = np.flatnonzero(active[i + 1 :] & (pos[i + 1 :] - AOD_SEP < value))
+    if len(after):
+        return after[0].item() + i + 1, False
+    return None
+
+
 class Qubit:
-    def __init__(self, id: int):
-        self.array = "SLM"
+    """view of a qubit in a MachineState. Without a state, the qubit has
+    its own."""
+
+    __slots__ = ("id", "state")
+
+    def __init__(self, id: int, state: Union[MachineState, None] = None):
         self.id = id
-        self.c = -1  # AOD coloumn index
-        self.r = -1  # AOD row index
-        self.x = -X_LOW_PAD - 1  # real X coordinates in um
-        self.y = -Y_LOW_PAD - 1  # real Y coordinates in um
+        self.state = state if state is not None else MachineState(id + 1, 0, 0)
+
+    @property
+    def array(self) -> str:
+        return "AOD" if self.state.q_aod[self.id] else "SLM"
+
+    @array.setter
+    def array(self, value: str):
+        self.state.q_aod[self.id] = value == "AOD"
+
+    @property
+    def c(self) -> int:  # AOD coloumn index
+        return self.state.q_c[self.id].item()
+
+    @c.setter
+    def c(self, value: int):
+        self.state.q_c[self.id] = value
+
+    @property
+    def r(self) -> int:  # AOD row index
+        return self.state.q_r[self.id].item()
+
+    @r.setter
+    def r(self, value: int):
+        self.state.q_r[self.id] = value
+
+    @property
+    def x(self) -> int:  # real X coordinates in um
+        return self.state.q_x[self.id].item()
+
+    @x.setter
+    def x(self, value: int):
+        self.state.q_x[self.id] = integral(value)
+
+    @property
+    def y(self) -> int:  # real Y coordinates in um
+        return self.state.q_y[self.id].item()
+
+    @y.setter
+    def y(self, value: int):
+        self.state.q_y[self.id] = integral(value)
 
 
 class Row:
-    def __init__(self, id: int):
+    """view of an AOD row in a MachineState."""
+
+    __slots__ = ("id", "state")
+
+    def __init__(self, id: int, state: Union[MachineState, None] = None):
         self.id = id
-        self.active = False
-        self.y = -Y_LOW_PAD - 1  # real Y coordinates in um
+        self.state = state if state is not None else MachineState(0, 0, id + 1)
+
+    @property
+    def active(self) -> bool:
+        return bool(self.state.r_active[self.id])
+
+    @active.setter
+    def active(self, value: bool):
+        self.state.r_active[self.id] = value
+
+    @property
+    def y(self) -> int:  # real Y coordinates in um
+        return self.state.r_y[self.id].item()
+
+    @y.setter
+    def y(self, value: int):
+        self.state.r_y[self.id] = integral(value)
 
 
 class Col:
-    def __init__(self, id: int):
+    """view of an AOD column in a MachineState."""
+
+    __slots__ = ("id", "state")
+
+    def __init__(self, id: int, state: Union[MachineState, None] = None):
         self.id = id
-        self.active = False
-        self.x = -X_LOW_PAD - 1  # real X coordinates in um
+        self.state = state if state is not None else MachineState(0, id + 1, 0)
+
+    @property
+    def active(self) -> bool:
+        return bool(self.state.c_active[self.id])
+
+    @active.setter
+    def active(self, value: bool):
+        self.state.c_active[self.id] = value
+
+    @property
+    def x(self) -> int:  # real X coordinates in um
+        return self.state.c_x[self.id].item()
+
+    @x.setter
+    def x(self, value: int):
+        self.state.c_x[self.id] = integral(value)
 
 
 class Inst(ABC):
@@ -79,7 +310,8 @@ class Inst(ABC):
     In general, the __init__ of specific instruction classes looks like
         def __init__(self, *):
             super().__init__(*)
-            self.verify(*)
+            if self.verifying(*):
+                self.verify(*)
             self.operate(*)
             super().write_code(*)
     """
@@ -130,14 +362,11 @@ class Inst(ABC):
             self.code[k] = v
 
         # get the current state of DPQA
-        curr = {}
-        curr["qubits"] = [
-            {"id": q.id, "x": q.x, "y": q.y, "array": q.array, "c": q.c, "r": q.r}
-            for q in qubit_objs
-        ]
-        curr["cols"] = [{"id": c.id, "active": c.active, "x": c.x} for c in col_objs]
-        curr["rows"] = [{"id": r.id, "active": r.active, "y": r.y} for r in row_objs]
-        self.code["state"] = curr
+        self.code["state"] = machineState(qubit_objs).snapshot()
+
+    def verifying(self, qubit_objs: Sequence[Qubit]) -> bool:
+        """whether to verify, i.e., the verification of CodeGen is not off."""
+        return machineState(qubit_objs).verify_insts
 
     @abstractmethod
     def verify(self):
@@ -215,16 +444,18 @@ class Init(Inst):
         for k, v in data.items():
             self.code[k] = v
         self.all_slms = []
-        self.verify(
-            slm_qubit_idx,
-            slm_qubit_xys,
-            aod_qubit_idx,
-            aod_qubit_crs,
-            aod_col_act_idx,
-            aod_col_xs,
-            aod_row_act_idx,
-            aod_row_ys,
-        )
+        self.slm_set = set()  # the SLMs in all_slms, for membership checks
+        if self.verifying(qubit_objs):
+            self.verify(
+                slm_qubit_idx,
+                slm_qubit_xys,
+                aod_qubit_idx,
+                aod_qubit_crs,
+                aod_col_act_idx,
+                aod_col_xs,
+                aod_row_act_idx,
+                aod_row_ys,
+            )
         self.operate(
             col_objs,
             row_objs,
@@ -257,7 +488,8 @@ class Init(Inst):
 
     def add_slms(self, slms: Sequence[Sequence[int]]):
         for slm in slms:
-            if slm not in self.all_slms:
+            if tuple(slm) not in self.slm_set:
+                self.slm_set.add(tuple(slm))
                 self.all_slms.append(slm)
 
     def verify(
@@ -280,13 +512,20 @@ class Init(Inst):
         for i in slm_qubit_xys:
             if len(i) != 2:
                 raise ValueError(f"{self.name}: SLM qubit xys {i} invalid.")
-        for i in range(len(slm_qubit_xys)):
-            for j in range(i + 1, len(slm_qubit_xys)):
-                if slm_qubit_xys[i] == slm_qubit_xys[j]:
-                    raise ValueError(
-                        f"{self.name}: SLM qubits {slm_qubit_idx[i]} "
-                        f"and {slm_qubit_idx[j]} xys are the same."
-                    )
+        # the first pair of qubits at the same xys: i is the smallest index
+        # of a qubit sharing its xys, and j the next qubit at that xys
+        seen = {}
+        pair = None
+        for j, xy in enumerate(slm_qubit_xys):
+            i = seen.setdefault(tuple(xy), j)
+            if i != j and (pair is None or i < pair[0]):
+                pair = (i, j)
+        if pair:
+            i, j = pair
+            raise ValueError(
+                f"{self.name}: SLM qubits {slm_qubit_idx[i]} "
+                f"and {slm_qubit_idx[j]} xys are the same."
+            )
         # todo: the case when not all atoms are in SLM
 
     def operate(
@@ -303,24 +542,30 @@ class Init(Inst):
         aod_row_act_idx: Sequence[int],
         aod_row_ys: Sequence[int],
     ):
-        for i, q_id in enumerate(slm_qubit_idx):
-            qubit_objs[q_id].array = "SLM"
-            (qubit_objs[q_id].x, qubit_objs[q_id].y) = slm_qubit_xys[i]
-            self.all_slms.append(slm_qubit_xys[i])
-
-        for i, col_id in enumerate(aod_col_act_idx):
-            col_objs[col_id].activate = True
-            col_objs[col_id].x = aod_col_xs[i]
-
-        for i, row_id in enumerate(aod_col_act_idx):
-            row_objs[row_id].activate = True
-            row_objs[row_id].y = aod_row_ys[i]
-
-        for i, q_id in enumerate(aod_qubit_idx):
-            qubit_objs[q_id].array = "AOD"
-            (qubit_objs[q_id].c, qubit_objs[q_id].r) = aod_qubit_crs[i]
-            qubit_objs[q_id].x = col_objs[qubit_objs[q_id].c].x
-            qubit_objs[q_id].y = row_objs[qubit_objs[q_id].r].y
+        state = machineState(qubit_objs)
+        if len(slm_qubit_idx):
+            xys = integral(slm_qubit_xys).reshape(-1, 2)
+            state.q_aod[slm_qubit_idx] = False
+            state.q_x[slm_qubit_idx] = xys[:, 0]
+            state.q_y[slm_qubit_idx] = xys[:, 1]
+            self.all_slms.extend(slm_qubit_xys)
+            self.slm_set.update(tuple(xy) for xy in slm_qubit_xys)
+
+        if len(aod_col_act_idx):
+            state.c_active[aod_col_act_idx] = True
+            state.c_x[aod_col_act_idx] = integral(aod_col_xs)
+
+        if len(aod_row_act_idx):
+            state.r_active[aod_row_act_idx] = True
+            state.r_y[aod_row_act_idx] = integral(aod_row_ys)
+
+        if len(aod_qubit_idx):
+            crs = np.asarray(aod_qubit_crs, dtype=np.int64).reshape(-1, 2)
+            state.q_aod[aod_qubit_idx] = True
+            state.q_c[aod_qubit_idx] = crs[:, 0]
+            state.q_r[aod_qubit_idx] = crs[:, 1]
+            state.q_x[aod_qubit_idx] = state.c_x[crs[:, 0]]
+            state.q_y[aod_qubit_idx] = state.r_y[crs[:, 1]]
 
     def emit_full(self):
         # all the used SLMs are counted during the whole codegen process,
@@ -345,16 +590,17 @@ class Move(Inst):
         prefix: str = "",
     ):
         super().__init__("Move", prefix=prefix, stage=s)
-        self.verify(
-            col_objs,
-            row_objs,
-            col_idx,
-            col_begin,
-            col_end,
-            row_idx,
-            row_begin,
-            row_end,
-        )
+        if self.verifying(qubit_objs):
+            self.verify(
+                col_objs,
+                row_objs,
+                col_idx,
+                col_begin,
+                col_end,
+                row_idx,
+                row_begin,
+                row_end,
+            )
         data = self.operate(
             col_objs,
             row_objs,
@@ -380,51 +626,46 @@ class Move(Inst):
         row_begin: Sequence[int],
         row_end: Sequence[int],
     ) -> Mapping[str, Any]:
+        state = machineState(qubit_objs)
         data = {}
-        # calculate the max  move distance of columns
-        data["cols"] = []
-        max_distance = 0
-        for i in range(len(col_idx)):
-            distance = abs(col_end[i] - col_begin[i])
-            if distance > 0:
-                data["cols"].append(
-                    {
-                        "id": col_idx[i],
-                        "shift": col_end[i] - col_begin[i],
-                        "begin": col_begin[i],
-                        "end": col_end[i],
-                    }
-                )
-                col_objs[col_idx[i]].x = col_end[i]
-                max_distance = max(max_distance, distance)
-
-        # calculate the max  move distance of rows
-        data["rows"] = []
-        for i in range(len(row_idx)):
-            distance = abs(row_end[i] - row_begin[i])
-            if distance > 0:
-                data["rows"].append(
-                    {
-                        "id": row_idx[i],
-                        "shift": row_end[i] - row_begin[i],
-                        "begin": row_begin[i],
-                        "end": row_end[i],
-                    }
-                )
-                row_objs[row_idx[i]].y = row_end[i]
-                max_distance = max(max_distance, distance)
+        # move the columns and the rows, and find the max move distance
+        data["cols"], col_distance = self.shift(state.c_x, col_idx, col_begin, col_end)
+        data["rows"], row_distance = self.shift(state.r_y, row_idx, row_begin, row_end)
 
-        # movement time per Bluvstein et al. units are us and um.
-        self.duration = 200 * ((max_distance / 110) ** (1 / 2))
+        self.duration = move_duration(max(col_distance, row_distance))
         data["duration"] = self.duration
 
-        for qubit_obj in qubit_objs:
-            if qubit_obj.array == "AOD":
-                qubit_obj.x = col_objs[qubit_obj.c].x
-                qubit_obj.y = row_objs[qubit_obj.r].y
+        # the qubits in AOD move with their columns and rows
+        aod = state.q_aod
+        state.q_x[aod] = state.c_x[state.q_c[aod]]
+        state.q_y[aod] = state.r_y[state.q_r[aod]]
 
         return data
 
+    def shift(
+        self,
+        pos: np.ndarray,
+        idx: Sequence[int],
+        begin: Sequence[int],
+        end: Sequence[int],
+    ) -> Tuple[Sequence[Mapping[str, int]], int]:
+        # move the cols (rows) in pos, return the shifts and the max distance
+        if not len(idx):
+            return [], 0
+        idx = np.asarray(idx, dtype=np.int64)
+        begin = integral(begin)
+        end = integral(end)
+        moving = end != begin
+        pos[idx[moving]] = end[moving]
+        shifts = [
+            {"id": i, "shift": e - b, "begin": b, "end": e}
+            for i, b, e in zip(
+                idx[moving].tolist(), begin[moving].tolist(), end[moving].tolist()
+            )
+        ]
+        distance = np.abs(end - begin).max().item()
+        return shifts, distance
+
     def verify(
         self,
         col_objs: Sequence[Col],
@@ -451,71 +692,63 @@ class Move(Inst):
                 f"{self.name}: row arguments invalid" f" {a} idx, {b} begin, {c} end."
             )
 
-        activated_col_idx = []
-        activated_col_xs = []
-        for col_obj in col_objs:
-            if col_obj.active:
-                if activated_col_idx and col_obj.x < activated_col_xs[-1] + AOD_SEP:
-                    raise ValueError(
-                        f"{self.name}: col beginning position invalid"
-                        f" col {col_obj.id} at x={col_obj.x} while "
-                        f"col {activated_col_idx[-1]} at"
-                        f" x={activated_col_xs[-1]}."
-                    )
-                activated_col_idx.append(col_obj.id)
-                activated_col_xs.append(col_obj.x)
-        for i, moving_col_id in enumerate(col_idx):
-            if moving_col_id not in activated_col_idx:
-                raise ValueError(
-                    f"{self.name}: col {moving_col_id} to move" f" is not activated."
-                )
-            j = activated_col_idx.index(moving_col_id)
-            if col_begin[i] != activated_col_xs[j]:
-                raise ValueError(
-                    f"{self.name}: col {moving_col_id} beginning x not agree."
-                )
-            activated_col_xs[j] = col_end[i]
-        for i in range(1, len(activated_col_xs)):
-            if activated_col_xs[i - 1] + AOD_SEP > activated_col_xs[i]:
+        state = machineState(col_objs)
+        self.verify_aod(
+            "col", "x", state.c_x, state.c_active, col_idx, col_begin, col_end
+        )
+        state = machineState(row_objs)
+        self.verify_aod(
+            "row", "y", state.r_y, state.r_active, row_idx, row_begin, row_end
+        )
+
+    def verify_aod(
+        self,
+        kind: str,
+        axis: str,
+        pos: np.ndarray,
+        active: np.ndarray,
+        idx: Sequence[int],
+        begin: Sequence[int],
+        end: Sequence[int],
+    ):
+        # the active cols (rows) are in order before and after the move
+        activated_idx = np.flatnonzero(active)
+        activated_pos = pos[activated_idx]
+        bad = np.flatnonzero(np.diff(activated_pos) < AOD_SEP)
+        if len(bad):
+            i = bad[0]
+            raise ValueError(
+                f"{self.name}: {kind} beginning position invalid "
+                f"{kind} {activated_idx[i + 1]} at {axis}={activated_pos[i + 1]} "
+                f"while {kind} {activated_idx[i]} at {axis}={activated_pos[i]}."
+            )
+        if len(idx):
+            idx = np.asarray(idx, dtype=np.int64)
+            if not len(activated_idx):
                 raise ValueError(
-                    f"{self.name}: col ending position invalid"
-                    f" col {activated_col_idx[i-1]} at "
-                    f"x={activated_col_xs[i-1]} while "
-                    f"col {activated_col_idx[i]} at x={activated_col_xs[i]}."
+                    f"{self.name}: {kind} {idx[0]} to move is not activated."
                 )
-
-        activated_row_idx = []
-        activated_row_ys = []
-        for row_obj in row_objs:
-            if row_obj.active:
-                if activated_row_idx and row_obj.y < activated_row_ys[-1] + AOD_SEP:
+            j = np.searchsorted(activated_idx, idx).clip(max=len(activated_idx) - 1)
+            found = activated_idx[j] == idx
+            bad = np.flatnonzero(~found | (activated_pos[j] != integral(begin)))
+            if len(bad):
+                i = bad[0]
+                if not found[i]:
                     raise ValueError(
-                        f"{self.name}: row beginning position invalid "
-                        f"row {row_obj.id} at y={row_obj.y} while "
-                        f"row {activated_row_idx[-1]} at "
-                        f"y={activated_row_ys[-1]}."
+                        f"{self.name}: {kind} {idx[i]} to move is not activated."
                     )
-                activated_row_idx.append(row_obj.id)
-                activated_row_ys.append(row_obj.y)
-        for i, moving_row_id in enumerate(row_idx):
-            if moving_row_id not in activated_row_idx:
-                raise ValueError(
-                    f"{self.name}: row {moving_row_id} to move " f"is not activated."
-                )
-            j = activated_row_idx.index(moving_row_id)
-            if row_begin[i] != activated_row_ys[j]:
                 raise ValueError(
-                    f"{self.name}: row {moving_row_id} beginning y not agree."
-                )
-            activated_row_ys[j] = row_end[i]
-        for i in range(1, len(activated_row_ys)):
-            if activated_row_ys[i - 1] + AOD_SEP > activated_row_ys[i]:
-                raise ValueError(
-                    f"{self.name}: row ending position invalid "
-                    f"row {activated_row_idx[i-1]} at "
-                    f"y={activated_row_ys[i-1]} while "
-                    f"row {activated_row_idx[i]} at y={activated_row_ys[i]}."
+                    f"{self.name}: {kind} {idx[i]} beginning {axis} not agree."
                 )
+            activated_pos[j] = integral(end)
+        bad = np.flatnonzero(np.diff(activated_pos) < AOD_SEP)
+        if len(bad):
+            i = bad[0]
+            raise ValueError(
+                f"{self.name}: {kind} ending position invalid "
+                f"{kind} {activated_idx[i]} at {axis}={activated_pos[i]} while "
+                f"{kind} {activated_idx[i + 1]} at {axis}={activated_pos[i + 1]}."
+            )
 
     def emit(self):
         code = {"type": self.type}
@@ -550,16 +783,17 @@ class Activate(Inst):
             stage=s,
             reduced_keys=["col_idx", "col_xs", "row_idx", "row_ys"],
         )
-        self.verify(
-            col_objs,
-            row_objs,
-            qubit_objs,
-            col_idx,
-            col_xs,
-            row_idx,
-            row_ys,
-            pickup_qs,
-        )
+        if self.verifying(qubit_objs):
+            self.verify(
+                col_objs,
+                row_objs,
+                qubit_objs,
+                col_idx,
+                col_xs,
+                row_idx,
+                row_ys,
+                pickup_qs,
+            )
         self.operate(
             col_objs,
             row_objs,
@@ -595,14 +829,15 @@ class Activate(Inst):
         row_ys: Sequence[int],
         pickup_qs: Sequence[int],
     ):
-        for i in range(len(col_idx)):
-            col_objs[col_idx[i]].active = True
-            col_objs[col_idx[i]].x = col_xs[i]
-        for i in range(len(row_idx)):
-            row_objs[row_idx[i]].active = True
-            row_objs[row_idx[i]].y = row_ys[i]
-        for q_id in pickup_qs:
-            qubit_objs[q_id].array = "AOD"
+        state = machineState(qubit_objs)
+        if len(col_idx):
+            state.c_active[col_idx] = True
+            state.c_x[col_idx] = integral(col_xs)
+        if len(row_idx):
+            state.r_active[row_idx] = True
+            state.r_y[row_idx] = integral(row_ys)
+        if len(pickup_qs):
+            state.q_aod[pickup_qs] = True
 
     def verify(
         self,
@@ -624,70 +859,56 @@ class Activate(Inst):
         if a != b:
             raise ValueError(f"f{self.name}: row arguments invalid {a} idx, {b} ys.")
 
+        state = machineState(col_objs)
         for i in range(len(col_idx)):
-            if col_objs[col_idx[i]].active:
+            if state.c_active[col_idx[i]]:
                 raise ValueError(f"{self.name}: col {col_idx[i]} already activated.")
-            for j in range(col_idx[i]):
-                if col_objs[j].active and col_objs[j].x > col_xs[i] - AOD_SEP:
-                    raise ValueError(
-                        f"{self.name}: col {j} at x={col_objs[j].x} is "
-                        f"too left for col {col_idx[i]}"
-                        f" to activate at x={col_xs[i]}."
-                    )
-            for j in range(col_idx[i] + 1, len(col_objs)):
-                if col_objs[j].active and col_objs[j].x - AOD_SEP < col_xs[i]:
-                    raise ValueError(
-                        f"{self.name}: col {j} at x={col_objs[j].x} is "
-                        f"too right for col {col_idx[i]} "
-                        f"to activate at x={col_xs[i]}."
-                    )
+            conflict = aodConflict(state.c_x, state.c_active, col_idx[i], col_xs[i])
+            if conflict:
+                j, before = conflict
+                raise ValueError(
+                    f"{self.name}: col {j} at x={state.c_x[j]} is "
+                    f"too {'left' if before else 'right'} for col {col_idx[i]} "
+                    f"to activate at x={col_xs[i]}."
+                )
+        state = machineState(row_objs)
         for i in range(len(row_idx)):
-            if row_objs[row_idx[i]].active:
+            if state.r_active[row_idx[i]]:
                 raise ValueError(f"{self.name}: row {row_idx[i]} already activated.")
-            for j in range(row_idx[i]):
-                if row_objs[j].active and row_objs[j].y > row_ys[i] - AOD_SEP:
-                    raise ValueError(
-                        f"{self.name}: row {j} at y={row_objs[j].y} is "
-                        f"too high for row {row_idx[i]} "
-                        f"to activate at y={row_ys[i]}."
-                    )
-            for j in range(row_idx[i] + 1, len(row_objs)):
-                if row_objs[j].active and row_objs[j].y - AOD_SEP < row_ys[i]:
-                    raise ValueError(
-                        f"{self.name}: row {j} at y={col_objs[j].y} is "
-                        f"too low for row {row_idx[i]} "
-                        f"to activate at y={row_ys[i]}."
-                    )
+            conflict = aodConflict(state.r_y, state.r_active, row_idx[i], row_ys[i])
+            if conflict:
+                j, before = conflict
+                raise ValueError(
+                    f"{self.name}: row {j} at y={state.r_y[j]} is "
+                    f"too {'high' if before else 'low'} for row {row_idx[i]} "
+                    f"to activate at y={row_ys[i]}."
+                )
 
-        active_xys = []  # the traps that are newly activted by this Activate
-        active_xs = [col.x for col in col_objs if col.active]
-        active_ys = [row.y for row in row_objs if row.active]
-        for x in active_xs:
-            for y in row_ys:
-                active_xys.append((x, y))
-        for y in active_ys:
-            for x in col_xs:
-                active_xys.append((x, y))
-        for x in col_xs:
-            for y in row_ys:
-                active_xys.append((x, y))
-
-        for q_id in range(len(qubit_objs)):
-            if q_id in pickup_qs:
-                if (qubit_objs[q_id].x, qubit_objs[q_id].y) not in active_xys:
-                    raise ValueError(
-                        f"{self.name}: q {q_id} not picked up "
-                        f"by col {qubit_objs[q_id].c} "
-                        f"row {qubit_objs[q_id].r} at "
-                        f"x={qubit_objs[q_id].x} y={qubit_objs[q_id].y}."
-                    )
-            else:
-                if (qubit_objs[q_id].x, qubit_objs[q_id].y) in active_xys:
-                    raise ValueError(
-                        f"{self.name}: q {q_id} wrongfully picked up by "
-                        f"col {qubit_objs[q_id].c} row {qubit_objs[q_id].r}"
-                        f" at x={qubit_objs[q_id].x} y={qubit_objs[q_id].y}."
-                    )
+        # the traps newly activated by this Activate are the crossings of a
+        # new col with any active row, or of an active col with a new row
+        state = machineState(qubit_objs)
+        active_xs = state.c_x[state.c_active]
+        active_ys = state.r_y[state.r_active]
+        on_new_x = np.isin(state.q_x, col_xs)
+        on_new_y = np.isin(state.q_y, row_ys)
+        active = (on_new_x & (on_new_y | np.isin(state.q_y, active_ys))) | (
+            on_new_y & np.isin(state.q_x, active_xs)
+        )
+        pickup = np.zeros(len(qubit_objs), dtype=bool)
+        pickup[pickup_qs] = True
+
+        bad = np.flatnonzero(pickup != active)
+        if len(bad):
+            q = qubit_objs[bad[0]]
+            if pickup[q.id]:
+                raise ValueError(
+                    f"{self.name}: q {q.id} not picked up "
+                    f"by col {q.c} row {q.r} at x={q.x} y={q.y}."
+                )
+            raise ValueError(
+                f"{self.name}: q {q.id} wrongfully picked up by "
+                f"col {q.c} row {q.r} at x={q.x} y={q.y}."
+            )
 
 
 class Deactivate(Inst):
@@ -707,9 +928,17 @@ class Deactivate(Inst):
         super().__init__(
             "Deactivate", prefix=prefix, stage=s, reduced_keys=["col_idx", "row_idx"]
         )
-        self.verify(
-            col_objs, row_objs, qubit_objs, col_idx, col_xs, row_idx, row_ys, dropoff_qs
-        )
+        if self.verifying(qubit_objs):
+            self.verify(
+                col_objs,
+                row_objs,
+                qubit_objs,
+                col_idx,
+                col_xs,
+                row_idx,
+                row_ys,
+                dropoff_qs,
+            )
         self.operate(col_objs, row_objs, qubit_objs, col_idx, row_idx, dropoff_qs)
         super().write_code(
             col_objs,
@@ -734,12 +963,13 @@ class Deactivate(Inst):
         row_idx: Sequence[int],
         dropoff_qs: Sequence[int],
     ):
-        for i in range(len(col_idx)):
-            col_objs[col_idx[i]].active = False
-        for i in range(len(row_idx)):
-            row_objs[row_idx[i]].active = False
-        for q_id in dropoff_qs:
-            qubit_objs[q_id].array = "SLM"
+        state = machineState(qubit_objs)
+        if len(col_idx):
+            state.c_active[col_idx] = False
+        if len(row_idx):
+            state.r_active[row_idx] = False
+        if len(dropoff_qs):
+            state.q_aod[dropoff_qs] = False
 
     def verify(
         self,
@@ -761,62 +991,54 @@ class Deactivate(Inst):
         if a != b:
             raise ValueError(f"{self.name}: row arguments invalid {a} idx, {b} ys.")
 
+        state = machineState(col_objs)
         for i in range(len(col_idx)):
-            if not col_objs[col_idx[i]].active:
+            if not state.c_active[col_idx[i]]:
                 raise ValueError(f"{self.name}: col {col_idx[i]} already dectivated.")
-            for j in range(col_idx[i]):
-                if col_objs[j].active and col_objs[j].x > col_xs[i] - AOD_SEP:
-                    raise ValueError(
-                        f"{self.name}: col {j} at x={col_objs[j].x} is "
-                        f"too left for col {col_idx[i]} "
-                        f"to deactivate at x={col_xs[i]}."
-                    )
-            for j in range(col_idx[i] + 1, len(col_objs)):
-                if col_objs[j].active and col_objs[j].x - AOD_SEP < col_xs[i]:
-                    raise ValueError(
-                        f"{self.name}: col {j} at x={col_objs[j].x} is "
-                        f"too right for col {col_idx[i]} "
-                        f"to deactivate at x={col_xs[i]}."
-                    )
+            conflict = aodConflict(state.c_x, state.c_active, col_idx[i], col_xs[i])
+            if conflict:
+                j, before = conflict
+                raise ValueError(
+                    f"{self.name}: col {j} at x={state.c_x[j]} is "
+                    f"too {'left' if before else 'right'} for col {col_idx[i]} "
+                    f"to deactivate at x={col_xs[i]}."
+                )
+        state = machineState(row_objs)
         for i in range(len(row_idx)):
-            if not row_objs[row_idx[i]].active:
+            if not state.r_active[row_idx[i]]:
                 raise ValueError(f"{self.name}: row {row_idx[i]} already deactivated.")
-            for j in range(row_idx[i]):
-                if row_objs[j].active and row_objs[j].y > row_ys[i] - AOD_SEP:
-                    raise ValueError(
-                        f"{self.name}: row {j} at y={row_objs[j].y} is "
-                        f"too high for row {row_idx[i]} "
-                        f"to deactivate at y={row_ys[i]}."
-                    )
-            for j in range(row_idx[i] + 1, len(row_objs)):
-                if row_objs[j].active and row_objs[j].y - AOD_SEP < row_ys[i]:
-                    raise ValueError(
-                        f"{self.name}: row {j} at y={col_objs[j].y} is "
-                        f"too low for row {row_idx[i]} "
-                        f"to deactivate at y={row_ys[i]}."
-                    )
+            conflict = aodConflict(state.r_y, state.r_active, row_idx[i], row_ys[i])
+            if conflict:
+                j, before = conflict
+                raise ValueError(
+                    f"{self.name}: row {j} at y={state.r_y[j]} is "
+                    f"too {'high' if before else 'low'} for row {row_idx[i]} "
+                    f"to deactivate at y={row_ys[i]}."
+                )
 
-        deactive_xys = []
-        active_xs = [col.x for col in col_objs if col.active]
-        for x in active_xs:
-            for y in row_ys:
-                deactive_xys.append((x, y))
+        # the traps deactivated are the crossings of an active col with a
+        # row to deactivate, only the qubits in AOD can be dropped off there
+        state = machineState(qubit_objs)
+        deactive = np.isin(state.q_x, state.c_x[state.c_active]) & np.isin(
+            state.q_y, row_ys
+        )
+        dropoff = np.zeros(len(qubit_objs), dtype=bool)
+        dropoff[dropoff_qs] = True
 
-        for q_id in range(len(qubit_objs)):
-            if q_id in dropoff_qs:
-                if (qubit_objs[q_id].x, qubit_objs[q_id].y) not in deactive_xys:
-                    raise ValueError(
-                        f"{self.name}: q {q_id} not dropped off from "
-                        f"col {qubit_objs[q_id].c} row {qubit_objs[q_id].r} "
-                        f"at x={qubit_objs[q_id].x} y={qubit_objs[q_id].y}."
-                    )
-            elif qubit_objs[q_id].array == "AOD":
-                if (qubit_objs[q_id].x, qubit_objs[q_id].y) in deactive_xys:
-                    raise ValueError(
-                        f"{self.name}: q {q_id} wrongfully dropped off from "
-                        f"col {qubit_objs[q_id].c} row {qubit_objs[q_id].r} "
-                        f"at x={qubit_objs[q_id].x} y={qubit_objs[q_id].y}."
-                    )
+        bad = np.flatnonzero(
+            (dropoff & ~deactive) | (~dropoff & state.q_aod & deactive)
+        )
+        if len(bad):
+            q = qubit_objs[bad[0]]
+            if dropoff[q.id]:
+                raise ValueError(
+                    f"{self.name}: q {q.id} not dropped off from "
+                    f"col {q.c} row {q.r} at x={q.x} y={q.y}."
+                )
+            raise ValueError(
+                f"{self.name}: q {q.id} wrongfully dropped off from "
+                f"col {q.c} row {q.r} at x={q.x} y={q.y}."
+            )
 
 
 class Rydberg(Inst):
@@ -829,7 +1051,8 @@ class Rydberg(Inst):
         gates: Sequence[Mapping[str, int | str]],
     ):
         super().__init__("Rydberg", prefix=f"Rydberg_{s}", stage=s)
-        self.verify(gates, qubit_objs)
+        if self.verifying(qubit_objs):
+            self.verify(gates, qubit_objs)
         super().write_code(
             col_objs,
             row_objs,
@@ -871,7 +1094,8 @@ class Raman(Inst):
         super().__init__(
             "Raman", prefix=f'Raman_{s}_{gate["q0"]}_{gate["op"]}', stage=s
         )
-        self.verify(gate, qubit_objs)
+        if self.verifying(qubit_objs):
+            self.verify(gate, qubit_objs)
         params = self.compute_parameters(gate)
         super().write_code(col_objs, row_objs, qubit_objs, {"gate": gate} | params)
 
@@ -911,7 +1135,8 @@ class Measurement(Inst):
         gate: Mapping[str, int | str],
     ):
         super().__init__("Measurement", prefix=f'Raman_{s}_{gate["q0"]}', stage=s)
-        self.verify(gate, qubit_objs)
+        if self.verifying(qubit_objs):
+            self.verify(gate, qubit_objs)
         super().write_code(col_objs, row_objs, qubit_objs, {"gate": gate})
 
     def verify(self, gate: Mapping[str, int | str], qubit_objs: Sequence[Qubit]):
@@ -1466,6 +1691,26 @@ class Swap(ComboInst):
         )
 
 
+def _build_stages(
+    codegen: "CodeGen",
+    no_transfer: bool,
+    start: int,
+    end: int,
+    checkpoint: "MachineState",
+    init: "Init",
+) -> Tuple[Sequence[str], Sequence[str]]:
+    # runs in a worker of CodeGen.build_parallel: build stages start, ...,
+    # end-1 from the checkpoint and return the JSON of their instructions
+    cols, rows, qubits = checkpoint.cols, checkpoint.rows, checkpoint.qubits
+    full = []
+    reduced = []
+    for s in range(start, end):
+        stage = codegen.builder_stage(s, no_transfer, cols, rows, qubits, init)
+        full += [json.dumps(code) for code in stage.emit_full()]
+        reduced += [json.dumps(code) for code in stage.emit()]
+    return full, reduced
+
+
 class CodeGen:
     """Generate code files: json containing a list of dict, each one
     corresponding to a DPQA instruction defined above.
@@ -1477,20 +1722,171 @@ class CodeGen:
         no_transfer: bool = False,
         dir: str = None,
         steane: bool = False,
+        delta_states: bool = False,
+        keyframe_interval: int = KEYFRAME_INTERVAL,
+        binary: bool = False,
+        stream: bool = False,
+        workers: int = 1,
+        check_parallel: bool = False,
+        check_swap: bool = False,
+        verification: str = "fast",
+        fuse: bool = False,
     ):
+        # delta_states: write the states in code_full delta-encoded with a
+        # full snapshot every keyframe_interval instructions. binary: write
+        # code_full as *_code_full.dpqa in the binary container instead.
+        # See codeformat. stream: build and write the code stage by stage
+        # to JSON lines files, *_code_full.jsonl and *_code.jsonl, see
+        # write_stream, instead of building the whole program first.
+        # workers: build and serialize the stages in this many processes,
+        # see build_parallel; check_parallel compares with the serial build.
+        # check_swap: also find the swaps by comparing every pair of qubits,
+        # and raise if they differ from swap_candidates. verification: one of
+        # VERIFY_LEVELS; 'off' skips the verify of every Inst, which is fine
+        # for trusted results of solve.py; 'fast' verifies every Inst as it
+        # is built; 'full' also replays the written code with verifier.py.
+        # fuse: fuse consecutive Moves and (De)Activates with peephole.py,
+        # the microseconds saved are in saved_duration.
+        if verification not in VERIFY_LEVELS:
+            raise ValueError(
+                f"verification {verification} not in {VERIFY_LEVELS}."
+            )
         self.steane = steane
+        self.check_swap = check_swap
+        self.verification = verification
+        self.fuse = fuse
+        self.saved_duration = 0
         self.read_compiled(file_name)
-        program = self.builder(no_transfer)
 
         if not dir:
             dir = "./results/code/"
         self.code_full_file = dir + (file_name.split("/")[-1]).replace(
             ".json", "_code_full.json"
         )
-        with open(self.code_full_file, "w") as f:
-            json.dump(program.emit_full(), f)
-        with open(self.code_full_file.replace("_code_full", "_code"), "w") as f:
-            json.dump(program.emit(), f)
+        self.write_files(
+            no_transfer,
+            delta_states,
+            keyframe_interval,
+            binary,
+            stream,
+            workers,
+            check_parallel,
+        )
+        if verification == "full":
+            # verifier imports this module
+            from verifier import verifyCode
+
+            errors = verifyCode(self.code_full_file, workers)
+            if errors:
+                raise ValueError(
+                    f"{self.code_full_file}: {len(errors)} instructions "
+                    f"failed verification, the first: {errors[0]}"
+                )
+
+    def write_files(
+        self,
+        no_transfer: bool,
+        delta_states: bool,
+        keyframe_interval: int,
+        binary: bool,
+        stream: bool,
+        workers: int,
+        check_parallel: bool,
+    ):
+        # build the code and write the files, see __init__ for the options
+        if stream:
+            self.write_stream(
+                no_transfer, binary, delta_states, keyframe_interval
+            )
+            return
+        if workers > 1:
+            if binary or delta_states:
+                raise ValueError("workers > 1 only writes the JSON format.")
+            if self.fuse:
+                raise ValueError("workers > 1 does not fuse instructions.")
+            full, reduced = self.build_parallel(no_transfer, workers)
+            code_full = "[" + ", ".join(full) + "]"
+            code = "[" + ", ".join(reduced) + "]"
+            if check_parallel:
+                program = self.builder(no_transfer)
+                if code_full != json.dumps(program.emit_full()) or\
+                        code != json.dumps(program.emit()):
+                    raise ValueError(
+                        "parallel CodeGen differs from the serial build.")
+            with open(self.code_full_file, "w") as f:
+                f.write(code_full)
+            with open(self.code_full_file.replace("_code_full", "_code"), "w") as f:
+                f.write(code)
+            return
+
+        program = self.builder(no_transfer)
+        code_full = program.emit_full()
+        code = program.emit()
+        if self.fuse:
+            # peephole imports this module
+            from peephole import peephole
+
+            code_full, code, self.saved_duration = peephole(code_full, code)
+        if binary:
+            self.code_full_file = self.code_full_file.replace(".json", ".dpqa")
+            writeBinary(code_full, self.code_full_file)
+        else:
+            if delta_states:
+                code_full = encodeDelta(code_full, keyframe_interval)
+            with open(self.code_full_file, "w") as f:
+                json.dump(code_full, f)
+        code_file = self.code_full_file.replace("_code_full", "_code")
+        with open(code_file.replace(".dpqa", ".json"), "w") as f:
+            json.dump(code, f)
+
+    def write_stream(
+        self,
+        no_transfer: bool,
+        binary: bool = False,
+        delta_states: bool = False,
+        keyframe_interval: int = KEYFRAME_INTERVAL,
+    ):
+        """write the code as it is generated by stream(), so only one stage
+        of instructions is in memory. The files are JSON lines: one
+        instruction per line; code_full starts with a line of the delta
+        format if delta_states, and ends with the trailer of all_slms.
+        With binary, code_full goes to the binary container instead.
+        """
+        self.code_full_file = self.code_full_file.replace(
+            ".json", ".dpqa" if binary else ".jsonl"
+        )
+        code_file = self.code_full_file.replace("_code_full", "_code")
+        with open(code_file.replace(".dpqa", ".jsonl"), "w") as f_code:
+
+            def code_full() -> Iterator[Mapping[str, Any]]:
+                if self.fuse:
+                    from peephole import peephole
+                # state before each stage, the stages are fused separately
+                prev = None
+                for full, reduced in self.stream(no_transfer):
+                    if self.fuse:
+                        full, reduced, saved = peephole(full, reduced, prev)
+                        self.saved_duration += saved
+                        prev = full[-1].get("state", prev)
+                    for code in reduced:
+                        f_code.write(json.dumps(code) + "\n")
+                    yield from full
+
+            if binary:
+                writeBinary(code_full(), self.code_full_file)
+                return
+            with open(self.code_full_file, "w") as f:
+                insts = code_full()
+                if delta_states:
+                    f.write(
+                        json.dumps({
+                            "format": DELTA_FORMAT,
+                            "keyframe_interval": keyframe_interval,
+                        }) + "\n"
+                    )
+                    insts = encodeDeltaStream(insts, keyframe_interval)
+                for code in insts:
+                    f.write(json.dumps(code) + "\n")
 
     def read_compiled(self, filename: str):
         with open(filename, "r") as f:
@@ -1541,8 +1937,11 @@ class CodeGen:
         for s, layer in enumerate(self.layers):
             if s == 0:
                 continue
-            layer["row"] = [{"id": i, "qs": []} for i in range(self.r_high - 0)]
+            layer["row"] = [
+                {"id": i, "qs": [], "sites_begin": {}} for i in range(self.r_high - 0)
+            ]
             layer["col"] = [{"id": i, "qs": []} for i in range(self.c_high - 0)]
+            layer["y_sites"] = {}
             prev_layer = self.layers[s - 1]
 
             # figure out in the movement from stage s-1 to s:
@@ -1559,6 +1958,17 @@ class CodeGen:
                     layer["col"][q["c"]]["x_end"] = q["x"]
                     layer["col"][q["c"]]["qs"].append(q["id"])
 
+            # index the qubits for Reload and Offload:
+            # - for each row, the qubits it picks up at each site x in the
+            #   beginning 'sites_begin'
+            # - for each y and x in the end, the qubits at that site 'y_sites'
+            for i, q in enumerate(layer["qubits"]):
+                if q["a"] == 1 and isinstance(q["r"], int):
+                    layer["row"][q["r"]]["sites_begin"].setdefault(
+                        prev_layer["qubits"][i]["x"], []
+                    ).append(i)
+                layer["y_sites"].setdefault(q["y"], {}).setdefault(q["x"], []).append(i)
+
             # figure out in the movement from stage s-1 to s:
             # - before the movement, which columns have site coord = X
             # - for all these cols, what is the relevant order from left 'offset'
@@ -1566,56 +1976,173 @@ class CodeGen:
             # - for all these cols, what is the relevant order from left 'offset'
             # similar for the AOD rows
             for case in ["_begin", "_end"]:
-                x_cols = []
-                for x in range(self.x_high):
-                    cols_at_x = []
-                    for c in range(self.c_high):
-                        if layer["col"][c]["qs"] and layer["col"][c]["x" + case] == x:
-                            cols_at_x.append(c)
-                    for i, c in enumerate(cols_at_x):
-                        layer["col"][c]["offset" + case] = i
-                    x_cols.append(cols_at_x)
+                x_cols = [[] for _ in range(self.x_high)]
+                for c in range(self.c_high):
+                    col = layer["col"][c]
+                    if col["qs"] and col["x" + case] in range(self.x_high):
+                        col["offset" + case] = len(x_cols[col["x" + case]])
+                        x_cols[col["x" + case]].append(c)
                 layer["x_cols" + case] = x_cols
-                y_rows = []
-                for y in range(self.y_high):
-                    rows_at_y = []
-                    for r in range(self.r_high):
-                        if layer["row"][r]["qs"] and layer["row"][r]["y" + case] == y:
-                            rows_at_y.append(r)
-                    for i, r in enumerate(rows_at_y):
-                        layer["row"][r]["offset" + case] = i
-                    y_rows.append(rows_at_y)
+                y_rows = [[] for _ in range(self.y_high)]
+                for r in range(self.r_high):
+                    row = layer["row"][r]
+                    if row["qs"] and row["y" + case] in range(self.y_high):
+                        row["offset" + case] = len(y_rows[row["y" + case]])
+                        y_rows[row["y" + case]].append(r)
                 layer["y_rows" + case] = y_rows
 
     def builder(self, no_transfer: bool):
-        qubits = [Qubit(i) for i in range(self.n_q)]
-        rows = [Row(i) for i in range(self.r_high)]
-        cols = [Col(i) for i in range(self.c_high)]
         program = ComboInst("Program")
+        for inst in self.builder_stages(no_transfer):
+            program.append_inst(inst)
+        return program
+
+    def builder_stages(
+        self, no_transfer: bool
+    ) -> Iterator[Union[Init, ComboInst]]:
+        """yield the Init, then the non-trivial instructions of each stage in
+        a ComboInst. Each stage is only built when it is asked for, so the
+        all_slms of Init is complete after the last stage.
+
+        Args:
+            no_transfer (bool): whether there is no atom transfer.
+
+        Yields:
+            Init | ComboInst: Init, then the instructions of stage 0, 1, ...
+        """
+        state = MachineState(self.n_q, self.c_high, self.r_high)
+        state.verify_insts = self.verification != "off"
+        cols, rows, qubits = state.cols, state.rows, state.qubits
 
         # read to comment in read_compiled() for structure of this method.
-        init = self.builder_init(cols, rows, qubits, program)  # has Rydberg_0
+        stage = ComboInst("Stage", suffix="0", stage=0)
+        init = self.builder_init(cols, rows, qubits, stage)  # has Rydberg_0
+        yield init
+        stage.remove_trivial_insts()
+        yield stage
+
+        for s in range(1, len(self.layers)):
+            yield self.builder_stage(s, no_transfer, cols, rows, qubits, init)
+
+    def builder_stage(
+        self,
+        s: int,
+        no_transfer: bool,
+        cols: Sequence[Col],
+        rows: Sequence[Row],
+        qubits: Sequence[Qubit],
+        init: Init,
+    ) -> ComboInst:
+        """build the non-trivial instructions of stage s>0, starting from
+        the state of cols, rows, and qubits at the end of stage s-1."""
+        stage = ComboInst("Stage", suffix=str(s), stage=s)
+        self.builder_swap(s, cols, rows, qubits, stage)
+
+        if (not no_transfer) or s == 1:
+            # if we know there is not atom transfer, we can simply skip the
+            # reload and offload procedures. However, we keep the first one
+            # just for convenience of generating animations.
+            self.builder_reload(s, cols, rows, qubits, stage)
+
+        self.builder_move(s, cols, rows, qubits, stage)
+
+        if not no_transfer:
+            self.builder_offload(s, cols, rows, qubits, stage)
+
+        self.builder_raman(s, cols, rows, qubits, stage, init)
+        self.builder_rydberg(s, cols, rows, qubits, stage, init)
+        stage.remove_trivial_insts()
+        return stage
+
+    def builder_checkpoints(
+        self, no_transfer: bool
+    ) -> Tuple[Init, ComboInst, Sequence[MachineState]]:
+        """serial pass over the stages that only keeps the state of the
+        cols, rows, and qubits at every stage boundary. The state is not
+        only the positions of the qubits in the layers: the traps chosen
+        in Offload, and the c/r of qubits and x/y of cols/rows left from
+        earlier stages, are also in the code, so they are replayed here.
+
+        Args:
+            no_transfer (bool): whether there is no atom transfer.
 
+        Returns:
+            Tuple[Init, ComboInst, Sequence[Any]]: Init with all its SLMs,
+                the instructions of stage 0, and for each stage s>0 the
+                MachineState at its beginning.
+        """
+        state = MachineState(self.n_q, self.c_high, self.r_high)
+        state.verify_insts = self.verification != "off"
+        cols, rows, qubits = state.cols, state.rows, state.qubits
+        stage = ComboInst("Stage", suffix="0", stage=0)
+        init = self.builder_init(cols, rows, qubits, stage)
+        stage.remove_trivial_insts()
+        checkpoints = []
         for s in range(1, len(self.layers)):
-            self.builder_swap(s, cols, rows, qubits, program)
+            checkpoints.append(state.copy())
+            self.builder_stage(s, no_transfer, cols, rows, qubits, init)
+        return init, stage, checkpoints
 
-            if (not no_transfer) or s == 1:
-                # if we know there is not atom transfer, we can simply skip the
-                # reload and offload procedures. However, we keep the first one
-                # just for convenience of generating animations.
-                self.builder_reload(s, cols, rows, qubits, program)
+    def build_parallel(
+        self, no_transfer: bool, workers: int
+    ) -> Tuple[Sequence[str], Sequence[str]]:
+        """build and serialize the stages in a process pool. The stages are
+        split in contiguous chunks, each rebuilt from the checkpoint at its
+        beginning, see builder_checkpoints.
 
-            self.builder_move(s, cols, rows, qubits, program)
+        Args:
+            no_transfer (bool): whether there is no atom transfer.
+            workers (int): number of processes.
 
-            if not no_transfer:
-                self.builder_offload(s, cols, rows, qubits, program)
+        Returns:
+            Tuple[Sequence[str], Sequence[str]]: the JSON of every
+                instruction of the full and the reduced code, in order.
+        """
+        init, stage_0, checkpoints = self.builder_checkpoints(no_transfer)
+        full = [json.dumps(code) for code in init.emit_full()]
+        full += [json.dumps(code) for code in stage_0.emit_full()]
+        reduced = [json.dumps(code) for code in init.emit()]
+        reduced += [json.dumps(code) for code in stage_0.emit()]
+
+        num_stage = len(checkpoints)
+        chunk = -(-num_stage // max(workers, 1)) if num_stage else 1
+        tasks = [
+            (self, no_transfer, start, min(start + chunk, num_stage + 1),
+             checkpoints[start - 1], init)
+            for start in range(1, num_stage + 1, chunk)
+        ]
+        if "fork" in multiprocessing.get_all_start_methods():
+            mp = multiprocessing.get_context("fork")
+        else:
+            mp = multiprocessing.get_context()
+        with mp.Pool(workers) as pool:
+            for chunk_full, chunk_reduced in pool.starmap(_build_stages, tasks):
+                full += chunk_full
+                reduced += chunk_reduced
+        return full, reduced
+
+    def stream(
+        self, no_transfer: bool
+    ) -> Iterator[Tuple[Sequence[Mapping[str, Any]], Sequence[Mapping[str, Any]]]]:
+        """generate the code stage by stage, see builder_stages.
 
-            self.builder_raman(s, cols, rows, qubits, program, init)
-            self.builder_rydberg(s, cols, rows, qubits, program, init)
+        Args:
+            no_transfer (bool): whether there is no atom transfer.
 
-        program.remove_trivial_insts()
-        program.prepend_inst(init)
-        return program
+        Yields:
+            Tuple[Sequence[Mapping[str, Any]], Sequence[Mapping[str, Any]]]:
+                the full and the reduced code of Init, then of each stage,
+                and finally ([trailer], []) where the trailer holds the
+                all_slms of Init.
+        """
+        for inst in self.builder_stages(no_transfer):
+            if isinstance(inst, Init):
+                init = inst
+                # all_slms is not known yet, it goes to the trailer
+                yield [dict(inst.code)], inst.emit()
+            else:
+                yield inst.emit_full(), inst.emit()
+        yield [{"type": TRAILER, "all_slms": init.all_slms}], []
 
     def builder_init(
         self,
@@ -1719,8 +2246,51 @@ class CodeGen:
         program: ComboInst,
     ):
         swap_obj = Swap(s)
+        this_layer = self.layers[s]
+        pairs = self.swap_candidates(s)
+        if self.check_swap and pairs != self.swap_candidates_pairwise(s):
+            raise ValueError(f"builder swap {s}: candidates differ from pairwise.")
+        # the check uses the current x of qubits, which the previous
+        # SwapPair may have changed, so the pairs are visited in order
+        for q0_id, q1_id in pairs:
+            q0_c = this_layer["qubits"][q0_id]["c"]
+            q1_c = this_layer["qubits"][q1_id]["c"]
+            # if their position and col indeces are in reverse order
+            if (q0_c > q1_c and qubits[q0_id].x < qubits[q1_id].x) or (
+                q0_c < q1_c and qubits[q0_id].x > qubits[q1_id].x
+            ):
+                swap_obj.add_swap_pair(cols, rows, qubits, q0_id, q1_id)
+        program.append_inst(swap_obj)
+
+    def swap_candidates(self, s: int) -> Sequence[Tuple[int, int]]:
+        """pairs of qubits in AOD at stage s that were at the same site in
+        stage s-1 and are picked up in the same row, in the order of
+        (q0, q1). The qubits are grouped by (x, y, r), and only the qubits in
+        one group, normally at most 2, are paired."""
+        prev_layer = self.layers[s - 1]
+        this_layer = self.layers[s]
+        groups = {}
+        for q_id in range(self.n_q):
+            if this_layer["qubits"][q_id]["a"] == 1:
+                key = (
+                    prev_layer["qubits"][q_id]["x"],
+                    prev_layer["qubits"][q_id]["y"],
+                    this_layer["qubits"][q_id]["r"],
+                )
+                groups.setdefault(key, []).append(q_id)
+        pairs = [
+            (q0_id, q1_id)
+            for group in groups.values()
+            for i, q0_id in enumerate(group)
+            for q1_id in group[i + 1 :]
+        ]
+        return sorted(pairs)
+
+    def swap_candidates_pairwise(self, s: int) -> Sequence[Tuple[int, int]]:
+        # swap_candidates by comparing every pair of qubits, for debugging
         prev_layer = self.layers[s - 1]
         this_layer = self.layers[s]
+        pairs = []
         for q0_id in range(self.n_q):
             for q1_id in range(q0_id + 1, self.n_q):
                 q0_a = this_layer["qubits"][q0_id]["a"]
@@ -1730,19 +2300,13 @@ class CodeGen:
                     q1_x = prev_layer["qubits"][q1_id]["x"]
                     q0_y = prev_layer["qubits"][q0_id]["y"]
                     q1_y = prev_layer["qubits"][q1_id]["y"]
-                    q0_c = this_layer["qubits"][q0_id]["c"]
-                    q1_c = this_layer["qubits"][q1_id]["c"]
                     q0_r = this_layer["qubits"][q0_id]["r"]
                     q1_r = this_layer["qubits"][q1_id]["r"]
                     # if two qubits are at the same site and
                     # both being picked up in the same row
                     if (q0_x, q0_y, q0_r) == (q1_x, q1_y, q1_r):
-                        # if their position and col indeces are in reverse order
-                        if (q0_c > q1_c and qubits[q0_id].x < qubits[q1_id].x) or (
-                            q0_c < q1_c and qubits[q0_id].x > qubits[q1_id].x
-                        ):
-                            swap_obj.add_swap_pair(cols, rows, qubits, q0_id, q1_id)
-        program.append_inst(swap_obj)
+                        pairs.append((q0_id, q1_id))
+        return pairs
 
     def builder_move(
         self,
@@ -1817,7 +2381,6 @@ class CodeGen:
         program: ComboInst,
     ):
         layer = self.layers[s]
-        prev_layer = self.layers[s - 1]
         reload_obj = Reload(s)
         # reload row by row
         for row_id in range(self.r_high):
@@ -1826,19 +2389,15 @@ class CodeGen:
                 pickup_qs = []
                 cols_to_active = []
                 x_to_activate = []
-                # consider the movements in a row of sites
-                for site_x in range(self.x_high):
-                    site_qs = []
-                    for q_id in range(len(qubits)):
-                        # find out the qubits with site_x and in row_id
-                        if (
-                            layer["qubits"][q_id]["a"] == 1
-                            and prev_layer["qubits"][q_id]["x"] == site_x
-                            and layer["qubits"][q_id]["r"] == row_id
-                        ):
-                            site_qs.append(q_id)
-                            qubits[q_id].r = row_id
-                            qubits[q_id].c = layer["qubits"][q_id]["c"]
+                # consider the movements in a row of sites, only the sites
+                # with qubits to pick up, see aod_from_compiled
+                sites_begin = layer["row"][row_id]["sites_begin"]
+                for site_x in sorted(sites_begin):
+                    # the qubits with site_x and in row_id
+                    site_qs = sites_begin[site_x]
+                    for q_id in site_qs:
+                        qubits[q_id].r = row_id
+                        qubits[q_id].c = layer["qubits"][q_id]["c"]
 
                     # shift the 1 or 2 cols that are picking up qubits
                     if len(site_qs) == 2:
@@ -2012,16 +2571,18 @@ class CodeGen:
             if rows[row_id].active:
                 dropoff_qs = []
                 offloadRow_obj = offload_obj.add_row_offload(row_id)
-                for site_x in range(self.x_high):
+                # the sites with qubits in the row, see aod_from_compiled
+                x_sites = layer["y_sites"].get(layer["row"][row_id]["y_end"], {})
+                for site_x in sorted(x_sites):
                     site_q_slm = []
                     site_q_aod = []
-                    for q_id, q in enumerate(layer["qubits"]):
-                        if (q["x"], q["y"]) == (site_x, layer["row"][row_id]["y_end"]):
-                            if qubits[q_id].array == "AOD" and q["r"] == row_id:
-                                dropoff_qs.append(q_id)
-                                site_q_aod.append(q_id)
-                            if qubits[q_id].array == "SLM":
-                                site_q_slm.append(q_id)
+                    for q_id in x_sites[site_x]:
+                        q = layer["qubits"][q_id]
+                        if qubits[q_id].array == "AOD" and q["r"] == row_id:
+                            dropoff_qs.append(q_id)
+                            site_q_aod.append(q_id)
+                        if qubits[q_id].array == "SLM":
+                            site_q_slm.append(q_id)
                     if len(site_q_aod) == 2:
                         [q_id_left, q_id_right] = site_q_aod
                         if (
@@ -2142,7 +2703,8 @@ class Animator:
     ):
         """
         Args:
-            code_file_name (str): file name of code_full generated by CodeGen.
+            code_file_name (str): file name of code_full generated by CodeGen,
+                in any format of codeformat.
             scaling_factor (int, optional): the unit scaling factor between the
              animation and um. Defaults to PT_MICRON.
             font (int, optional): font size in the animation. Defaults to 10.
@@ -2184,14 +2746,17 @@ class Animator:
         )
 
         animation_file = (
-            dir + (code_file_name.replace("_code_full.json", ".mp4")).split("/")[-1]
+            dir
+            + re.sub(r"_code_full\.(json|jsonl|dpqa)$", ".mp4", code_file_name).split(
+                "/"
+            )[-1]
         )
         self.animation_file = animation_file
         anim.save(animation_file, writer=FFMpegWriter(FPS))
 
     def read_files(self, code_file: str):
-        with open(code_file, "r") as f:
-            self.code = json.load(f)
+        self.states = readCode(code_file)
+        self.code = self.states.insts
 
         self.n_q = self.code[0]["n_q"]
         self.x_high = self.code[0]["x_high"]
@@ -2367,21 +2932,21 @@ class Animator:
         for i, inst in enumerate(self.code):
             if f >= self.keyframes[i - 1] and f < self.keyframes[i]:
                 if inst["type"] == "Rydberg":
-                    return self.update_rydberg(f, inst)
+                    return self.update_rydberg(f, inst, self.states.state_at(i))
                 elif inst["type"] == "Move":
-                    return self.update_move(f, inst, self.code[i - 1]["state"])
+                    return self.update_move(f, inst, self.states.state_at(i - 1))
                 elif inst["type"] == "Activate":
-                    return self.update_activate(f, inst)
+                    return self.update_activate(f, inst, self.states.state_at(i))
                 elif inst["type"] == "Deactivate":
-                    return self.update_deactivate(f, inst)
+                    return self.update_deactivate(f, inst, self.states.state_at(i))
                 elif inst["type"] == "Init":
                     return
                 elif inst["type"] == "Raman" or inst["type"] == "Measurement":
-                    return self.update_raman(f, inst)
+                    return self.update_raman(f, inst, self.states.state_at(i))
                 else:
                     raise ValueError(f"unknown inst type {inst['type']}")
 
-    def update_raman(self, f: int, inst: dict):
+    def update_raman(self, f: int, inst: dict, state: dict):
         q_id = inst["gate"]["q0"]
         if f == inst["f_begin"]:
             self.title.set_text(inst["name"])
@@ -2392,19 +2957,19 @@ class Animator:
             self.qubit_scat.set_color(
                 [
                     "b" if i != q_id else "g" if inst["gate"]["op"] != "m" else "r"
-                    for i in range(len(inst["state"]["qubits"]))
+                    for i in range(len(state["qubits"]))
                 ]
             )
             if inst["gate"]["op"] != "m":
                 self.texts = [
                     self.ax.text(
-                        inst["state"]["qubits"][q_id]["x"] + 1,
-                        inst["state"]["qubits"][q_id]["y"] + 1,
+                        state["qubits"][q_id]["x"] + 1,
+                        state["qubits"][q_id]["y"] + 1,
                         f"duration={inst['raman_duration']:.3f}, angle={inst['angle']:.3f}, rabi={inst['rabi_max']:.3f}, detuning={inst['detuning_max']:.3f}",
                     )
                 ]
             self.qubit_scat.set_offsets(
-                [(q["x"], q["y"]) for q in inst["state"]["qubits"]]
+                [(q["x"], q["y"]) for q in state["qubits"]]
             )
         if f == inst["f_end"]:
             if self.circuit_image:
@@ -2414,7 +2979,7 @@ class Animator:
                 for text in self.texts:
                     text.remove()
 
-    def update_rydberg(self, f: int, inst: dict):
+    def update_rydberg(self, f: int, inst: dict, state: dict):
         edges = [(g["q0"], g["q1"]) for g in inst["gates"]]
         if f == inst["f_begin"]:
             if self.circuit_image:
@@ -2428,8 +2993,8 @@ class Animator:
                 active_qubits += [g["q0"], g["q1"]]
             self.texts = [
                 self.ax.text(
-                    inst["state"]["qubits"][q_id]["x"] + 1,
-                    inst["state"]["qubits"][q_id]["y"] + 1,
+                    state["qubits"][q_id]["x"] + 1,
+                    state["qubits"][q_id]["y"] + 1,
                     q_id,
                 )
                 for q_id in active_qubits
@@ -2440,7 +3005,7 @@ class Animator:
 
             # draw SLM qubits in blue and at the correct locations
             self.qubit_scat.set_offsets(
-                [(q["x"], q["y"]) for q in inst["state"]["qubits"]]
+                [(q["x"], q["y"]) for q in state["qubits"]]
             )
 
         if self.show_graph and f == int((inst["f_begin"] + inst["f_end"]) / 2):
@@ -2504,7 +3069,7 @@ class Animator:
         self.qubit_scat.set_offsets([(q_xs[i], q_ys[i]) for i in range(self.n_q)])
         return
 
-    def update_activate(self, f: int, inst: dict):
+    def update_activate(self, f: int, inst: dict, state: dict):
         if f == inst["f_begin"]:
             self.title.set_text(inst["name"])
 
@@ -2519,15 +3084,15 @@ class Animator:
 
             # SLM qubits remain blue while qubits being picked up turns red
             self.qubit_scat.set_color(
-                ["b" if q["array"] == "SLM" else "r" for q in inst["state"]["qubits"]]
+                ["b" if q["array"] == "SLM" else "r" for q in state["qubits"]]
             )
 
-    def update_deactivate(self, f: int, inst: dict):
+    def update_deactivate(self, f: int, inst: dict, state: dict):
         if f == inst["f_end"]:
             self.title.set_text(inst["name"])
 
             self.qubit_scat.set_color(
-                ["b" if q["array"] == "SLM" else "r" for q in inst["state"]["qubits"]]
+                ["b" if q["array"] == "SLM" else "r" for q in state["qubits"]]
             )
 
             # deactivate Cols/Rows by setting alpha=0
@@ -2556,6 +3121,38 @@ if __name__ == "__main__":
     #     "--noGraph", help="do not show graph on the side", action="store_true"
     # )
     parser.add_argument("--dir", help="working directory", type=str)
+    parser.add_argument(
+        "--delta",
+        help="delta-encode the states in the code_full file",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--binary",
+        help="write the code_full file in the binary container",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--stream",
+        help="generate and write the code stage by stage",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--workers",
+        help="processes to build the stages in parallel",
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        "--verification",
+        help="off, fast (verify every instruction), or full (also replay the code)",
+        choices=VERIFY_LEVELS,
+        default="fast",
+    )
+    parser.add_argument(
+        "--fuse",
+        help="fuse consecutive Moves and (De)Activates, see peephole.py",
+        action="store_true",
+    )
     args = parser.parse_args()
 
     with open(args.input_file, "r") as f:
@@ -2573,7 +3170,15 @@ if __name__ == "__main__":
         no_transfer=data["no_transfer"],
         dir=args.dir if args.dir else "./results/code/",
         steane=args.steane,
+        delta_states=args.delta,
+        binary=args.binary,
+        stream=args.stream,
+        workers=args.workers,
+        verification=args.verification,
+        fuse=args.fuse,
     )
+    if args.fuse:
+        print(f"fused instructions: {codegen.saved_duration:.2f}us saved.")
     Animator(
         codegen.code_full_file,
         scaling_factor=args.scaling if args.scaling else PT_MICRON,
@@ -0,0 +1,347 @@
+from typing import Mapping, Sequence, Any, Union
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing.connection import wait
+from collections import deque
+from solve import DPQA
+import multiprocessing
+import argparse
+import sqlite3
+import time
+import json
+import os
+
+try:
+    import resource
+except ImportError:  # not available on Windows, memory limits are ignored
+    resource = None
+
+
+def build_dpqa(
+        name: str,
+        program: Sequence[Sequence[int]],
+        arch: Sequence[int],
+        dir: Union[str, None] = None,
+        all_commutable: bool = False,
+        print_detail: bool = False,
+) -> DPQA:
+    """set up a DPQA instance the same way run.py does.
+
+    Args:
+        name (str): name of the compilation, also used as file name.
+        program (Sequence[Sequence[int]]): list of qubit pairs of 2Q gates.
+        arch (Sequence[int]): [#X, #Y, #C, #R] passed to setArchitecture.
+        dir (str | None, optional): output directory. Defaults to None.
+        all_commutable (bool, optional): whether the gates commute.
+            Defaults to False.
+        print_detail (bool, optional): Defaults to False.
+
+    Returns:
+        DPQA: the instance ready for solve().
+    """
+    tmp = DPQA(name, dir=dir, print_detail=print_detail)
+    tmp.setArchitecture(arch)
+    tmp.setProgram(program)
+    if all_commutable:
+        tmp.setCommutation()
+    tmp.hybrid_strategy()
+    return tmp
+
+
+def compile_threaded(
+        programs: Sequence[Sequence[Sequence[int]]],
+        arch: Sequence[int],
+        workers: int = 4,
+        names: Union[Sequence[str], None] = None,
+        dir: Union[str, None] = None,
+        all_commutable: bool = False,
+        save_file: bool = False,
+) -> Sequence[Mapping[str, Any]]:
+    """compile several programs concurrently in a thread pool.
+
+    Each DPQA instance owns its z3 context, so the instances do not share
+    any z3 state. z3 is called through ctypes, which releases the GIL for
+    the duration of every call into libz3, so the threads solve in parallel
+    while only the Python-side encoding is serialized.
+
+    Args:
+        programs (Sequence[Sequence[Sequence[int]]]): the programs to compile.
+        arch (Sequence[int]): [#X, #Y, #C, #R] shared by all programs.
+        workers (int, optional): number of threads. Defaults to 4.
+        names (Sequence[str] | None, optional): names of the programs.
+            Defaults to None, i.e., 'program_0', 'program_1', ...
+        dir (str | None, optional): output directory. Defaults to None.
+        all_commutable (bool, optional): Defaults to False.
+        save_file (bool, optional): whether to write each result to dir.
+            Defaults to False.
+
+    Returns:
+        Sequence[Mapping[str, Any]]: result_json of each program, in order.
+    """
+    if names is None:
+        names = [f"program_{i}" for i in range(len(programs))]
+    if len(names) != len(programs):
+        raise ValueError(
+            f"{len(names)} names given for {len(programs)} programs.")
+
+    def job(i: int) -> Mapping[str, Any]:
+        tmp = build_dpqa(names[i], programs[i], arch, dir=dir,
+                         all_commutable=all_commutable)
+        return tmp.solve(save_file=save_file)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(job, range(len(programs))))
+
+
+def _compile_job(
+        conn: Any,
+        name: str,
+        program: Sequence[Sequence[int]],
+        arch: Sequence[int],
+        all_commutable: bool,
+        mem_limit: Union[int, None],
+):
+    # runs in the worker process. The result or the error is sent back
+    # through conn; if the process dies before that, the job is retried.
+    if mem_limit and resource:
+        limit = mem_limit * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+    try:
+        tmp = build_dpqa(name, program, arch, all_commutable=all_commutable)
+        conn.send({"status": "ok", "result": tmp.solve(save_file=False)})
+    except MemoryError:
+        conn.send({"status": "memory", "error": "memory limit exceeded"})
+    except Exception as e:
+        conn.send({"status": "error", "error": repr(e)})
+    conn.close()
+
+
+class ResultStore:
+    """sqlite file holding the result and timing stats of every job,
+    indexed by the job name and by its status."""
+
+    def __init__(self, file_name: str):
+        self.conn = sqlite3.connect(file_name)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS results ("
+            "name TEXT PRIMARY KEY, status TEXT, attempts INTEGER, "
+            "n_q INTEGER, n_g INTEGER, n_t INTEGER, solve_time REAL, "
+            "wall_time REAL, timestamp REAL, error TEXT, result TEXT)"
+        )
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS results_status ON results (status)")
+        self.conn.commit()
+
+    def write(
+            self,
+            name: str,
+            status: str,
+            attempts: int,
+            wall_time: float,
+            result: Union[Mapping[str, Any], None] = None,
+            error: Union[str, None] = None,
+    ):
+        self.conn.execute(
+            "INSERT OR REPLACE INTO results VALUES "
+            "(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                name,
+                status,
+                attempts,
+                result["n_q"] if result else None,
+                result["n_g"] if result else None,
+                result["n_t"] if result else None,
+                float(result["duration"]) if result else None,
+                wall_time,
+                time.time(),
+                error,
+                json.dumps(result) if result else None,
+            ),
+        )
+        self.conn.commit()
+
+    def done(self) -> Sequence[str]:
+        rows = self.conn.execute(
+            "SELECT name FROM results WHERE status = 'ok'")
+        return [row[0] for row in rows]
+
+    def read(self, name: str) -> Union[Mapping[str, Any], None]:
+        row = self.conn.execute(
+            "SELECT result FROM results WHERE name = ?", (name,)).fetchone()
+        return json.loads(row[0]) if row and row[0] else None
+
+    def summary(self) -> Mapping[str, Mapping[str, Any]]:
+        rows = self.conn.execute(
+            "SELECT name, status, attempts, n_t, solve_time, wall_time, "
+            "error FROM results")
+        return {
+            row[0]: {
+                "status": row[1],
+                "attempts": row[2],
+                "n_t": row[3],
+                "solve_time": row[4],
+                "wall_time": row[5],
+                "error": row[6],
+            }
+            for row in rows
+        }
+
+    def close(self):
+        self.conn.close()
+
+
+def compile_many(
+        programs: Sequence[Sequence[Sequence[int]]],
+        arch: Sequence[int],
+        workers: int = 4,
+        names: Union[Sequence[str], None] = None,
+        store: str = "./results/batch.db",
+        timeout: Union[float, None] = None,
+        mem_limit: Union[int, None] = None,
+        retries: int = 1,
+        all_commutable: bool = False,
+        skip_done: bool = True,
+) -> Mapping[str, Mapping[str, Any]]:
+    """compile many programs over a pool of worker processes.
+
+    Every job runs in its own forked process, so the interpreter and the
+    z3/networkx imports are paid once by the parent, and a job can be
+    killed on timeout or when it exceeds its memory limit without taking
+    down the others. A job whose process dies without reporting back
+    (segfault, OOM killer, ...) is retried up to `retries` times.
+
+    Args:
+        programs (Sequence[Sequence[Sequence[int]]]): the programs.
+        arch (Sequence[int]): [#X, #Y, #C, #R] shared by all programs.
+        workers (int, optional): max number of concurrent jobs. Defaults to 4.
+        names (Sequence[str] | None, optional): unique names of the programs,
+            used as keys in the store. Defaults to 'program_0', ...
+        store (str, optional): sqlite file collecting all results.
+            Defaults to './results/batch.db'.
+        timeout (float | None, optional): seconds per job. Defaults to None.
+        mem_limit (int | None, optional): MB of address space per job.
+            Defaults to None.
+        retries (int, optional): retries of a crashed job. Defaults to 1.
+        all_commutable (bool, optional): Defaults to False.
+        skip_done (bool, optional): do not rerun jobs that already succeeded
+            in the store. Defaults to True.
+
+    Returns:
+        Mapping[str, Mapping[str, Any]]: status and timing of every job in
+            the store. Use ResultStore(store).read(name) for a result_json.
+    """
+    if names is None:
+        names = [f"program_{i}" for i in range(len(programs))]
+    if len(set(names)) != len(programs):
+        raise ValueError("names of the programs must be unique.")
+
+    os.makedirs(os.path.dirname(store) or ".", exist_ok=True)
+    results = ResultStore(store)
+    done = set(results.done()) if skip_done else set()
+    pending = deque(
+        (i, 1) for i in range(len(programs)) if names[i] not in done)
+    if "fork" in multiprocessing.get_all_start_methods():
+        mp = multiprocessing.get_context("fork")
+    else:
+        mp = multiprocessing.get_context()
+    running = {}  # receiving end of the pipe -> (job, attempt, process, t_s)
+
+    while pending or running:
+        while pending and len(running) < workers:
+            i, attempt = pending.popleft()
+            recv_conn, send_conn = mp.Pipe(duplex=False)
+            proc = mp.Process(
+                target=_compile_job,
+                args=(send_conn, names[i], programs[i], arch,
+                      all_commutable, mem_limit),
+            )
+            proc.start()
+            send_conn.close()
+            running[recv_conn] = (i, attempt, proc, time.time())
+            print(f"job {names[i]} started (attempt {attempt})")
+
+        ready = wait(list(running.keys()), timeout=1)
+        for recv_conn in list(running.keys()):
+            i, attempt, proc, t_s = running[recv_conn]
+            wall_time = time.time() - t_s
+            if recv_conn in ready:
+                try:
+                    msg = recv_conn.recv()
+                except EOFError:
+                    msg = None  # died before sending anything
+                proc.join()
+                if msg is None and attempt <= retries:
+                    print(f"job {names[i]} crashed with exit code "
+                          f"{proc.exitcode}, retrying")
+                    pending.append((i, attempt + 1))
+                elif msg is None:
+                    results.write(names[i], "crashed", attempt, wall_time,
+                                  error=f"exit code {proc.exitcode}")
+                    print(f"job {names[i]} crashed with exit code "
+                          f"{proc.exitcode}")
+                else:
+                    results.write(names[i], msg["status"], attempt, wall_time,
+                                  result=msg.get("result"),
+                                  error=msg.get("error"))
+                    print(f"job {names[i]} {msg['status']} "
+                          f"in {wall_time:.1f}s")
+            elif timeout is not None and wall_time > timeout:
+                proc.kill()
+                proc.join()
+                results.write(names[i], "timeout", attempt, wall_time,
+                              error=f"timeout after {timeout}s")
+                print(f"job {names[i]} killed after {timeout}s")
+            else:
+                continue
+            recv_conn.close()
+            del running[recv_conn]
+
+    summary = results.summary()
+    results.close()
+    return summary
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="compile the rand3reg graphs in graphs.json in a batch.")
+    parser.add_argument("sizes", metavar="S", type=int, nargs="+",
+                        help="#qubit in graph.")
+    parser.add_argument("--ids", type=int, nargs="+", default=list(range(10)),
+                        help="indices of the graphs. Defaults to 0-9.")
+    parser.add_argument("--graphs", type=str, default="./graphs.json")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--timeout", type=float, help="seconds per job.")
+    parser.add_argument("--mem", type=int, help="MB of memory per job.")
+    parser.add_argument("--retries", type=int, default=1)
+    parser.add_argument("--store", type=str, default="./results/batch.db",
+                        help="sqlite file collecting all the results.")
+    parser.add_argument("--rerun", action="store_true",
+                        help="also rerun the jobs that succeeded before.")
+    args = parser.parse_args()
+
+    with open(args.graphs, "r") as f:
+        graphs = json.load(f)
+    programs = []
+    names = []
+    for size in args.sizes:
+        for id in args.ids:
+            if str(size) not in graphs.keys() or id not in range(
+                    len(graphs[str(size)])):
+                raise ValueError(f"No such graph {size}_{id}.")
+            programs.append(graphs[str(size)][id])
+            names.append(f"rand3reg_{size}_{id}")
+
+    summary = compile_many(
+        programs,
+        [16, 16, 16, 16],
+        workers=args.workers,
+        names=names,
+        store=args.store,
+        timeout=args.timeout,
+        mem_limit=args.mem,
+        retries=args.retries,
+        all_commutable=True,
+        skip_done=not args.rerun,
+    )
+    for name, row in summary.items():
+        print(f"{name}: {row['status']} n_t={row['n_t']} "
+              f"solve_time={row['solve_time']} wall_time={row['wall_time']}")
@@ -0,0 +1,112 @@
+from typing import Mapping, Sequence, Any
+from animation import CodeGen
+import argparse
+import tempfile
+import time
+import json
+import os
+
+
+def synthetic_layers(side: int, n_t: int) -> Mapping[str, Any]:
+    """a compiled result in the format of solve.py with about 2*side^2
+    qubits, for benchmarking CodeGen without running the solver.
+
+    There is one qubit in SLM at every site of a (side+1) x side grid, and
+    one qubit in AOD at every crossing of side columns and side rows. The
+    columns shift one site right and back in alternate stages, and every
+    qubit in AOD has a gate with the qubit in SLM at its site.
+
+    Args:
+        side (int): number of AOD columns and rows.
+        n_t (int): number of stages.
+
+    Returns:
+        Mapping[str, Any]: the result with n_q, n_x, n_y, n_c, n_r, layers.
+    """
+    n_x = side + 1
+    n_slm = n_x * side
+    n_q = n_slm + side * side
+    layers = []
+    for s in range(n_t):
+        qubits = [
+            {"id": i, "a": 0, "x": i // side, "y": i % side, "c": 0, "r": 0}
+            for i in range(n_slm)
+        ]
+        gates = []
+        for c in range(side):
+            for r in range(side):
+                q = n_slm + c * side + r
+                x = c + s % 2
+                qubits.append({"id": q, "a": 1, "x": x, "y": r, "c": c, "r": r})
+                gates.append({"id": len(gates), "q0": x * side + r, "q1": q})
+        layers.append({"qubits": qubits, "gates": gates})
+    return {
+        "n_q": n_q,
+        "n_x": n_x,
+        "n_y": side,
+        "n_c": side,
+        "n_r": side,
+        "no_transfer": True,
+        "layers": layers,
+    }
+
+
+def bench_codegen(
+        sides: Sequence[int],
+        n_t: int = 10,
+        repeat: int = 3,
+) -> Sequence[Mapping[str, Any]]:
+    """time CodeGen on synthetic results of increasing size.
+
+    Args:
+        sides (Sequence[int]): side of each synthetic result, see
+            synthetic_layers.
+        n_t (int, optional): number of stages. Defaults to 10.
+        repeat (int, optional): best of this many runs. Defaults to 3.
+
+    Returns:
+        Sequence[Mapping[str, Any]]: for each size, n_q, the seconds of
+            CodeGen including writing the files, the seconds of building
+            the instructions only, and the microseconds of building per
+            qubit per stage.
+    """
+    stats = []
+    with tempfile.TemporaryDirectory() as dir:
+        for side in sides:
+            result = synthetic_layers(side, n_t)
+            file_name = os.path.join(dir, f"synthetic_{side}.json")
+            with open(file_name, "w") as f:
+                json.dump(result, f)
+            total = float("inf")
+            build = float("inf")
+            for _ in range(repeat):
+                t_s = time.time()
+                codegen = CodeGen(file_name, no_transfer=True, dir=dir + "/")
+                total = min(total, time.time() - t_s)
+                t_s = time.time()
+                codegen.builder(no_transfer=True)
+                build = min(build, time.time() - t_s)
+            stats.append({
+                "n_q": result["n_q"],
+                "time": total,
+                "build_time": build,
+                "us_per_qubit_stage": 1e6 * build / (result["n_q"] * n_t),
+            })
+    return stats
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="time CodeGen on synthetic results of increasing size.")
+    parser.add_argument("sides", metavar="S", type=int, nargs="*",
+                        default=[8, 12, 16, 23],
+                        help="#AOD cols (and rows), about 2*S^2 qubits. "
+                             "Defaults to 8 12 16 23, i.e., 136-1081 qubits.")
+    parser.add_argument("--stages", type=int, default=10)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    for row in bench_codegen(args.sides, args.stages, args.repeat):
+        print(f"n_q={row['n_q']} time={row['time']:.3f}s "
+              f"build={row['build_time']:.3f}s "
+              f"({row['us_per_qubit_stage']:.2f}us per qubit per stage)")
@@ -0,0 +1,96 @@
+from typing import Mapping, Sequence, Any
+from networkx import random_regular_graph
+from solve import DPQA
+import argparse
+import time
+
+
+def compile_rand3reg(
+        n: int,
+        seed: int,
+        hardware: bool,
+        time_budget: float = 3,
+) -> Mapping[str, Any]:
+    """compile a random 3-regular graph like run.py does, greedily.
+
+    Args:
+        n (int): number of qubits.
+        seed (int): seed of the graph.
+        hardware (bool): whether to use setObjective('hardware').
+        time_budget (float, optional): seconds per batch of the hardware
+            objective. Defaults to 3.
+
+    Returns:
+        Mapping[str, Any]: the result of DPQA.solve with hardware_estimate
+            and hardware_time, and the seconds of solving in 'duration'.
+    """
+    graph = random_regular_graph(3, n, seed=seed)
+    solver = DPQA(f"rand3reg_{n}_{seed}")
+    solver.setArchitecture([16, 16, 16, 16])
+    solver.setProgram([tuple(edge) for edge in graph.edges()])
+    solver.setCommutation()
+    if hardware:
+        solver.setObjective("hardware", time_budget=time_budget)
+    result = solver.solve(save_file=False)
+    if not hardware:
+        # the same estimate, which solve only adds for the hardware objective
+        solver.hardwareEstimate()
+    return result
+
+
+def bench_hardware(
+        sizes: Sequence[int],
+        seeds: Sequence[int],
+        time_budget: float = 3,
+) -> Sequence[Mapping[str, Any]]:
+    """compare the stages and the estimated hardware time of compiling with
+    and without the hardware objective.
+
+    Args:
+        sizes (Sequence[int]): numbers of qubits.
+        seeds (Sequence[int]): seeds of the graphs of each size.
+        time_budget (float, optional): seconds per batch of the hardware
+            objective. Defaults to 3.
+
+    Returns:
+        Sequence[Mapping[str, Any]]: for each graph and objective, n_q, seed,
+            objective, n_t, hardware_time in us, transfers, the summed max
+            distance in um, and the seconds of solving.
+    """
+    stats = []
+    for n in sizes:
+        for seed in seeds:
+            for hardware in (False, True):
+                t_s = time.time()
+                result = compile_rand3reg(n, seed, hardware, time_budget)
+                estimates = result["hardware_estimate"]
+                stats.append({
+                    "n_q": n,
+                    "seed": seed,
+                    "objective": "hardware" if hardware else "stages",
+                    "n_t": result["n_t"],
+                    "hardware_time": result["hardware_time"],
+                    "transfers": sum(e["transfers"] for e in estimates),
+                    "max_distance": sum(e["max_distance"] for e in estimates),
+                    "time": time.time() - t_s,
+                })
+    return stats
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="compile random 3-regular graphs with and without the "
+                    "hardware objective and compare the estimated hardware "
+                    "time.")
+    parser.add_argument("sizes", metavar="N", type=int, nargs="*",
+                        default=[10, 16], help="#qubits. Defaults to 10 16.")
+    parser.add_argument("--seeds", type=int, nargs="*", default=[0, 1, 2])
+    parser.add_argument("--time_budget", type=float, default=3)
+    args = parser.parse_args()
+
+    rows = bench_hardware(args.sizes, args.seeds, args.time_budget)
+    for row in rows:
+        print(f"n_q={row['n_q']} seed={row['seed']} {row['objective']:8} "
+              f"n_t={row['n_t']} hardware_time={row['hardware_time']:.0f}us "
+              f"transfers={row['transfers']} "
+              f"distance={row['max_distance']}um ({row['time']:.1f}s)")
@@ -0,0 +1,546 @@
+from typing import Sequence, Mapping, Any, Union, Iterable, Iterator
+import numpy as np
+import argparse
+import struct
+import tempfile
+import copy
+import json
+import os
+
+# the state of DPQA in the code_full files of CodeGen, see Inst.write_code,
+# is a snapshot of these entities, each a list indexed by the entity id
+ENTITIES = ("qubits", "cols", "rows")
+DELTA_FORMAT = "delta"
+KEYFRAME_INTERVAL = 64  # instructions between two full snapshots
+# last line of the JSON lines code of a streaming CodeGen, which holds the
+# all_slms of Init, only known at the end
+TRAILER = "Trailer"
+
+# binary container: MAGIC, the length of the JSON header as uint64, the
+# header, then the arrays listed in the header, each aligned to ALIGN bytes
+MAGIC = b"DPQACODE"
+BINARY_VERSION = 1
+ALIGN = 64
+# state arrays of the binary container: (entity, key, array name)
+STATE_ARRAYS = (
+    ("qubits", "x", "qubit_x"),
+    ("qubits", "y", "qubit_y"),
+    ("qubits", "c", "qubit_c"),
+    ("qubits", "r", "qubit_r"),
+    ("qubits", "array", "qubit_aod"),
+    ("cols", "active", "col_active"),
+    ("cols", "x", "col_x"),
+    ("rows", "active", "row_active"),
+    ("rows", "y", "row_y"),
+)
+# keys of the col/row shifts of Move, stored in the arrays shift_<key>
+SHIFT_KEYS = ("id", "shift", "begin", "end")
+# instructions writeBinary holds in memory before spilling them, and the
+# bytes it copies at a time from a spilled array to the container
+SPILL_INSTS = 16
+SPILL_BYTES = 1 << 20
+
+
+def stateDelta(
+    prev: Mapping[str, Any], curr: Mapping[str, Any]
+) -> Mapping[str, Any]:
+    """find the changes from one state to the next.
+
+    Args:
+        prev (Mapping[str, Any]): state of the previous instruction.
+        curr (Mapping[str, Any]): state of the current instruction.
+
+    Returns:
+        Mapping[str, Any]: for each entity with changes, a list of
+            [index, {key: new value}] of the changed entries.
+    """
+    delta = {}
+    for entity in ENTITIES:
+        changes = []
+        for i, (p, c) in enumerate(zip(prev[entity], curr[entity])):
+            diff = {k: v for k, v in c.items() if p.get(k) != v}
+            if diff:
+                changes.append([i, diff])
+        if changes:
+            delta[entity] = changes
+    return delta
+
+
+def applyDelta(state: Mapping[str, Any], delta: Mapping[str, Any]):
+    """apply the changes found by stateDelta to state in place.
+
+    Args:
+        state (Mapping[str, Any]): state of the previous instruction.
+        delta (Mapping[str, Any]): changes to the current instruction.
+    """
+    for entity, changes in delta.items():
+        for i, diff in changes:
+            state[entity][i].update(diff)
+
+
+def encodeDelta(
+    code_full: Sequence[Mapping[str, Any]],
+    keyframe_interval: int = KEYFRAME_INTERVAL,
+) -> Mapping[str, Any]:
+    """delta-encode the states of a code_full list: every keyframe_interval
+    instructions keep the full 'state', the others only keep the 'delta'
+    from the state of the instruction before them.
+
+    Args:
+        code_full (Sequence[Mapping[str, Any]]): code from emit_full().
+        keyframe_interval (int, optional): Defaults to KEYFRAME_INTERVAL.
+
+    Returns:
+        Mapping[str, Any]: {'format': 'delta', 'keyframe_interval': ...,
+            'insts': [...]}. The instructions are shallow copies.
+    """
+    return {
+        "format": DELTA_FORMAT,
+        "keyframe_interval": keyframe_interval,
+        "insts": list(encodeDeltaStream(code_full, keyframe_interval)),
+    }
+
+
+def encodeDeltaStream(
+    code_full: Iterable[Mapping[str, Any]],
+    keyframe_interval: int = KEYFRAME_INTERVAL,
+) -> Iterator[Mapping[str, Any]]:
+    """encodeDelta one instruction at a time. Instructions without a state,
+    e.g., the trailer, are passed through.
+
+    Args:
+        code_full (Iterable[Mapping[str, Any]]): code from emit_full().
+        keyframe_interval (int, optional): Defaults to KEYFRAME_INTERVAL.
+
+    Yields:
+        Mapping[str, Any]: the instructions in the 'insts' of encodeDelta.
+    """
+    if keyframe_interval < 1:
+        raise ValueError("keyframe_interval must be at least 1.")
+    prev = None
+    i = 0
+    for inst in code_full:
+        if "state" not in inst:
+            yield inst
+            continue
+        new_inst = {k: v for k, v in inst.items() if k != "state"}
+        if i % keyframe_interval == 0:
+            new_inst["state"] = inst["state"]
+        else:
+            new_inst["delta"] = stateDelta(prev, inst["state"])
+        yield new_inst
+        prev = inst["state"]
+        i += 1
+
+
+def decodeDelta(code: Mapping[str, Any]) -> Sequence[Mapping[str, Any]]:
+    """turn a delta-encoded code back into a code_full list.
+
+    Args:
+        code (Mapping[str, Any]): result of encodeDelta.
+
+    Returns:
+        Sequence[Mapping[str, Any]]: code_full with a 'state' in every
+            instruction.
+    """
+    reader = StateReader(code)
+    code_full = []
+    for i, inst in enumerate(reader.insts):
+        new_inst = {k: v for k, v in inst.items() if k != "delta"}
+        new_inst["state"] = copy.deepcopy(reader.state_at(i))
+        code_full.append(new_inst)
+    return code_full
+
+
+class StateReader:
+    """access the states of a code_full file in either format.
+
+    With the delta format, the state reconstructed last is kept, so reading
+    the instructions in order costs one delta per instruction, and a jump
+    costs at most keyframe_interval deltas from the keyframe before it.
+    """
+
+    def __init__(self, code: Union[Sequence[Mapping[str, Any]], Mapping]):
+        """
+        Args:
+            code (Sequence[Mapping[str, Any]] | Mapping): a code_full list,
+                or the result of encodeDelta, e.g., as loaded from the file.
+        """
+        if isinstance(code, Mapping):
+            if code.get("format") != DELTA_FORMAT:
+                raise ValueError(f"unknown code format {code.get('format')}")
+            self.delta = True
+            self.insts = code["insts"]
+            self.keyframe_interval = code["keyframe_interval"]
+        else:
+            self.delta = False
+            self.insts = code
+        self.curr_i = None
+        self.curr_state = None
+
+    def __len__(self) -> int:
+        return len(self.insts)
+
+    def state_at(self, i: int) -> Mapping[str, Any]:
+        """state of DPQA after instruction i.
+
+        Args:
+            i (int): index of the instruction.
+
+        Returns:
+            Mapping[str, Any]: the state. With the delta format, it is only
+                valid until the next call and must not be modified.
+        """
+        if not self.delta:
+            return self.insts[i]["state"]
+        if i < 0:
+            i += len(self.insts)
+        keyframe = i - i % self.keyframe_interval
+        if self.curr_i is None or not keyframe <= self.curr_i <= i:
+            self.curr_i = keyframe
+            self.curr_state = copy.deepcopy(self.insts[keyframe]["state"])
+        while self.curr_i < i:
+            self.curr_i += 1
+            applyDelta(self.curr_state, self.insts[self.curr_i]["delta"])
+        return self.curr_state
+
+    def to_json(self) -> Sequence[Mapping[str, Any]]:
+        """the code_full list."""
+        if not self.delta:
+            return self.insts
+        return decodeDelta({
+            "format": DELTA_FORMAT,
+            "keyframe_interval": self.keyframe_interval,
+            "insts": self.insts,
+        })
+
+
+class SpillArray:
+    """an array of writeBinary, appended chunk by chunk to a temporary file
+    so that only the current chunk is in memory. Integers are coordinates
+    or indices and stored as int32, flags as uint8.
+    """
+
+    def __init__(self, dtype: str, dir: str):
+        """
+        Args:
+            dtype (str): dtype of the array, e.g., '<i4'.
+            dir (str): directory of the temporary file.
+        """
+        self.dtype = np.dtype(dtype)
+        self.file = tempfile.TemporaryFile(dir=dir)
+        self.shape = [0]
+        self.nbytes = 0
+
+    def append(self, values: Sequence[Any]):
+        # values is a chunk of rows of the array
+        if len(values) == 0:
+            return
+        array = np.asarray(values)
+        if array.size and array.dtype.kind == "f" and self.dtype.kind != "f":
+            raise ValueError(f"non-integer values for dtype {self.dtype}.")
+        array = array.astype(self.dtype)
+        self.file.write(array.tobytes())
+        self.shape = [self.shape[0] + len(array)] + list(array.shape[1:])
+        self.nbytes += array.nbytes
+
+    def copy_to(self, f: Any, add: int = 0):
+        # write the array to f, adding add to every value
+        self.file.seek(0)
+        while True:
+            chunk = self.file.read(SPILL_BYTES)
+            if not chunk:
+                break
+            if add:
+                chunk = (np.frombuffer(chunk, dtype=self.dtype) + add).tobytes()
+            f.write(chunk)
+        self.file.close()
+
+
+def writeBinary(
+    code: Union[Iterable[Mapping[str, Any]], Mapping], file_name: str
+):
+    """write code in the binary container. The instructions are split into
+    arrays: opcode and duration of every instruction, the col/row shifts
+    of every Move, and the state after every instruction; the other keys
+    of an instruction are kept as JSON in the extra array.
+
+    The arrays are spilled to temporary files every SPILL_INSTS
+    instructions and copied after the header at the end, so a generator,
+    e.g., of a streaming CodeGen, is written with bounded memory.
+
+    Args:
+        code (Iterable[Mapping[str, Any]] | Mapping): code_full, possibly
+            a generator ending with the trailer, or the result of
+            encodeDelta.
+        file_name (str): output file, e.g., '*_code_full.dpqa'.
+    """
+    if isinstance(code, Mapping):
+        reader = StateReader(code)
+        code = (dict(inst, state=reader.state_at(i))
+                for i, inst in enumerate(reader.insts))
+    dir = os.path.dirname(os.path.abspath(file_name))
+    # in the order of the container; the extra of the first instruction,
+    # Init, is kept until the trailer, so extra and extra_ptr are spilled
+    # without it, and extra_ptr relative to its end
+    dtypes = {
+        "opcode": "|u1",
+        "duration": "<f8",
+        "shift_ptr": "<i8",
+        "extra_ptr": "<i8",
+        "extra": "|u1",
+    }
+    for key in ("axis",) + SHIFT_KEYS:
+        dtypes["shift_" + key] = "<i4"
+    for _, key, name in STATE_ARRAYS:
+        dtypes[name] = "|u1" if key in ("array", "active") else "<i4"
+    spills = {name: SpillArray(dtype, dir) for name, dtype in dtypes.items()}
+    chunks = {name: [] for name in dtypes}
+
+    def spill():
+        for name, chunk in chunks.items():
+            if name == "extra":
+                chunk = np.frombuffer(b"".join(chunk), dtype=np.uint8)
+            spills[name].append(chunk)
+            chunks[name] = []
+
+    opcodes = []
+    init_extra = None
+    n_inst = 0
+    n_shift = 0
+    n_extra = 0
+    chunks["shift_ptr"].append(0)
+    for inst in code:
+        if inst["type"] == TRAILER:
+            # the rest of Init, which is the first instruction
+            init = json.loads(init_extra)
+            init.update({k: v for k, v in inst.items() if k != "type"})
+            init_extra = json.dumps(init).encode()
+            continue
+        if inst["type"] not in opcodes:
+            opcodes.append(inst["type"])
+        chunks["opcode"].append(opcodes.index(inst["type"]))
+        chunks["duration"].append(inst.get("duration", np.nan))
+        others = {}
+        for k, v in inst.items():
+            if k in ("type", "duration", "state", "delta"):
+                continue
+            if inst["type"] == "Move" and k in ("cols", "rows"):
+                for entry in v:
+                    chunks["shift_axis"].append(0 if k == "cols" else 1)
+                    for key in SHIFT_KEYS:
+                        chunks["shift_" + key].append(entry[key])
+                n_shift += len(v)
+            else:
+                others[k] = v
+        chunks["shift_ptr"].append(n_shift)
+        if n_inst:
+            extra = json.dumps(others).encode()
+            chunks["extra"].append(extra)
+            n_extra += len(extra)
+            chunks["extra_ptr"].append(n_extra)
+        else:
+            init_extra = json.dumps(others).encode()
+
+        state = inst["state"]
+        for entity, key, name in STATE_ARRAYS:
+            if key == "array":
+                chunks[name].append([q[key] == "AOD" for q in state[entity]])
+            else:
+                chunks[name].append([e[key] for e in state[entity]])
+        n_inst += 1
+        if n_inst % SPILL_INSTS == 0:
+            spill()
+    spill()
+
+    header = {
+        "version": BINARY_VERSION,
+        "n_inst": n_inst,
+        "opcodes": opcodes,
+        "arrays": {},
+    }
+    offset = 0
+    for name, array in spills.items():
+        shape, nbytes = array.shape, array.nbytes
+        if name == "extra_ptr":
+            shape, nbytes = [n_inst + 1], (n_inst + 1) * array.dtype.itemsize
+        if name == "extra":
+            shape, nbytes = [len(init_extra) + n_extra], len(init_extra) + n_extra
+        header["arrays"][name] = {
+            "dtype": array.dtype.str,
+            "shape": shape,
+            "offset": offset,
+        }
+        offset += -(-nbytes // ALIGN) * ALIGN
+    header_bytes = json.dumps(header).encode()
+    data_start = -(-(len(MAGIC) + 8 + len(header_bytes)) // ALIGN) * ALIGN
+
+    with open(file_name, "wb") as f:
+        f.write(MAGIC)
+        f.write(struct.pack("<Q", len(header_bytes)))
+        f.write(header_bytes)
+        for name, array in spills.items():
+            f.seek(data_start + header["arrays"][name]["offset"])
+            if name == "extra_ptr":
+                f.write(np.asarray([0, len(init_extra)], dtype="<i8").tobytes())
+                array.copy_to(f, len(init_extra))
+            elif name == "extra":
+                f.write(init_extra)
+                array.copy_to(f)
+            else:
+                array.copy_to(f)
+        f.truncate(data_start + offset)
+
+
+class BinaryCode:
+    """code in the binary container, with the same insts and state_at as
+    StateReader. The arrays are memory-mapped, so only the instructions
+    are decoded on loading; a state is decoded when it is asked for.
+    """
+
+    def __init__(self, file_name: str):
+        """
+        Args:
+            file_name (str): file written by writeBinary.
+        """
+        with open(file_name, "rb") as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f"{file_name} is not a binary code file.")
+            header_length = struct.unpack("<Q", f.read(8))[0]
+            self.header = json.loads(f.read(header_length))
+        if self.header["version"] > BINARY_VERSION:
+            raise ValueError(
+                f"binary code version {self.header['version']} is newer "
+                f"than the supported version {BINARY_VERSION}.")
+        data_start = -(-(len(MAGIC) + 8 + header_length) // ALIGN) * ALIGN
+        self.arrays = {}
+        for name, info in self.header["arrays"].items():
+            if 0 in info["shape"]:
+                self.arrays[name] = np.zeros(info["shape"], info["dtype"])
+            else:
+                self.arrays[name] = np.memmap(
+                    file_name, dtype=info["dtype"], mode="r",
+                    offset=data_start + info["offset"],
+                    shape=tuple(info["shape"]))
+        self.delta = False
+        self.insts = [self.inst(i) for i in range(self.header["n_inst"])]
+
+    def __len__(self) -> int:
+        return self.header["n_inst"]
+
+    def inst(self, i: int) -> Mapping[str, Any]:
+        """instruction i without its state."""
+        arrays = self.arrays
+        extra = arrays["extra"][
+            arrays["extra_ptr"][i]:arrays["extra_ptr"][i + 1]]
+        inst = {"type": self.header["opcodes"][arrays["opcode"][i]]}
+        inst.update(json.loads(extra.tobytes()))
+        if inst["type"] == "Move":
+            inst["cols"] = []
+            inst["rows"] = []
+            for j in range(arrays["shift_ptr"][i], arrays["shift_ptr"][i + 1]):
+                entry = {key: arrays["shift_" + key][j].item()
+                         for key in SHIFT_KEYS}
+                if arrays["shift_axis"][j] == 0:
+                    inst["cols"].append(entry)
+                else:
+                    inst["rows"].append(entry)
+        if not np.isnan(arrays["duration"][i]):
+            duration = arrays["duration"][i].item()
+            inst["duration"] = int(duration) if duration.is_integer()\
+                else duration
+        return inst
+
+    def state_at(self, i: int) -> Mapping[str, Any]:
+        """state of DPQA after instruction i, see StateReader.state_at."""
+        state = {}
+        for entity in ENTITIES:
+            values = {key: self.arrays[name][i].tolist()
+                      for e, key, name in STATE_ARRAYS if e == entity}
+            if entity == "qubits":
+                values["array"] = ["AOD" if aod else "SLM"
+                                   for aod in values["array"]]
+            if entity != "qubits":
+                values["active"] = [bool(a) for a in values["active"]]
+            keys = list(values.keys())
+            state[entity] = [
+                dict([("id", j)] + [(k, values[k][j]) for k in keys])
+                for j in range(len(values[keys[0]]))
+            ]
+        return state
+
+    def to_json(self) -> Sequence[Mapping[str, Any]]:
+        """the code_full list."""
+        code_full = []
+        for i, inst in enumerate(self.insts):
+            code_full.append(dict(inst, state=self.state_at(i)))
+        return code_full
+
+
+def readJsonLines(file_name: str) -> Union[Sequence[Mapping], Mapping]:
+    """load the JSON lines code of a streaming CodeGen: an optional first
+    line with the delta format, the instructions, and the trailer.
+
+    Args:
+        file_name (str): '*_code_full.jsonl'.
+
+    Returns:
+        Sequence[Mapping] | Mapping: the same as the JSON code_full.
+    """
+    header = None
+    insts = []
+    with open(file_name, "r") as f:
+        for line in f:
+            inst = json.loads(line)
+            if "format" in inst and not insts and header is None:
+                header = inst
+            elif inst["type"] == TRAILER:
+                insts[0].update(
+                    {k: v for k, v in inst.items() if k != "type"})
+            else:
+                insts.append(inst)
+    if header:
+        return dict(header, insts=insts)
+    return insts
+
+
+def readCode(file_name: str) -> Union[StateReader, BinaryCode]:
+    """load a code_full file of any format: JSON or JSON lines with full or
+    delta-encoded states, or the binary container."""
+    with open(file_name, "rb") as f:
+        binary = f.read(len(MAGIC)) == MAGIC
+    if binary:
+        return BinaryCode(file_name)
+    if file_name.endswith(".jsonl"):
+        return StateReader(readJsonLines(file_name))
+    with open(file_name, "r") as f:
+        return StateReader(json.load(f))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="convert code_full files between the formats: JSON with "
+        "full or delta-encoded states, and the binary container, which is "
+        "used if the output file ends with .dpqa."
+    )
+    parser.add_argument("input_file", type=str)
+    parser.add_argument("output_file", type=str)
+    parser.add_argument(
+        "--keyframe",
+        help="instructions between full snapshots",
+        type=int,
+        default=KEYFRAME_INTERVAL,
+    )
+    parser.add_argument(
+        "--full", help="write JSON with full states", action="store_true"
+    )
+    args = parser.parse_args()
+
+    code = readCode(args.input_file).to_json()
+    if args.output_file.endswith(".dpqa"):
+        writeBinary(code, args.output_file)
+    else:
+        if not args.full:
+            code = encodeDelta(code, args.keyframe)
+        with open(args.output_file, "w") as f:
+            json.dump(code, f)
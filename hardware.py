@@ -0,0 +1,18 @@
+# physics constants
+R_B = 6  # rydberg range
+AOD_SEP = 4  # min AOD separation
+RYD_SEP = 15  # sufficient distance to avoid Rydberg
+SITE_SLMS = 2  # number of SLMs in a site
+SLM_SEP = AOD_SEP  # separation of SLMs inside a site
+SITE_WIDTH = 4  # total width of SLMs in a site
+X_SITE_SEP = RYD_SEP + SITE_WIDTH  # separation of sites in X direction
+Y_SITE_SEP = RYD_SEP  # separation of sites in Y direction
+
+# durations
+T_RYDBERG = 0.15  # microseconds for Rydberg
+T_ACTIVATE = 50  # microseconds for (de)activating AOD
+
+
+def move_duration(distance: float) -> float:
+    # movement time per Bluvstein et al. units are us and um.
+    return 200 * ((distance / 110) ** (1 / 2))
@@ -0,0 +1,162 @@
+from typing import Mapping, Sequence, Any, Union, Tuple
+from animation import MachineState, Inst
+from codeformat import readCode, TRAILER
+from verifier import instStage, checkState, buildInst
+import argparse
+import json
+
+# instructions that the pass fuses when they are consecutive
+FUSABLE = ("Move", "Activate", "Deactivate")
+
+
+def fusedCode(
+    a: Mapping[str, Any], b: Mapping[str, Any]
+) -> Union[Mapping[str, Any], None]:
+    """the instruction doing a and b at once, without the state, if they are
+    of the same fusable type in the same stage and on disjoint cols and rows.
+
+    Args:
+        a (Mapping[str, Any]): an instruction in code_full.
+        b (Mapping[str, Any]): the instruction right after a.
+
+    Returns:
+        Union[Mapping[str, Any], None]: the fused instruction, named after
+            both, e.g., Reload_1:ReloadRow_0:Parking+Reload_1:ReloadRow_1:
+            ColShift:Move, or None if a and b cannot be fused.
+    """
+    if a["type"] != b["type"] or a["type"] not in FUSABLE:
+        return None
+    if instStage(a) != instStage(b):
+        return None
+    name = a["name"].rpartition(":")[0] + "+" + b["name"]
+    if a["type"] == "Move":
+        cols = [col["id"] for col in a["cols"]] + [col["id"] for col in b["cols"]]
+        rows = [row["id"] for row in a["rows"]] + [row["id"] for row in b["rows"]]
+    else:
+        cols = a["col_idx"] + b["col_idx"]
+        rows = a["row_idx"] + b["row_idx"]
+    if len(set(cols)) != len(cols) or len(set(rows)) != len(rows):
+        return None
+    if a["type"] == "Move":
+        return {
+            "type": "Move",
+            "name": name,
+            "cols": a["cols"] + b["cols"],
+            "rows": a["rows"] + b["rows"],
+        }
+    qs = "pickup_qs" if a["type"] == "Activate" else "dropoff_qs"
+    fused = {"type": a["type"], "name": name}
+    for key in ["col_idx", "col_xs", "row_idx", "row_ys", qs]:
+        fused[key] = a[key] + b[key]
+    return fused
+
+
+def fuseInsts(
+    a: Mapping[str, Any], b: Mapping[str, Any], prev: Mapping[str, Any]
+) -> Union[Inst, None]:
+    """fuse two consecutive instructions if the fused instruction passes the
+    verification of CodeGen from the state before a, e.g., the separation
+    of AOD cols and rows in Move.verify, and ends in the state after b.
+
+    Args:
+        a (Mapping[str, Any]): an instruction in code_full.
+        b (Mapping[str, Any]): the instruction right after a.
+        prev (Mapping[str, Any]): state before a.
+
+    Returns:
+        Union[Inst, None]: the fused instruction, or None.
+    """
+    fused = fusedCode(a, b)
+    if fused is None:
+        return None
+    state = MachineState.from_snapshot(prev)
+    state.q_c[:] = [q["c"] for q in b["state"]["qubits"]]
+    state.q_r[:] = [q["r"] for q in b["state"]["qubits"]]
+    try:
+        inst = buildInst(fused, state)
+    except ValueError:
+        return None
+    if checkState(state) or inst.code["state"] != b["state"]:
+        return None
+    return inst
+
+
+def peephole(
+    code_full: Sequence[Mapping[str, Any]],
+    code: Union[Sequence[Mapping[str, Any]], None] = None,
+    prev: Union[Mapping[str, Any], None] = None,
+) -> Tuple[Sequence[Mapping[str, Any]], Sequence[Mapping[str, Any]], float]:
+    """fuse consecutive Moves on disjoint cols and rows into one Move that
+    takes the longest of their durations, and consecutive Activates (or
+    Deactivates) into one batch taking a single T_ACTIVATE. Fusing is
+    greedy: an instruction joins the previous one, fused or not, whenever
+    fuseInsts accepts it.
+
+    Args:
+        code_full (Sequence[Mapping[str, Any]]): the full code with the
+            states, e.g., emit_full() of CodeGen.builder.
+        code (Sequence[Mapping[str, Any]] | None, optional): the reduced
+            code of the same instructions. If None, it is rebuilt from
+            code_full. Defaults to None.
+        prev (Mapping[str, Any] | None, optional): state before the first
+            instruction if it is not Init. Defaults to None.
+
+    Returns:
+        Tuple[Sequence[Mapping[str, Any]], Sequence[Mapping[str, Any]], float]:
+            the full code, the reduced code, and the microseconds saved.
+    """
+    out_full = []
+    out_code = []
+    saved = 0
+    # states before and after the last instruction in out_full
+    before = None
+    for i, inst in enumerate(code_full):
+        if inst["type"] == TRAILER:
+            out_full.append(inst)
+            continue
+        fused = fuseInsts(out_full[-1], inst, before) if out_full else None
+        if fused:
+            saved += out_full[-1]["duration"] + inst["duration"] - fused.duration
+            out_full[-1] = fused.emit_full()[0]
+            out_code[-1] = fused.emit()[0]
+            prev = inst["state"]
+            continue
+        before = prev
+        prev = inst["state"]
+        out_full.append(inst)
+        if code is not None:
+            out_code.append(code[i])
+        elif inst["type"] == "Init":
+            state = MachineState(inst["n_q"], inst["c_high"], inst["r_high"])
+            out_code += buildInst(inst, state).emit()
+        else:
+            state = MachineState.from_snapshot(before)
+            state.q_c[:] = [q["c"] for q in inst["state"]["qubits"]]
+            state.q_r[:] = [q["r"] for q in inst["state"]["qubits"]]
+            out_code += buildInst(inst, state).emit()
+    return out_full, out_code, saved
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="fuse consecutive Moves on disjoint cols and rows, and "
+        "consecutive Activates (Deactivates), in a code_full file of any "
+        "format. Writes the fused code_full and code in JSON."
+    )
+    parser.add_argument("input_file", type=str)
+    parser.add_argument(
+        "output_file", type=str, help="the fused code_full, ending in _code_full.json"
+    )
+    args = parser.parse_args()
+    # the fused code goes next to it, as CodeGen.write_files names them
+    if not args.output_file.endswith("_code_full.json"):
+        parser.error("output_file must end in _code_full.json")
+    code_file = args.output_file[: -len("_code_full.json")] + "_code.json"
+
+    code_full = readCode(args.input_file).to_json()
+    fused_full, fused, saved = peephole(code_full)
+    with open(args.output_file, "w") as f:
+        json.dump(fused_full, f)
+    with open(code_file, "w") as f:
+        json.dump(fused, f)
+    print(f"{len(code_full)} -> {len(fused_full)} instructions, {saved:.2f}us saved.")
@@ -1,6 +1,7 @@
-from solve import DPQA
+from solve import DPQA, RELABEL_METHODS
 import argparse
 import json
+import os
 
 with open('./graphs.json', 'r') as f:
     graphs = json.load(f)
@@ -12,6 +13,26 @@ parser.add_argument('--suffix', type=str,
                     help='suffix to the file name.')
 parser.add_argument('--dir', help='output directory', type=str)
 parser.add_argument('--print_detail', action='store_true')
+parser.add_argument('--relabel', choices=RELABEL_METHODS,
+                    help='relabel the qubits before encoding.')
+parser.add_argument('--incremental', action='store_true',
+                    help='reuse the previous result in the output directory.')
+parser.add_argument('--hardware', action='store_true',
+                    help='also minimize the estimated hardware time.')
+parser.add_argument('--time_budget', type=float, default=10,
+                    help='seconds per window for --hardware.')
+parser.add_argument('--window', type=int, default=2,
+                    help='layers re-solved together for --hardware.')
+parser.add_argument('--budget', type=float,
+                    help='seconds for the whole solving; when to switch to '
+                         'optimal solving is then decided online.')
+parser.add_argument('--cube_workers', type=int, default=0,
+                    help='solve the last batch by cube-and-conquer over '
+                         'this many processes.')
+parser.add_argument('--aggregate', action='store_true',
+                    help='solve duplicate gates on a pair as one gate.')
+parser.add_argument('--templates', type=str,
+                    help='directory of the cached architecture constraints.')
 args = parser.parse_args()
 
 filename = 'rand3reg_' + str(args.size) + '_' + str(args.id)
@@ -24,9 +45,22 @@ tmp = DPQA(
 )
 tmp.setArchitecture([16, 16, 16, 16])
 if str(args.size) in graphs.keys() and args.id in range(10):
-    tmp.setProgram(graphs[str(args.size)][args.id])
+    tmp.setProgram(graphs[str(args.size)][args.id], relabel=args.relabel)
 else:
     raise ValueError(f'No such graph {args.size}_{args.id}.')
 tmp.setCommutation()
+if args.aggregate:
+    tmp.setAggregation()
+if args.templates:
+    tmp.setTemplateStore(args.templates)
+if args.budget:
+    tmp.setTimeBudget(args.budget)
+if args.incremental and os.path.exists(tmp.dir + filename + '.json'):
+    tmp.setIncremental(tmp.dir + filename + '.json')
+if args.cube_workers:
+    tmp.setCubeAndConquer(args.cube_workers)
+if args.hardware:
+    tmp.setObjective('hardware', time_budget=args.time_budget,
+                     window=args.window)
 tmp.hybrid_strategy()
 tmp.solve(save_file=True)
@@ -1,12 +1,41 @@
-from typing import Mapping, Sequence, Any
+from typing import Mapping, Sequence, Any, Union, Iterable
 from z3 import Int, Bool, sat, And, Implies, Solver, Not, Or, is_true, Then
-from networkx import max_weight_matching, Graph
+from z3 import Context, is_bool, unsat, Sum, If, IntVal
+from networkx import max_weight_matching, Graph, spectral_ordering
+from networkx.utils import reverse_cuthill_mckee_ordering
 from itertools import product
+from multiprocessing.connection import wait
+from collections import deque
+from hardware import X_SITE_SEP, Y_SITE_SEP, T_ACTIVATE, move_duration
 import time
 import json
-
-
+import multiprocessing
+import copy
+import os
+import tempfile
+import re
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+try:
+    import scipy  # needed by spectral_ordering
+except ImportError:  # not in requirements.txt, relabel='spectral' is off
+    scipy = None
+
+
+# methods of relabelQubits available with the installed packages
+RELABEL_METHODS = ("rcm", "spectral") if scipy else ("rcm",)
+# bump when the constraints of solver_init change, to ignore old templates
+TEMPLATE_VERSION = 1
 PYSAT_ENCODING = 2  # default choice: sequential counter
+# entries of a z3 model in SMT-LIB, e.g., '(define-fun x_q0_t1 () Int\n  3)'
+MODEL_ENTRY = re.compile(
+    r"\(define-fun (\S+) \(\) (?:Int|Bool)\s+(true|false|\d+|\(- \d+\))\)")
+# names of the variables in solver_init and constraint_gate_batch
+MODEL_VAR = re.compile(r"([acrxy])_q(\d+)_t(\d+)|t_g(\d+)")
 
 
 def collisionExtract(
@@ -66,6 +95,99 @@ def maxDegree(list_gate_qubits: Sequence[Sequence[int]],
     return max(cnt)
 
 
+def aggregateGates(list_gate_qubits: Sequence[Sequence[int]],
+                   count_program_qubit: int,
+                   all_commutable: bool) -> Sequence[Sequence[int]]:
+    """group the duplicate gates that can execute as one gate. If the gates
+    commute, all the gates on the same pair of qubits are duplicates. If
+    not, a gate is a duplicate of the previous gate on its qubits if that
+    gate is on the same pair, i.e., no other gate acts on the two qubits in
+    between.
+
+    Args:
+        list_gate_qubits (Sequence[Sequence[int]]):
+        count_program_qubit (int):  the number of logical/program qubit
+        all_commutable (bool): whether the gates commute
+
+    Returns:
+        Sequence[Sequence[int]]: groups of gate indices in the order of
+            their first gate, which represents the group
+    """
+
+    groups = []
+    group_of_pair = {}
+    # list_last_group records the latest group that acts on each qubit
+    list_last_group = [-1 for _ in range(count_program_qubit)]
+    for i, qubits in enumerate(list_gate_qubits):
+        pair = tuple(qubits)
+        if all_commutable:
+            if pair in group_of_pair:
+                groups[group_of_pair[pair]].append(i)
+                continue
+            group_of_pair[pair] = len(groups)
+        else:
+            j = list_last_group[qubits[0]]
+            if len(qubits) == 2 and j >= 0 and\
+                    j == list_last_group[qubits[1]] and\
+                    tuple(list_gate_qubits[groups[j][0]]) == pair:
+                groups[j].append(i)
+                continue
+            for q in qubits:
+                list_last_group[q] = len(groups)
+        groups.append([i])
+    return groups
+
+
+def maxGatesPerStage(list_gate_qubits: Sequence[Sequence[int]],
+                     count_site: int) -> int:
+    """calculate the max number of gates that can execute in one stage.
+    In a stage, a qubit is in at most one gate and a site holds at most one
+    gate, so the gates of a stage form a matching of the interaction graph
+    with at most count_site edges.
+
+    Args:
+        list_gate_qubits (Sequence[Sequence[int]]):
+        count_site (int): the number of sites, i.e., #X * #Y
+
+    Returns:
+        int: min(size of a maximum matching, count_site)
+    """
+
+    G = Graph()
+    G.add_edges_from(list_gate_qubits)
+    return min(len(max_weight_matching(G)), count_site)
+
+
+def stageLowerBound(list_gate_qubits: Sequence[Sequence[int]],
+                    count_program_qubit: int,
+                    count_site: int,
+                    all_commutable: bool) -> int:
+    """calculate a lower bound of the number of stages to execute the gates.
+    The bound is the larger of the max degree (commutable) or the depth
+    (ordered), and #gates divided by the max number of gates per stage. The
+    latter is tighter, e.g., for regular graphs with an odd number of
+    qubits, which need max degree + 1 stages, and when sites are scarce.
+
+    Args:
+        list_gate_qubits (Sequence[Sequence[int]]):
+        count_program_qubit (int):  the number of logical/program qubit
+        count_site (int): the number of sites, i.e., #X * #Y
+        all_commutable (bool): whether the gates commute
+
+    Returns:
+        int: a lower bound of the number of stages
+    """
+
+    if len(list_gate_qubits) == 0:
+        return 0
+    if all_commutable:
+        bound = maxDegree(list_gate_qubits, count_program_qubit)
+    else:
+        bound = pushLeftDepth(list_gate_qubits, count_program_qubit)
+    per_stage = maxGatesPerStage(list_gate_qubits, count_site)
+    return max(bound, -(-len(list_gate_qubits) // per_stage))
+
+
 def dependencyExtract(list_gate_qubits: Sequence[Sequence[int]],
                       count_program_qubit: int) -> Sequence[Sequence[int]]:
     """Extract dependency relations between the gates.
@@ -125,6 +247,123 @@ def pushLeftDepth(list_gate_qubits: Sequence[Sequence[int]],
     return max(push_forward_depth)
 
 
+def splitJobs(result_json: Mapping[str, Any]) -> Sequence[Mapping]:
+    """split a solution of DPQA.setPrograms into one solution per job. The
+    qubits and gates of a job get back their ids in the job. The positions
+    stay those on the shared array, and every stage of the joint solution
+    is kept, also those without gates of the job, to keep the moves valid.
+
+    Args:
+        result_json (Mapping[str, Any]): result of solve() with 'jobs'.
+
+    Returns:
+        Sequence[Mapping[str, Any]]: a result_json for every job.
+    """
+
+    results = []
+    for j, job in enumerate(result_json['jobs']):
+        qubit_id = {q: i for i, q in enumerate(job['qubits'])}
+        gate_id = {g: i for i, g in enumerate(job['gates'])}
+        result = {k: v for k, v in result_json.items()
+                  if k not in ('layers', 'jobs', 'g_q', 'g_s', 'lower_bound',
+                               'optimal')}
+        result['name'] = f"{result_json['name']}_job{j}"
+        result['n_q'] = len(job['qubits'])
+        result['n_g'] = len(job['gates'])
+        result['g_q'] = [[qubit_id[q] for q in result_json['g_q'][g]]
+                         for g in job['gates']]
+        result['g_s'] = [result_json['g_s'][g] for g in job['gates']]
+        result['layers'] = []
+        for layer in result_json['layers']:
+            qubits = []
+            for q in job['qubits']:
+                qubit = dict(layer['qubits'][q])
+                qubit['id'] = qubit_id[q]
+                qubits.append(qubit)
+            gates = []
+            for gate in layer['gates']:
+                if gate['id'] in gate_id:
+                    gates.append({'id': gate_id[gate['id']],
+                                  'q0': qubit_id[gate['q0']],
+                                  'q1': qubit_id[gate['q1']]})
+            result['layers'].append({'qubits': qubits, 'gates': gates})
+        results.append(result)
+    return results
+
+
+def readStreamResult(file_name: str) -> Mapping[str, Any]:
+    """load the result of DPQA.solve_stream with all its layers, i.e., in the
+    same format as the result of DPQA.solve except for g_q and g_s.
+
+    Args:
+        file_name (str): the result json, which names its layers file
+
+    Returns:
+        Mapping[str, Any]: result_json with 'layers'
+    """
+
+    with open(file_name, 'r') as f:
+        result_json = json.load(f)
+    result_json['layers'] = []
+    with open(result_json['layers_file'], 'r') as f:
+        for line in f:
+            result_json['layers'].append(json.loads(line))
+    return result_json
+
+
+def modelValue(value: str) -> int:
+    """convert a value in MODEL_ENTRY to int, true is 1 and false is 0."""
+    if value == 'true':
+        return 1
+    if value == 'false':
+        return 0
+    if value.startswith('(-'):
+        return -int(value[3:-1])
+    return int(value)
+
+
+def cubeWorker(conn: Any, smt2: str):
+    """solve cubes in a worker process of cube-and-conquer. The encoding is
+    parsed once from SMT-LIB, then every cube received through conn is
+    checked as assumptions on this warm copy. For each cube, sends back
+    ('sat' | 'unsat' | 'unknown', values of the variables if sat).
+
+    Args:
+        conn (Any): duplex end of a pipe. Receives (cube, timeout) where cube
+            is a list of (variable name, value), or None to stop.
+        smt2 (str): the assertions of the solver, i.e., Solver.sexpr().
+    """
+
+    ctx = Context()
+    solver = Solver(ctx=ctx)
+    solver.from_string(smt2)
+    while True:
+        msg = conn.recv()
+        if msg is None:
+            break
+        cube, timeout = msg
+        literals = []
+        for name, value in cube:
+            if name.startswith('a_'):
+                var = Bool(name, ctx=ctx)
+                literals.append(var if value else Not(var))
+            else:
+                literals.append(Int(name, ctx=ctx) == value)
+        solver.set(timeout=int(timeout * 1000) if timeout else 4294967295)
+        result = solver.check(*literals)
+        if result == sat:
+            values = {}
+            for name, value in MODEL_ENTRY.findall(solver.model().sexpr()):
+                if MODEL_VAR.fullmatch(name):
+                    values[name] = modelValue(value)
+            conn.send(('sat', values))
+        elif result == unsat:
+            conn.send(('unsat', None))
+        else:
+            conn.send(('unknown', None))
+    conn.close()
+
+
 class DPQA:
     """class to encode the compilation problem to SMT and solves using Z3."""
 
@@ -142,21 +381,58 @@ class DPQA:
         self.result_json['layers'] = []
         self.row_per_site = 3
         self.cardenc = "pysat"
-        self.optimal_ratio = 0
+        self.optimal_ratio = None
+        self.solve_budget = None
+        self.deadline = None
+        self.optimal_deadline = None
+        self.batch_costs = []
         self.non_front_g_q = []
         self.non_front_g_s = []
         self.non_front_g_i = []
+        # every instance owns its z3 context so that several DPQA objects can
+        # encode and solve in different threads of the same process
+        self.ctx = Context()
+        self.memory_limit = None
+        self.rss_at_restart = 0
+        self.lazy_exactness = False
+        self.objective = "stages"
+        self.objective_weights = None
+        self.objective_window = 2
+        self.time_budget = 10
+        self.cube_workers = 0
+        self.previous = None
+        self.jobs = None
+        self.aggregate = False
+        self.duplicates = {}
+        self.flushed_layers = 0
+        self.template_dir = None
+        self.templates = {}
 
     def setOptimalRatio(self, ratio: float):
         self.optimal_ratio = ratio
 
+    def setTimeBudget(self, seconds: float, optimal_cost: float = 4):
+        # total seconds for solve(). Unless the optimal ratio is set, the
+        # switch from greedy to optimal solving is then decided online from
+        # the measured cost of the greedy batches, see switch_to_optimal.
+        # optimal_cost is the factor of the optimal solving time per stage.
+        self.solve_budget = seconds
+        self.optimal_cost = optimal_cost
+
     def setArchitecture(self, bounds: Sequence[int]):
         # bounds = [number of X, number of Y, number of C, number of R]
         self.n_x, self.n_y, self.n_c, self.n_r = bounds
 
-    def setProgram(self, program: Sequence[Sequence[int]], nqubit: int = None):
+    def setProgram(
+            self,
+            program: Sequence[Sequence[int]],
+            nqubit: int = None,
+            relabel: str = None,
+    ):
         # assume program is a iterable of pairs of qubits in 2Q gate
         # assume that the qubit indices used are consecutively 0, 1, ...
+        # relabel: None or one of RELABEL_METHODS, see relabelQubits; 'spectral'
+        # needs scipy
         self.n_g = len(program)
         self.g_i = [i for i in range(self.n_g)]
         tmp = [(min(pair), max(pair)) for pair in program]
@@ -169,25 +445,280 @@ class DPQA:
             self.n_q += 1
         else:
             self.n_q = nqubit
+        self.program_g_q = self.g_q
+        self.relabel_method = relabel
+        self.old_label = None
+        if relabel:
+            self.relabelQubits(relabel)
         self.dependencies = dependencyExtract(self.g_q, self.n_q)
         self.n_t = pushLeftDepth(self.g_q, self.n_q)
         self.collisions = collisionExtract(self.g_q)
 
         self.updateGateIndexMatrix()
 
+    def setPrograms(
+            self,
+            programs: Sequence[Sequence[Sequence[int]]],
+            nqubits: Sequence[int] = None,
+            relabel: str = None,
+    ):
+        # compile several independent programs jointly on one array. Job j
+        # gets the qubits from the sum of the #qubits of the jobs before it,
+        # and its gates follow those of the jobs before it. The jobs share
+        # no qubit, so the solver freely puts gates of different jobs in the
+        # same Rydberg stage. result_json['jobs'] maps the qubits and gates
+        # of each job, see splitJobs.
+        program = []
+        self.jobs = []
+        q_offset = 0
+        for j, job in enumerate(programs):
+            if nqubits:
+                n_q = nqubits[j]
+            else:
+                n_q = max([max(gate) for gate in job], default=-1) + 1
+            self.jobs.append({
+                'qubits': list(range(q_offset, q_offset + n_q)),
+                'gates': list(range(len(program), len(program) + len(job))),
+            })
+            program += [[q + q_offset for q in gate] for gate in job]
+            q_offset += n_q
+        self.setProgram(program, nqubit=q_offset, relabel=relabel)
+
+    def setIncremental(self, previous: Union[str, Mapping[str, Any]]):
+        # reuse the solution of a previous version of the program, given as
+        # result_json or as the path to its file, see reuse_layers
+        if isinstance(previous, str):
+            with open(previous, 'r') as f:
+                previous = json.load(f)
+        self.previous = previous
+
+    def reuse_layers(self):
+        # take over the layers of the previous solution before the first
+        # layer with a gate at or after the first gate that differs from the
+        # previous program (if all_commutable, before the first layer with a
+        # gate not in the program), and remove their gates from g_q.
+        # solve_greedy then continues from the positions of the last reused
+        # layer, the same as after a committed batch.
+        prev = self.previous
+        for key in ('n_q', 'n_x', 'n_y', 'n_c', 'n_r', 'row_per_site',
+                    'all_commutable', 'all_aod', 'no_transfer'):
+            if prev.get(key) != self.result_json[key]:
+                print(f"previous solution has a different {key}, "
+                      f"compiling from scratch")
+                return
+        prev_g_q = [tuple(gate) for gate in prev['g_q']]
+        first_diff = 0
+        while first_diff < min(len(prev_g_q), len(self.program_g_q)) and\
+                prev_g_q[first_diff] == tuple(self.program_g_q[first_diff]):
+            first_diff += 1
+
+        # previous layers are in the labels of the program, see restoreLabels
+        layers = []
+        gates_done = []
+        if self.all_commutable:
+            # the order of the gates does not matter, so a layer can be
+            # reused while the new program still has all its gates. They are
+            # matched by qubit pair and get their ids in the new program.
+            new_ids = {}
+            for i, gate in enumerate(self.program_g_q):
+                new_ids.setdefault(tuple(gate), []).append(i)
+            for layer in prev['layers']:
+                pairs = [(g['q0'], g['q1']) for g in layer['gates']]
+                if any(pairs.count(p) > len(new_ids.get(p, []))
+                       for p in pairs):
+                    break
+                layer = copy.deepcopy(layer)
+                for g in layer['gates']:
+                    g['id'] = new_ids[(g['q0'], g['q1'])].pop(0)
+                    gates_done.append(g['id'])
+                layers.append(layer)
+        else:
+            for layer in prev['layers']:
+                gate_ids = [g['id'] for g in layer['gates']]
+                if any(i >= first_diff for i in gate_ids):
+                    break
+                layers.append(copy.deepcopy(layer))
+                gates_done += gate_ids
+        num_layer = len(layers)
+
+        if self.old_label:
+            new_label = {old: new for new, old in enumerate(self.old_label)}
+            for layer in layers:
+                qubits = [None for _ in range(self.n_q)]
+                for q in layer['qubits']:
+                    q['id'] = new_label[q['id']]
+                    qubits[q['id']] = q
+                layer['qubits'] = qubits
+                for g in layer['gates']:
+                    q0, q1 = new_label[g['q0']], new_label[g['q1']]
+                    g['q0'], g['q1'] = min(q0, q1), max(q0, q1)
+
+        print(f"reusing {num_layer} layers with {len(gates_done)} gates, "
+              f"first changed gate {first_diff}")
+        self.result_json['layers'] = layers
+        self.result_json['incremental'] = {
+            'first_changed_gate': first_diff,
+            'reused_layers': num_layer,
+            'reused_gates': len(gates_done),
+        }
+        # gates are not reordered yet, so the gate ids are the indices
+        self.remove_gates(gates_done)
+
+    def relabelQubits(self, method: str):
+        # renumber the qubits so that interacting qubits get close indices,
+        # i.e., a small bandwidth of the interaction graph. The pairwise and
+        # c/r ordering constraints then propagate better. The solving is in
+        # the new labels; restoreLabels maps the result back. Gate ids
+        # (g_i) keep their order, so only the qubit ids change.
+        G = Graph()
+        G.add_nodes_from(range(self.n_q))
+        G.add_edges_from(self.g_q)
+        if method == "rcm":
+            order = list(reverse_cuthill_mckee_ordering(G))
+        elif method == "spectral":
+            # Fiedler vector ordering
+            if scipy is None:
+                raise ValueError("relabeling method spectral needs scipy")
+            order = spectral_ordering(G)
+        else:
+            raise ValueError(f"relabeling method {method} unknown")
+        new_label = {old: new for new, old in enumerate(order)}
+        self.old_label = order
+        self.g_q = tuple(
+            (min(new_label[q0], new_label[q1]),
+             max(new_label[q0], new_label[q1]))
+            for (q0, q1) in self.g_q)
+
+    def restoreLabels(self):
+        # map qubit ids in result_json back to the labels of the program
+        if not self.old_label:
+            return
+        old = self.old_label
+        for layer in self.result_json['layers']:
+            qubits = [None for _ in range(self.n_q)]
+            for q in layer['qubits']:
+                q['id'] = old[q['id']]
+                qubits[q['id']] = q
+            layer['qubits'] = qubits
+            for g in layer.get('gates', []):
+                q0, q1 = old[g['q0']], old[g['q1']]
+                g['q0'], g['q1'] = min(q0, q1), max(q0, q1)
+        self.result_json['g_q'] = self.program_g_q
+        self.result_json['relabel'] = self.relabel_method
+
+    def lowerBound(self) -> int:
+        # lower bound of the number of stages for the gates left in g_q
+        g_q = self.g_q
+        if self.aggregate:
+            groups = aggregateGates(g_q, self.n_q, self.all_commutable)
+            g_q = [g_q[group[0]] for group in groups]
+        return stageLowerBound(g_q, self.n_q, self.n_x * self.n_y,
+                               self.all_commutable)
+
+    def moveEstimate(
+            self,
+            qubits: Sequence[Mapping[str, int]],
+            next_qubits: Sequence[Mapping[str, int]],
+    ) -> Mapping[str, Any]:
+        # estimate the duration of the move from a stage to the next with
+        # the model in animation.Move: move_duration of the max distance,
+        # here of the sites in um, and T_ACTIVATE for each AOD row picked up
+        # and again for dropping it off, as in the reload and offload of
+        # CodeGen. qubits has the a/r/x/y of every qubit in the stage.
+        rows = set(qubits[q]['r'] for q in range(self.n_q)
+                   if qubits[q]['a'])
+        max_distance = 0
+        for q in range(self.n_q):
+            if qubits[q]['a']:
+                max_distance = max(
+                    max_distance,
+                    X_SITE_SEP * abs(next_qubits[q]['x'] - qubits[q]['x']),
+                    Y_SITE_SEP * abs(next_qubits[q]['y'] - qubits[q]['y']))
+        transfer_time = 0
+        if not self.no_transfer:
+            transfer_time = 2 * T_ACTIVATE * len(rows)
+        move_time = move_duration(max_distance)
+        return {
+            'aod_rows': len(rows),
+            'max_distance': max_distance,
+            'transfer_time': transfer_time,
+            'move_time': move_time,
+            'time': transfer_time + move_time,
+        }
+
+    def hardwareEstimate(self):
+        # estimate the duration of the move after every stage, see
+        # moveEstimate, and count the transfers before it
+        estimates = []
+        layers = self.result_json['layers']
+        for s in range(len(layers) - 1):
+            qubits = layers[s]['qubits']
+            transfers = 0
+            if s > 0:
+                transfers = sum(
+                    1 for q in range(self.n_q)
+                    if qubits[q]['a'] != layers[s - 1]['qubits'][q]['a'])
+            estimate = {'transfers': transfers}
+            estimate.update(self.moveEstimate(qubits, layers[s + 1]['qubits']))
+            estimates.append(estimate)
+        self.result_json['hardware_estimate'] = estimates
+        self.result_json['hardware_time'] = sum(e['time'] for e in estimates)
+
     def updateGateIndexMatrix(self):
+        # sparse: only the qubit pairs with some gate have an entry, so this
+        # is O(n_g) instead of O(n_q^2). Pairs without gates are missing.
         self.gate_index = {}
-        for i in range(self.n_q):
-            for j in range(i+1, self.n_q):
-                self.gate_index[(i, j)] = []
         for i in range(self.n_g):
-            self.gate_index[self.g_q[i]].append(i)
+            self.gate_index.setdefault(self.g_q[i], []).append(i)
 
     def setCommutation(self):
         self.all_commutable = True
         self.n_t = maxDegree(self.g_q, self.n_q)
         self.dependencies = []
 
+    def setAggregation(self):
+        # solve duplicate gates, see aggregateGates, as one gate. Only for
+        # gates that compose into one, e.g., CRZ(a)CRZ(b) = CRZ(a+b). The
+        # duplicates are put back in the same stage, see expandDuplicates.
+        self.aggregate = True
+
+    def aggregate_gates(self):
+        # keep one gate of every group of duplicates in g_q, and remember
+        # the ids of the others in self.duplicates
+        groups = aggregateGates(self.g_q, self.n_q, self.all_commutable)
+        self.duplicates = {
+            self.g_i[group[0]]: [self.g_i[g] for g in group[1:]]
+            for group in groups if len(group) > 1}
+        keep = [group[0] for group in groups]
+        num_duplicate = len(self.g_q) - len(keep)
+        self.g_q = tuple(self.g_q[g] for g in keep)
+        self.g_s = tuple(self.g_s[g] for g in keep)
+        self.g_i = tuple(self.g_i[g] for g in keep)
+        self.n_g = len(self.g_q)
+        self.updateGateIndexMatrix()
+        self.collisions = collisionExtract(self.g_q)
+        self.dependencies = dependencyExtract(self.g_q, self.n_q)
+        self.result_json['aggregated_gates'] = num_duplicate
+        print(f"aggregated {num_duplicate} duplicate gates")
+
+    def expandDuplicates(self):
+        # put the duplicates of every gate in the same stage as the gate
+        for layer in self.result_json['layers']:
+            gates = []
+            for g in layer['gates']:
+                gates.append(g)
+                for i in self.duplicates.get(g['id'], []):
+                    gates.append({'id': i, 'q0': g['q0'], 'q1': g['q1']})
+            layer['gates'] = gates
+
+    def setTemplateStore(self, dir: str = "./results/templates/"):
+        # keep the gate-independent constraints of solver_init as SMT-LIB
+        # files in dir, so that later solves with the same #qubits, #stages
+        # and architecture parse them instead of building them again
+        if not dir.endswith('/'):
+            dir += '/'
+        self.template_dir = dir
+
     def setAOD(self):
         self.all_aod = True
 
@@ -200,6 +731,97 @@ class DPQA:
     def setRowSite(self, row_per_site: int):
         self.row_per_site = row_per_site
 
+    def setLazyExactness(self):
+        # do not encode 'not co-located' for every pair of qubits without a
+        # gate up front. Only add it for the pairs that a model co-locates,
+        # see check_batch.
+        self.lazy_exactness = True
+
+    def setObjective(
+            self,
+            objective: str,
+            time_budget: float = 10,
+            weights: Sequence[float] = None,
+            window: int = 2,
+    ):
+        # 'stages' (default): minimize the number of stages only.
+        # 'hardware': after solving for the stages as before, re-solve every
+        # `window` layers with their gates fixed, so the stages stay the
+        # same, and minimize the hardware time of hardwareEstimate: first
+        # the time of (de)activating the AOD rows, then that of the moves.
+        # At most time_budget seconds per window. With
+        # weights=(w_transfer, w_move), minimize the weighted sum of the two
+        # instead of the lexicographic order.
+        if objective not in ("stages", "hardware"):
+            raise ValueError(f"objective {objective} unknown")
+        if window < 1:
+            raise ValueError(f"window {window} is not positive")
+        self.objective = objective
+        self.time_budget = time_budget
+        self.objective_weights = weights
+        self.objective_window = window
+
+    def setCubeAndConquer(
+            self,
+            workers: int,
+            cubes_per_worker: int = 4,
+            cube_timeout: float = 30,
+    ):
+        # solve the batches of solve_optimal by cube-and-conquer over worker
+        # processes. The search space is split into about cubes_per_worker
+        # cubes per worker; a cube still unknown after cube_timeout seconds
+        # is split further, see conquer.
+        self.cube_workers = workers
+        self.cubes_per_worker = cubes_per_worker
+        self.cube_timeout = cube_timeout
+
+    def setMemoryLimit(self, mb: float):
+        # restart with a fresh z3 context when z3 uses more than mb MB, or
+        # the process RSS grew by more than mb MB since the last (re)start
+        self.memory_limit = mb
+
+    def memory_usage(self) -> Sequence[float]:
+        # return (z3 memory, process RSS) in MB
+        z3_memory = 0
+        if getattr(self, 'dpqa', None) is not None:
+            stats = (self.dpqa).statistics()
+            if 'memory' in stats.keys():
+                z3_memory = stats.get_key_value('memory')
+        try:
+            with open('/proc/self/statm', 'r') as f:
+                rss = int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+            rss /= 1024 * 1024
+        except (OSError, ValueError, AttributeError):
+            # no procfs, fall back to the peak RSS (KB on Linux)
+            rss = 0
+            if resource:
+                rss = resource.getrusage(
+                    resource.RUSAGE_SELF).ru_maxrss / 1024
+        return z3_memory, rss
+
+    def memory_watchdog(self, where: str):
+        # called between batches: everything committed so far is in
+        # result_json['layers'] and the remaining gates are in g_q, so a
+        # new context loses nothing. The next solver_init builds in it.
+        if not self.memory_limit:
+            return
+        z3_memory, rss = self.memory_usage()
+        if z3_memory > self.memory_limit or\
+                rss - self.rss_at_restart > self.memory_limit:
+            print(f"    memory z3={z3_memory:.1f}MB rss={rss:.1f}MB, "
+                  f"restarting solver after {where}")
+            self.result_json['restarts'].append({
+                'after': where,
+                'layers': len(self.result_json['layers']),
+                'remaining_gates': len(self.g_q),
+                'z3_memory': z3_memory,
+                'rss': rss,
+                'timestamp': str(time.time()),
+            })
+            self.dpqa = None
+            self.ctx = Context()
+            self.rss_at_restart = self.memory_usage()[1]
+
     def addMetadata(self, metadata: Mapping[str, Any]):
         self.result_json = {}
         for k, v in metadata.items():
@@ -220,12 +842,27 @@ class DPQA:
         self.result_json['n_g'] = self.n_g
         self.result_json['g_q'] = self.g_q
         self.result_json['g_s'] = self.g_s
+        self.result_json['lower_bound'] = self.lowerBound()
+        if self.jobs:
+            self.result_json['jobs'] = self.jobs
+        self.result_json['objective'] = self.objective
+        if self.objective == "hardware":
+            self.result_json['time_budget'] = self.time_budget
+            self.result_json['objective_weights'] = self.objective_weights
+            self.result_json['objective_window'] = self.objective_window
+        if self.solve_budget:
+            self.result_json['solve_budget'] = self.solve_budget
+            self.result_json['hybrid'] = []
+        if self.memory_limit:
+            self.result_json['restarts'] = []
+            self.rss_at_restart = self.memory_usage()[1]
 
     def remove_gates(self, gate_ids: Sequence[int]):
         # remove gate_ids from the gates to execute
         new_g_q = []
         new_g_s = []
         new_g_i = []
+        gate_ids = set(gate_ids)
         for i in range(len(self.g_q)):
             if i not in gate_ids:
                 new_g_q.append(self.g_q[i])
@@ -391,23 +1028,25 @@ class DPQA:
             y: Sequence[Sequence[Any]],
             c: Sequence[Sequence[Any]],
             r: Sequence[Sequence[Any]],
+            s: int = 0,
     ):
         # not too many AOD cols/rows can be together, default 3, for init stage
+        # (or for stage s of a window in optimize_window)
         for q in range(self.n_q):
             for qq in range(self.n_q):
                 if q != qq:
                     (self.dpqa).add(
                         Implies(And(
-                            a[q][0],
-                            a[qq][0],
-                            c[q][0]-c[qq][0] > self.row_per_site - 1),
-                            x[q][0] > x[qq][0]))
+                            a[q][s],
+                            a[qq][s],
+                            c[q][s]-c[qq][s] > self.row_per_site - 1),
+                            x[q][s] > x[qq][s]))
                     (self.dpqa).add(
                         Implies(And(
-                            a[q][0],
-                            a[qq][0],
-                            r[q][0]-r[qq][0] > self.row_per_site - 1),
-                            y[q][0] > y[qq][0]))
+                            a[q][s],
+                            a[qq][s],
+                            r[q][s]-r[qq][s] > self.row_per_site - 1),
+                            y[q][s] > y[qq][s]))
 
     def constraint_site_crowding(
             self,
@@ -454,22 +1093,31 @@ class DPQA:
         # the gates to execute. return the variable arrays a, c, r, x, y
 
         # variables
-        a = [[Bool(f"a_q{q}_t{t}") for t in range(num_stage)]
+        a = [[Bool(f"a_q{q}_t{t}", ctx=self.ctx) for t in range(num_stage)]
              for q in range(self.n_q)]
         # for col and row, the data does not matter if atom in SLM
-        c = [[Int(f"c_q{q}_t{t}") for t in range(num_stage)]
+        c = [[Int(f"c_q{q}_t{t}", ctx=self.ctx) for t in range(num_stage)]
              for q in range(self.n_q)]
-        r = [[Int(f"r_q{q}_t{t}") for t in range(num_stage)]
+        r = [[Int(f"r_q{q}_t{t}", ctx=self.ctx) for t in range(num_stage)]
              for q in range(self.n_q)]
-        x = [[Int(f"x_q{q}_t{t}") for t in range(num_stage)]
+        x = [[Int(f"x_q{q}_t{t}", ctx=self.ctx) for t in range(num_stage)]
              for q in range(self.n_q)]
-        y = [[Int(f"y_q{q}_t{t}") for t in range(num_stage)]
+        y = [[Int(f"y_q{q}_t{t}", ctx=self.ctx) for t in range(num_stage)]
              for q in range(self.n_q)]
 
-        (self.dpqa) = Solver()
+        (self.dpqa) = Solver(ctx=self.ctx)
         if self.cardenc == "z3atleast":
             (self.dpqa) = Then('simplify', 'solve-eqs',
-                               'card2bv', 'bit-blast', 'aig', 'sat').solver()
+                               'card2bv', 'bit-blast', 'aig', 'sat',
+                               ctx=self.ctx).solver()
+
+        if self.template_dir:
+            template = self.load_template(num_stage)
+            if template:
+                # the parsed variables are the same as those above because
+                # they have the same names and sorts in the same context
+                (self.dpqa).from_string(template)
+                return a, c, r, x, y
 
         self.constraint_all_aod(num_stage, a)
         self.constraint_no_transfer(num_stage, a)
@@ -484,17 +1132,55 @@ class DPQA:
         self.constraint_site_crowding(num_stage, a, x, y, c, r)
         self.constraint_no_swap(num_stage, a, x, y)
 
+        if self.template_dir:
+            self.save_template(num_stage)
         return a, c, r, x, y
 
+    def template_file(self, num_stage: int) -> str:
+        # the constraints of solver_init only depend on these settings
+        return self.template_dir + (
+            f"v{TEMPLATE_VERSION}_q{self.n_q}_s{num_stage}"
+            f"_a{self.n_x}x{self.n_y}x{self.n_c}x{self.n_r}"
+            f"_r{self.row_per_site}"
+            f"{'_aod' if self.all_aod else ''}"
+            f"{'_notransfer' if self.no_transfer else ''}.smt2")
+
+    def load_template(self, num_stage: int) -> Union[str, None]:
+        # SMT-LIB of the constraints of solver_init, kept in memory after
+        # the first read since every greedy batch needs the same one
+        file_name = self.template_file(num_stage)
+        if file_name not in self.templates:
+            if not os.path.exists(file_name):
+                return None
+            with open(file_name, 'r') as f:
+                self.templates[file_name] = f.read()
+        return self.templates[file_name]
+
+    def save_template(self, num_stage: int):
+        # write to a temporary file of a unique name first, then rename it,
+        # so that concurrent solves in threads or processes never read a
+        # partial template or write to the same temporary file
+        file_name = self.template_file(num_stage)
+        self.templates[file_name] = (self.dpqa).sexpr()
+        os.makedirs(self.template_dir, exist_ok=True)
+        fd, tmp_name = tempfile.mkstemp(dir=self.template_dir, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            f.write(self.templates[file_name])
+        os.replace(tmp_name, file_name)
+
     def constraint_aod_order_from_prev(
             self,
             x: Sequence[Sequence[Any]],
             y: Sequence[Sequence[Any]],
             c: Sequence[Sequence[Any]],
             r: Sequence[Sequence[Any]],
+            prev: Mapping[str, Any] = None,
     ):
-        if len(self.result_json['layers']) > 0:
-            vars = self.result_json['layers'][-1]['qubits']
+        # prev: the layer before stage 0, by default the last one solved
+        if prev is None and len(self.result_json['layers']) > 0:
+            prev = self.result_json['layers'][-1]
+        if prev is not None:
+            vars = prev['qubits']
             for q in range(self.n_q):
                 # load location info
                 if 'x' in vars[q]:
@@ -562,19 +1248,472 @@ class DPQA:
             y: Sequence[Sequence[Any]],
     ):
         # global CZ switch (only works for graph state circuit)
-        for q0 in range(self.n_q):
-            for q1 in range(q0+1, self.n_q):
-                for s in range(1, num_stage):
-                    if not self.gate_index[(q0, q1)]:
-                        (self.dpqa).add(
-                            Or(x[q0][s] != x[q1][s], y[q0][s] != y[q1][s]))
-                    else:
-                        (self.dpqa).add(Implies
-                                        (And(x[q0][s] == x[q1][s],
-                                             y[q0][s] == y[q1][s]
-                                             ),
-                                            Or([t[g] == s for g in self.gate_index[(q0, q1)]]))
-                                        )
+        if self.lazy_exactness:
+            # pairs without gates are handled in check_batch
+            pairs = sorted(self.gate_index.keys())
+        else:
+            pairs = [(q0, q1) for q0 in range(self.n_q)
+                     for q1 in range(q0+1, self.n_q)]
+        for (q0, q1) in pairs:
+            for s in range(1, num_stage):
+                if (q0, q1) not in self.gate_index:
+                    (self.dpqa).add(
+                        Or(x[q0][s] != x[q1][s], y[q0][s] != y[q1][s]))
+                else:
+                    (self.dpqa).add(Implies
+                                    (And(x[q0][s] == x[q1][s],
+                                         y[q0][s] == y[q1][s]
+                                         ),
+                                        Or([t[g] == s for g in self.gate_index[(q0, q1)]]))
+                                    )
+
+    def check_batch(
+            self,
+            num_stage: int,
+            x: Sequence[Sequence[Any]],
+            y: Sequence[Sequence[Any]],
+    ) -> bool:
+        # check satisfiability. With lazy exactness, a model may put two
+        # qubits without a gate in the same site. Then we add 'not
+        # co-located' for those pairs only and check again. Co-located
+        # qubits are found by hashing the sites, O(n_q) per stage.
+        while (self.dpqa).check() == sat:
+            if not self.lazy_exactness:
+                return True
+            num_violated = self.exactness_violations(
+                [self.dpqa], (self.dpqa).model(), num_stage, x, y)
+            if num_violated == 0:
+                return True
+            if self.print_detail:
+                print(f"    {num_violated} pairs without gates co-located")
+        return False
+
+    def cube_variables(self, num_stage: int) -> Sequence[Any]:
+        # the variables to split on, most impactful first: t of the gates
+        # with the most collisions/dependencies, then a of the qubits with
+        # the most gates. a of the last stage does not matter.
+        related = [[] for _ in range(len(self.g_q))]
+        if self.all_commutable:
+            for g0, g1 in self.collisions:
+                related[g0].append(g1)
+                related[g1].append(g0)
+        else:
+            for g0, g1 in self.dependencies:
+                related[g0].append(g1)
+                related[g1].append(g0)
+        gates = sorted(range(len(self.g_q)), key=lambda g: -len(related[g]))
+        degree = [0 for _ in range(self.n_q)]
+        for q0, q1 in self.g_q:
+            degree[q0] += 1
+            degree[q1] += 1
+        qubits = sorted(range(self.n_q), key=lambda q: -degree[q])
+        return [('t', g) for g in gates] + \
+            [('a', q, s) for q in qubits for s in range(num_stage - 1)]
+
+    def split_cube(
+            self,
+            num_stage: int,
+            cube: Sequence[Any],
+            var: Any,
+    ) -> Sequence[Sequence[Any]]:
+        # the cubes extending cube with every value of var. Values of t that
+        # obviously conflict with t in cube, i.e., the same stage for two
+        # collided gates or a dependency in the wrong order, are dropped.
+        if var[0] == 'a':
+            name = f"a_q{var[1]}_t{var[2]}"
+            return [cube + [(name, 1)], cube + [(name, 0)]]
+        g = var[1]
+        stages = {int(name[3:]): value for name, value in cube
+                  if name.startswith('t_g')}
+        children = []
+        # solve_optimal executes all the gates, so t is never 0 (trash)
+        for value in range(1, num_stage):
+            conflict = False
+            if self.all_commutable:
+                for g0, g1 in self.collisions:
+                    other = g1 if g0 == g else g0 if g1 == g else None
+                    if other is not None and stages.get(other) == value:
+                        conflict = True
+            else:
+                for g0, g1 in self.dependencies:
+                    if g0 == g and g1 in stages and stages[g1] <= value:
+                        conflict = True
+                    if g1 == g and g0 in stages and stages[g0] >= value:
+                        conflict = True
+            if not conflict:
+                children.append(cube + [(f"t_g{g}", value)])
+        return children
+
+    def conquer(self, num_stage: int) -> Union[Mapping[str, int], None]:
+        # cube-and-conquer on the current assertions of self.dpqa. Return
+        # the values of the variables in a SAT cube, or None if all cubes
+        # are UNSAT. Every worker gets a warm copy of the encoding and
+        # solves cubes as assumptions. Adaptive depth: split all cubes one
+        # variable deeper until there are cubes_per_worker cubes per worker,
+        # then split a cube again whenever it times out. The first worker
+        # does not take cubes but solves the whole problem, because proving
+        # UNSAT cube by cube can take much longer, e.g., for edge colorings.
+        split_vars = self.cube_variables(num_stage)
+        num_cube_workers = max(self.cube_workers - 1, 1)
+        cubes = [([], 0)]  # (cube, index of the next variable to split)
+        while len(cubes) < self.cubes_per_worker * num_cube_workers and\
+                cubes and cubes[0][1] < len(split_vars):
+            cubes = [(child, i + 1) for cube, i in cubes
+                     for child in self.split_cube(num_stage, cube,
+                                                  split_vars[i])]
+        # every cube gets a timeout, which doubles for the cubes split from
+        # a cube that timed out, so that hard parts are not split endlessly
+        cubes = [(cube, i, self.cube_timeout) for cube, i in cubes]
+        if self.print_detail:
+            print(f"    {len(cubes)} cubes of depth {cubes[0][1]} "
+                  f"on {num_cube_workers} workers" if cubes else
+                  "    no consistent cube")
+        if not cubes:
+            return None
+        pending = deque(cubes)
+
+        smt2 = (self.dpqa).sexpr()
+        if "fork" in multiprocessing.get_all_start_methods():
+            mp = multiprocessing.get_context("fork")
+        else:
+            mp = multiprocessing.get_context()
+        workers = []
+        for _ in range(min(num_cube_workers, len(pending)) + 1):
+            conn, worker_conn = mp.Pipe()
+            proc = mp.Process(target=cubeWorker, args=(worker_conn, smt2))
+            proc.start()
+            worker_conn.close()
+            workers.append((conn, proc))
+
+        running = {}  # conn -> (cube, index of the next variable, timeout)
+        whole = workers[0][0]
+        whole.send(([], None))
+        running[whole] = None
+        idle = [conn for conn, _ in workers[1:]]
+        try:
+            while pending or len(running) > 1:
+                while pending and idle:
+                    conn = idle.pop()
+                    cube, i, timeout = pending.popleft()
+                    # a cube that cannot be split any more runs to the end
+                    conn.send((cube, timeout if i < len(split_vars) else None))
+                    running[conn] = (cube, i, timeout)
+                for conn in wait(list(running.keys())):
+                    result, values = conn.recv()
+                    if conn == whole:
+                        del running[conn]
+                        return values  # None if UNSAT
+                    cube, i, timeout = running.pop(conn)
+                    idle.append(conn)
+                    if result == 'sat':
+                        return values
+                    if result == 'unknown':
+                        if self.print_detail:
+                            print(f"    cube of depth {i} timed out, split")
+                        for child in self.split_cube(num_stage, cube,
+                                                     split_vars[i]):
+                            pending.appendleft((child, i + 1, 2 * timeout))
+            return None
+        finally:
+            # the first SAT cube wins, cancel the others. Also cancel the
+            # whole problem if all the cubes are UNSAT
+            for conn, proc in workers:
+                if conn in running:
+                    proc.terminate()
+                else:
+                    conn.send(None)
+                proc.join()
+                conn.close()
+
+    def check_cubes(
+            self,
+            num_stage: int,
+            a: Sequence[Sequence[Any]],
+            c: Sequence[Sequence[Any]],
+            r: Sequence[Sequence[Any]],
+            x: Sequence[Sequence[Any]],
+            y: Sequence[Sequence[Any]],
+            t: Sequence[Any],
+    ) -> bool:
+        # check_batch by cube-and-conquer. The values from the SAT cube are
+        # checked again in self.dpqa as assumptions, which is immediate, so
+        # that (self.dpqa).model() is available as usual.
+        if not self.cube_workers:
+            return self.check_batch(num_stage, x, y)
+        vars = {'a': a, 'c': c, 'r': r, 'x': x, 'y': y}
+        while True:
+            values = self.conquer(num_stage)
+            if values is None:
+                return False
+            literals = []
+            for name, value in values.items():
+                match = MODEL_VAR.fullmatch(name)
+                if match.group(4) is not None:
+                    literals.append(t[int(match.group(4))] == value)
+                    continue
+                var = vars[match.group(1)][int(match.group(2))][
+                    int(match.group(3))]
+                if match.group(1) == 'a':
+                    literals.append(var if value else Not(var))
+                else:
+                    literals.append(var == value)
+            if (self.dpqa).check(*literals) != sat:
+                # should not happen, fall back to the sequential check
+                return self.check_batch(num_stage, x, y)
+            if not self.lazy_exactness or self.exactness_violations(
+                    [self.dpqa], (self.dpqa).model(), num_stage, x, y) == 0:
+                return True
+
+    def exactness_violations(
+            self,
+            solvers: Sequence[Any],
+            model: Any,
+            num_stage: int,
+            x: Sequence[Sequence[Any]],
+            y: Sequence[Sequence[Any]],
+    ) -> int:
+        # add 'not co-located' to solvers for every pair of qubits without a
+        # gate that model co-locates. Return the number of such pairs.
+        vals = self.read_model(model, num_stage, {'x': x, 'y': y})
+        num_violated = 0
+        for s in range(1, num_stage):
+            site_qs = {}
+            for q in range(self.n_q):
+                site = (vals['x'][q][s], vals['y'][q][s])
+                site_qs.setdefault(site, []).append(q)
+            for qs in site_qs.values():
+                for i, q0 in enumerate(qs):
+                    for q1 in qs[i+1:]:
+                        if (q0, q1) not in self.gate_index:
+                            for solver in solvers:
+                                solver.add(Or(x[q0][s] != x[q1][s],
+                                              y[q0][s] != y[q1][s]))
+                            num_violated += 1
+        return num_violated
+
+    def optimize_window(
+            self,
+            begin: int,
+            end: int,
+            time_budget: float,
+    ) -> bool:
+        # re-solve the layers begin..end-1 of result_json, begin > 0, for
+        # the hardware objective, see setObjective, keeping the gates of
+        # every layer, so the stages do not change. Like a greedy batch,
+        # stage s of the window is layer begin-1+s: stage 0 has the x/y of
+        # layer begin-1 and only sets its a/c/r. Unless it is the last
+        # layer, layer end-1 keeps its x/y, and its a/c/r are left to the
+        # next window. Return whether the layers changed.
+        layers = self.result_json['layers']
+        num_stage = end - begin + 1
+        window = layers[begin - 1:end]
+        moves = range(num_stage - 1)
+        current_time = sum(
+            self.moveEstimate(window[s]['qubits'],
+                              window[s + 1]['qubits'])['time']
+            for s in moves)
+
+        # solve in a context of its own: new terms in self.ctx change the
+        # models that its solvers find later
+        main = (self.ctx, self.dpqa)
+        self.ctx = Context()
+        try:
+            a, c, r, x, y = self.solver_init(num_stage)
+            # layer begin-1 with the cols and rows that the qubits arrive
+            # in, i.e., those of the move from layer begin-2
+            prev = {'qubits': []}
+            for q in range(self.n_q):
+                qubit = dict(window[0]['qubits'][q], a=0)
+                if begin > 1:
+                    for k in ('a', 'c', 'r'):
+                        qubit[k] = layers[begin - 2]['qubits'][q][k]
+                prev['qubits'].append(qubit)
+            self.constraint_aod_order_from_prev(x, y, c, r, prev)
+            # every layer solved greedily is stage 0 of some batch
+            for s in range(1, num_stage):
+                self.constraint_aod_crowding_init(a, x, y, c, r, s)
+            ctx = self.ctx
+            assertions = (self.dpqa).assertions()
+        finally:
+            self.ctx, self.dpqa = main
+        hw_solver = Solver(ctx=ctx)
+        hw_solver.add(assertions)
+        if end < len(layers):
+            for q in range(self.n_q):
+                hw_solver.add(x[q][-1] == window[-1]['qubits'][q]['x'])
+                hw_solver.add(y[q][-1] == window[-1]['qubits'][q]['y'])
+
+        # the gates of each layer, as in constraint_connectivity and
+        # constraint_interaction_exactness with the stage of every gate fixed
+        stage_pairs = [set() for _ in range(num_stage)]
+        for s in range(1, num_stage):
+            for g in window[s]['gates']:
+                q0, q1 = min(g['q0'], g['q1']), max(g['q0'], g['q1'])
+                stage_pairs[s].add((q0, q1))
+                hw_solver.add(x[q0][s] == x[q1][s], y[q0][s] == y[q1][s])
+        if self.lazy_exactness:
+            # pairs without gates in the window are handled below
+            pairs = sorted(set().union(*stage_pairs))
+        else:
+            pairs = [(q0, q1) for q0 in range(self.n_q)
+                     for q1 in range(q0+1, self.n_q)]
+        for s in range(1, num_stage):
+            for (q0, q1) in pairs:
+                if (q0, q1) not in stage_pairs[s]:
+                    hw_solver.add(
+                        Or(x[q0][s] != x[q1][s], y[q0][s] != y[q1][s]))
+
+        # the cost is in ns to be integral. The max distance of a move is a
+        # multiple of X_SITE_SEP or Y_SITE_SEP in the array, so
+        # move_duration is a step function over these distances.
+        distances = sorted(set(
+            [X_SITE_SEP * i for i in range(self.n_x)] +
+            [Y_SITE_SEP * j for j in range(self.n_y)]))
+        rows_used = []
+        move_time = []
+        for s in moves:
+            if not self.no_transfer:
+                # T_ACTIVATE to pick up and to drop off each AOD row used
+                for row in range(self.n_r):
+                    used = Bool(f"u_t{s}_r{row}", ctx=ctx)
+                    for q in range(self.n_q):
+                        hw_solver.add(
+                            Implies(And(a[q][s], r[q][s] == row), used))
+                    rows_used.append(If(used, 1, 0))
+            # d >= distance in um that any qubit moves from stage s to s+1.
+            # Only AOD qubits move, so this is the distance of the AOD move.
+            d = Int(f"d_t{s}", ctx=ctx)
+            for q in range(self.n_q):
+                hw_solver.add(d >= X_SITE_SEP * (x[q][s+1] - x[q][s]))
+                hw_solver.add(d >= X_SITE_SEP * (x[q][s] - x[q][s+1]))
+                hw_solver.add(d >= Y_SITE_SEP * (y[q][s+1] - y[q][s]))
+                hw_solver.add(d >= Y_SITE_SEP * (y[q][s] - y[q][s+1]))
+            # move_duration of the least possible distance >= d
+            m = IntVal(0, ctx)
+            for lo, hi in zip(distances, distances[1:]):
+                m = If(d > lo, round(1000 * move_duration(hi)), m)
+            move_time.append(m)
+        total_transfer = IntVal(0, ctx)
+        if rows_used:
+            total_transfer = 2000 * T_ACTIVATE * Sum(rows_used)
+        total_move = Sum(move_time)
+        if self.objective_weights:
+            w_a, w_d = self.objective_weights
+        else:
+            # lexicographic: the transfers first, i.e., no decrease of the
+            # move time is worth one more AOD row
+            w_a = len(moves) * round(1000 * move_duration(distances[-1])) + 1
+            w_d = 1
+        cost = w_a * total_transfer + w_d * total_move
+
+        # the same cost of the current layers
+        current_transfer = 0
+        current_move = 0
+        for s in moves:
+            estimate = self.moveEstimate(window[s]['qubits'],
+                                         window[s + 1]['qubits'])
+            if not self.no_transfer:
+                current_transfer += 2000 * T_ACTIVATE * estimate['aod_rows']
+            current_move += round(
+                1000 * move_duration(estimate['max_distance']))
+        hw_solver.add(cost < w_a * current_transfer + w_d * current_move)
+
+        # linear search from above: ask for a model cheaper than the best
+        # one so far until UNSAT or out of time. Every improvement found
+        # before the timeout is kept.
+        vals_vars = {'a': a, 'c': c, 'r': r, 'x': x, 'y': y}
+        best_vals = None
+        best_time = current_time
+        t_s = time.time()
+        while True:
+            remaining = time_budget - (time.time() - t_s)
+            if remaining <= 0:
+                break
+            hw_solver.set(timeout=int(remaining * 1000))
+            if hw_solver.check() != sat:
+                break
+            model = hw_solver.model()
+            vals = self.read_model(model, num_stage, vals_vars)
+            num_violated = 0
+            for s in range(1, num_stage):
+                site_qs = {}
+                for q in range(self.n_q):
+                    site = (vals['x'][q][s], vals['y'][q][s])
+                    site_qs.setdefault(site, []).append(q)
+                for qs in site_qs.values():
+                    for i, q0 in enumerate(qs):
+                        for q1 in qs[i+1:]:
+                            if (q0, q1) not in stage_pairs[s]:
+                                hw_solver.add(Or(x[q0][s] != x[q1][s],
+                                                 y[q0][s] != y[q1][s]))
+                                num_violated += 1
+            if num_violated > 0:
+                continue
+            stages = [[{k: vals[k][q][s] for k in ('a', 'r', 'x', 'y')}
+                       for q in range(self.n_q)] for s in range(num_stage)]
+            new_time = sum(self.moveEstimate(stages[s], stages[s + 1])['time']
+                           for s in moves)
+            if new_time < best_time:
+                best_vals, best_time = vals, new_time
+            hw_solver.add(cost < model.eval(cost, model_completion=True))
+
+        if best_vals is None:
+            return False
+        if self.print_detail:
+            print(f"    layers {begin}-{end - 1}: {best_time:.0f}us "
+                  f"instead of {current_time:.0f}us")
+        for s in range(num_stage):
+            if s == num_stage - 1 and end < len(layers):
+                continue
+            keys = ('a', 'c', 'r') if s == 0 else ('a', 'c', 'r', 'x', 'y')
+            for q in range(self.n_q):
+                for k in keys:
+                    window[s]['qubits'][q][k] = best_vals[k][q][s]
+        return True
+
+    def optimize_windows(
+            self,
+            begin: int,
+            end: int,
+            time_budget: float,
+    ) -> int:
+        # optimize_window on the layers begin..end-1 with half of the time
+        # budget and, if they do not improve, on each half of them with the
+        # rest. Within a window, the AOD qubits of a stage keep their cols
+        # and rows into the next stage, which the greedy batches of one step
+        # do not, so a window can be infeasible with its gates while a
+        # window of one layer, like such a batch, is not. Return the number
+        # of windows improved.
+        if end - begin == 1:
+            return int(self.optimize_window(begin, end, time_budget))
+        t_s = time.time()
+        if self.optimize_window(begin, end, time_budget / 2):
+            return 1
+        mid = (begin + end) // 2
+        remaining = time_budget - (time.time() - t_s)
+        num_improved = self.optimize_windows(begin, mid, remaining / 2)
+        remaining = time_budget - (time.time() - t_s)
+        return num_improved + self.optimize_windows(mid, end, remaining)
+
+    def optimize_hardware(self):
+        # the hardware objective after solving for the stages: re-solve
+        # the layers after the first in windows of self.objective_window,
+        # spending at most time_budget seconds per window, see
+        # optimize_windows. The first layer, the initial placement, stays.
+        layers = self.result_json['layers']
+        num_improved = 0
+        for begin in range(1, len(layers), self.objective_window):
+            time_budget = self.time_budget
+            if self.deadline:
+                time_budget = min(time_budget, self.deadline - time.time())
+            if time_budget <= 0:
+                if self.print_detail:
+                    print("hardware objective: out of time budget")
+                break
+            end = min(begin + self.objective_window, len(layers))
+            num_improved += self.optimize_windows(begin, end, time_budget)
+        if self.print_detail:
+            print(f"hardware objective: {num_improved} windows improved")
 
     def constraint_gate_batch(
             self,
@@ -588,7 +1727,7 @@ class DPQA:
         # add the constraints related to the gates to execute
 
         num_gate = len(self.g_q)
-        t = [Int(f"t_g{g}") for g in range(num_gate)]
+        t = [Int(f"t_g{g}", ctx=self.ctx) for g in range(num_gate)]
 
         self.constraint_aod_order_from_prev(x, y, c, r)
         for g in range(num_gate):
@@ -635,7 +1774,8 @@ class DPQA:
                         Not(t[idx % num_gate] == (idx // num_gate)))
                 else:
                     if val not in ancillary.keys():
-                        ancillary[val] = Bool("anx_{}".format(val))
+                        ancillary[val] = Bool(
+                            "anx_{}".format(val), ctx=self.ctx)
                     if i < 0:
                         or_list.append(Not(ancillary[val]))
                     else:
@@ -666,17 +1806,64 @@ class DPQA:
         else:
             raise ValueError("cardinality method unknown")
 
+    def read_model(
+            self,
+            model: Any,
+            num_stage: int,
+            vars: Mapping[str, Sequence[Any]],
+    ) -> Mapping[str, Sequence[Any]]:
+        # decode the model in one pass over its SMT-LIB text instead of one
+        # model[...] and .as_long() per variable and per use. vars maps
+        # 'a', 'c', 'r', 'x', 'y' to the [q][s] arrays of variables and 't'
+        # to the gate variables. Returns integer arrays of the same shapes,
+        # e.g., vals['x'][q][s], vals['t'][g]; a is 1 (AOD) or 0 (SLM).
+        vals = {}
+        for k, var in vars.items():
+            if k == 't':
+                vals[k] = [None for _ in range(len(var))]
+            else:
+                vals[k] = [[None for _ in range(num_stage)]
+                           for _ in range(self.n_q)]
+        for name, value in MODEL_ENTRY.findall(model.sexpr()):
+            match = MODEL_VAR.fullmatch(name)
+            if not match:
+                continue  # e.g., ancillary variables of the cardinality
+            value = modelValue(value)
+            if match.group(4) is not None:
+                g = int(match.group(4))
+                if 't' in vals and g < len(vals['t']):
+                    vals['t'][g] = value
+            else:
+                k, q, s = match.group(1), int(match.group(2)),\
+                    int(match.group(3))
+                if k in vals and q < self.n_q and s < num_stage:
+                    vals[k][q][s] = value
+
+        # a variable missing from the model can take any value
+        def default(var: Any) -> int:
+            value = model.eval(var, model_completion=True)
+            if is_bool(value):
+                return 1 if is_true(value) else 0
+            return value.as_long()
+
+        for k, var in vars.items():
+            if k == 't':
+                for g in range(len(var)):
+                    if vals[k][g] is None:
+                        vals[k][g] = default(var[g])
+            else:
+                for q in range(self.n_q):
+                    for s in range(num_stage):
+                        if vals[k][q][s] is None:
+                            vals[k][q][s] = default(var[q][s])
+        return vals
+
     def read_partial_solution(
             self,
             s: int,
-            model: Any,
-            a: Sequence[Sequence[Any]],
-            c: Sequence[Sequence[Any]],
-            r: Sequence[Sequence[Any]],
-            x: Sequence[Sequence[Any]],
-            y: Sequence[Sequence[Any]],
+            vals: Mapping[str, Sequence[Any]],
     ):
-        real_s = len(self.result_json['layers'])
+        real_s = self.flushed_layers + len(self.result_json['layers'])
         if real_s == 0 and s == 0:
             real_s = -1
         if self.print_detail:
@@ -686,27 +1873,19 @@ class DPQA:
         for q in range(self.n_q):
             layer['qubits'].append({
                 'id': q,
-                'a': 1 if is_true(model[a[q][s]]) else 0,
-                'x': model[x[q][s]].as_long(),
-                'y': model[y[q][s]].as_long(),
-                'c': model[c[q][s]].as_long(),
-                'r': model[r[q][s]].as_long()})
-            if is_true(model[a[q][s]]):
-                if self.print_detail:
-                    print(
-                        f"        q_{q} is at ({model[x[q][s]].as_long()}, "
-                        f"{model[y[q][s]].as_long()})"
-                        f" AOD c_{model[c[q][s]].as_long()},"
-                        f" r_{model[r[q][s]].as_long()}"
-                    )
-            else:
-                if self.print_detail:
-                    print(
-                        f"        q_{q} is at ({model[x[q][s]].as_long()}, "
-                        f"{model[y[q][s]].as_long()}) SLM"
-                        f" c_{model[c[q][s]].as_long()},"
-                        f" r_{model[r[q][s]].as_long()}"
-                    )
+                'a': vals['a'][q][s],
+                'x': vals['x'][q][s],
+                'y': vals['y'][q][s],
+                'c': vals['c'][q][s],
+                'r': vals['r'][q][s]})
+            if self.print_detail:
+                print(
+                    f"        q_{q} is at ({vals['x'][q][s]}, "
+                    f"{vals['y'][q][s]})"
+                    f"{' AOD' if vals['a'][q][s] else ' SLM'}"
+                    f" c_{vals['c'][q][s]},"
+                    f" r_{vals['r'][q][s]}"
+                )
         return layer
 
     """how to stitch partial solution: (suppose there are 3 stages or 2
@@ -750,21 +1929,23 @@ class DPQA:
             y: Sequence[Sequence[Any]],
             t: Sequence[Any],
     ):
-        model = (self.dpqa).model()
+        vals = self.read_model((self.dpqa).model(), num_stage,
+                               {'a': a, 'c': c, 'r': r, 'x': x, 'y': y,
+                                't': t})
 
         for s in range(num_stage):
-            layer = self.read_partial_solution(s, model, a, c, r, x, y)
+            layer = self.read_partial_solution(s, vals)
 
             if s == 0 and self.result_json['layers']:
                 # if there is a 'previous last stage' and we're at the first
                 # stage of the partial solution, we write over the last a/c/r's
                 for q in range(self.n_q):
                     self.result_json['layers'][-1]['qubits'][q]['a'] =\
-                        1 if is_true(model[a[q][s]]) else 0
+                        vals['a'][q][s]
                     self.result_json['layers'][-1]['qubits'][q]['c'] =\
-                        model[c[q][s]].as_long()
+                        vals['c'][q][s]
                     self.result_json['layers'][-1]['qubits'][q]['r'] =\
-                        model[r[q][s]].as_long()
+                        vals['r'][q][s]
 
             if s > 0:
                 # otherwise, only append the x/y/z/c/r data when we're not at
@@ -773,7 +1954,7 @@ class DPQA:
                 layer['gates'] = []
                 gates_done = []
                 for g in range(len(self.g_q)):
-                    if model[t[g]].as_long() == s:
+                    if vals['t'][g] == s:
                         if self.print_detail:
                             print(
                                 f"        CZ(q_{self.g_q[g][0]},"
@@ -794,6 +1975,9 @@ class DPQA:
     def hybrid_strategy(self):
         # default strategy for hybrid solving: if n_q <30, use optimal solving
         # i.e., optimal_ratio=1 with no transfer; if n_q >= 30, last 5% optimal
+        # with a time budget, leave it to switch_to_optimal
+        if self.optimal_ratio == None and self.solve_budget:
+            return
         if self.optimal_ratio == None:
             self.setOptimalRatio(1 if self.n_q < 30 else 0.05)
         if self.optimal_ratio == 1 and self.n_q < 30:
@@ -807,7 +1991,7 @@ class DPQA:
         self.non_front_g_q = []
         self.non_front_g_s = []
         self.non_front_g_i = []
-        all_dest = [d for (_, d) in self.dependencies]
+        all_dest = set(d for (_, d) in self.dependencies)
         for g in range(self.n_g):
             if g not in all_dest:
                 new_idx.append(g)
@@ -826,94 +2010,303 @@ class DPQA:
         self.collisions = collisionExtract(self.g_q)
         self.dependencies = dependencyExtract(self.g_q, self.n_q)
 
+    def switch_to_optimal(self, batch: int) -> bool:
+        # decide whether to solve the remaining gates optimally. From the
+        # last greedy batches, estimate the time to finish greedily, and the
+        # time for the optimal solving as that times optimal_cost for every
+        # stage beyond the first in the lower bound, since the search gets
+        # much harder with the number of stages unrolled. Switch if the
+        # estimate fits in half of the time left. The optimal solving then
+        # stops early enough to finish greedily if it runs out of time. The
+        # decisions are logged in result_json['hybrid'].
+        if not self.batch_costs:
+            return False  # nothing measured yet
+        recent = self.batch_costs[-3:]
+        batch_time = sum(cost[0] for cost in recent) / len(recent)
+        batch_gates = sum(cost[1] for cost in recent) / len(recent)
+        num_gate = len(self.g_q)
+        bound = self.lowerBound()
+        greedy_estimate = batch_time * num_gate / max(batch_gates, 1)
+        optimal_estimate = greedy_estimate *\
+            self.optimal_cost ** max(bound - 1, 0)
+        time_left = self.deadline - time.time()
+        decision = optimal_estimate <= time_left / 2
+        self.result_json['hybrid'].append({
+            'batch': batch,
+            'remaining_gates': num_gate,
+            'lower_bound': bound,
+            'batch_time': batch_time,
+            'batch_gates': batch_gates,
+            'greedy_estimate': greedy_estimate,
+            'optimal_estimate': optimal_estimate,
+            'time_left': time_left,
+            'decision': 'optimal' if decision else 'greedy',
+        })
+        if decision:
+            self.optimal_deadline = self.deadline - 2 * greedy_estimate
+        print(f"    hybrid: {num_gate} gates left, greedy ~"
+              f"{greedy_estimate:.1f}s, optimal ~{optimal_estimate:.1f}s, "
+              f"{time_left:.1f}s left: {'optimal' if decision else 'greedy'}")
+        return decision
+
+    def continue_greedy(self, total_g_q: int, batch: int) -> bool:
+        # whether solve_greedy solves another batch
+        if len(self.g_q) == 0:
+            return False
+        if self.optimal_ratio is None:
+            if self.solve_budget:
+                return not self.switch_to_optimal(batch)
+            return True  # hybrid_strategy not used, all greedy
+        return len(self.g_q) > self.optimal_ratio * total_g_q
+
     def solve_greedy(self, step: int,):
         total_g_q = len(self.g_q)
         t_curr = 1
 
-        while len(self.g_q) > self.optimal_ratio * total_g_q:
-            step = 1
-            a, c, r, x, y = self.solver_init(step+1)
-            self.get_front_layer()
-            print(f"gate batch {t_curr}")
+        while self.continue_greedy(total_g_q, t_curr):
+            self.solve_batch(t_curr)
+            t_curr += 1
 
-            (self.dpqa).push()  # gate related constraints
-            t = self.constraint_gate_batch(step+1, c, r, x, y)
+    def solve_batch(self, batch: int):
+        # solve one greedy batch: as many gates of the front layer as
+        # possible in one step, or two steps if none fits in one
+        t_batch = time.time()
+        num_gate = len(self.g_q)
+        step = 1
+        a, c, r, x, y = self.solver_init(step+1)
+        self.get_front_layer()
+        print(f"gate batch {batch}")
+
+        (self.dpqa).push()  # gate related constraints
+        t = self.constraint_gate_batch(step+1, c, r, x, y)
+
+        # no more gates than a maximum matching or the number of sites
+        bound_gate = maxGatesPerStage(self.g_q, self.n_x * self.n_y)
+
+        (self.dpqa).push()  # gate bound
+        self.constraint_gate_card(bound_gate, step+1, t)
+
+        solved_batch_gates = self.check_batch(step+1, x, y)
 
-            G = Graph()
-            G.add_edges_from(self.g_q)
-            bound_gate = len(max_weight_matching(G))
+        while not solved_batch_gates:
+            print(f"    no solution, bound_gate={bound_gate} too large")
+            (self.dpqa).pop()  # pop to reduce gate bound
+            bound_gate -= 1
+            if bound_gate <= 0:
+                if self.print_detail:
+                    print(f"    no solution, step={step} too small")
+                step = 2
+                a, c, r, x, y = self.solver_init(step + 1)  # self.dpqa is cleaned
+                (self.dpqa).push()  # gate related constraints
+                t = self.constraint_gate_batch(step + 1, c, r, x, y)
+                if self.print_detail:
+                    print(self.g_q)
+                bound_gate = 1
 
-            (self.dpqa).push()  # gate bound
+            (self.dpqa).push()  # new gate bound
             self.constraint_gate_card(bound_gate, step+1, t)
 
-            solved_batch_gates = True if (self.dpqa).check() == sat else False
-
-            while not solved_batch_gates:
-                print(f"    no solution, bound_gate={bound_gate} too large")
-                (self.dpqa).pop()  # pop to reduce gate bound
-                bound_gate -= 1
-                if bound_gate <= 0:
-                    if self.print_detail:
-                        print(f"    no solution, step={step} too small")
-                    step = 2
-                    a, c, r, x, y = self.solver_init(step + 1)  # self.dpqa is cleaned
-                    (self.dpqa).push()  # gate related constraints
-                    t = self.constraint_gate_batch(step + 1, c, r, x, y)
-                    if self.print_detail:
-                        print(self.g_q)
-                    bound_gate = 1
-
-                (self.dpqa).push()  # new gate bound
-                self.constraint_gate_card(bound_gate, step+1, t)
-
-                solved_batch_gates =\
-                    True if (self.dpqa).check() == sat else False
+            solved_batch_gates = self.check_batch(step+1, x, y)
 
-            print(f"    found solution with {bound_gate} gates in {step} step")
-            self.process_partial_solution(step+1, a, c, r, x, y, t)
-            (self.dpqa).pop()  # the gate bound constraints for solved batch
-            t_curr += 1
-            (self.dpqa).pop()  # the gate related constraints for solved batch
+        print(f"    found solution with {bound_gate} gates in {step} step")
+        self.process_partial_solution(step+1, a, c, r, x, y, t)
+        (self.dpqa).pop()  # the gate bound constraints for solved batch
+        (self.dpqa).pop()  # the gate related constraints for solved batch
+        self.memory_watchdog(f"gate batch {batch}")
+        self.batch_costs.append(
+            (time.time() - t_batch, num_gate - len(self.g_q)))
 
     def solve_optimal(self, step: int):
         bound_gate = len(self.g_q)
+        # fewer steps than the lower bound are UNSAT, do not try them
+        step = max(step, self.lowerBound())
+        if self.print_detail:
+            print(f"    start from the lower bound, step={step}")
 
         a, c, r, x, y = self.solver_init(step+1)
         t = self.constraint_gate_batch(step+1, c, r, x, y)
         self.constraint_gate_card(bound_gate, step+1, t)
+        self.limit_to_deadline()
 
-        solved_batch_gates = True if (self.dpqa).check() == sat else False
+        solved_batch_gates = self.check_cubes(step+1, a, c, r, x, y, t)
 
         while not solved_batch_gates:
+            if self.optimal_deadline and\
+                    time.time() >= self.optimal_deadline:
+                # the check timed out, it was not UNSAT
+                print(f"    out of time budget at step={step}")
+                self.result_json['hybrid'].append({
+                    'step': step,
+                    'remaining_gates': len(self.g_q),
+                    'decision': 'abort optimal',
+                })
+                return False
             if self.print_detail:
                 print(f"    no solution, step={step} too small")
             step += 1
+            self.memory_watchdog(f"step {step-1}")
             a, c, r, x, y = self.solver_init(step+1)  # self.dpqa is cleaned
             t = self.constraint_gate_batch(step+1, c, r, x, y)
             if self.print_detail:
                 print(self.g_q)
             self.constraint_gate_card(bound_gate, step+1, t)
+            self.limit_to_deadline()
 
-            solved_batch_gates =\
-                True if (self.dpqa).check() == sat else False
+            solved_batch_gates = self.check_cubes(step+1, a, c, r, x, y, t)
 
         if self.print_detail:
             print(f"    found solution with {bound_gate} gates in {step} step")
         self.process_partial_solution(step+1, a, c, r, x, y, t)
+        return True
+
+    def limit_to_deadline(self):
+        # with a time budget, checks of self.dpqa stop at the deadline. The
+        # workers of cube-and-conquer are not limited.
+        if self.optimal_deadline:
+            timeout = int((self.optimal_deadline - time.time()) * 1000)
+            (self.dpqa).set(timeout=max(timeout, 1))
+
+    def solve_stream(
+            self,
+            gates: Iterable[Sequence[int]],
+            nqubit: int,
+            window: int = 1000,
+            all_commutable: bool = False,
+            save_file: bool = True,
+    ) -> Mapping[str, Any]:
+        # greedy solving of a long program given as an iterator of qubit
+        # pairs, for programs too large for setProgram. Only the next
+        # `window` gates are held in g_q, with their dependencies and
+        # collisions; after every batch, g_q is refilled from the iterator.
+        # In order, the front layer of the window is that of the program.
+        # The finished layers are appended to dir/name_layers.jsonl, one
+        # layer per line, and dropped from result_json. All but the last
+        # layer are finished, since the next batch overwrites its a/c/r.
+        # The file dir/name.json then has the settings and 'layers_file',
+        # see readStreamResult. No relabeling, aggregation, optimal
+        # solving at the end, or hardware objective, which need the whole
+        # program. all_commutable replaces setCommutation.
+        if self.objective == "hardware":
+            raise ValueError("the hardware objective needs solve(), the "
+                             "layers of solve_stream are written as solved")
+        if not self.dir:
+            self.dir = "./results/smt/"
+        self.n_q = nqubit
+        self.g_q, self.g_s, self.g_i = (), (), ()
+        self.n_g = 0
+        self.program_g_q = ()
+        self.relabel_method = None
+        self.old_label = None
+        self.all_commutable = all_commutable
+        self.dependencies = []
+        self.writeSettingJson()
+        for key in ('g_q', 'g_s', 'lower_bound'):
+            del self.result_json[key]
+        layers_file = self.dir + f"{self.result_json['name']}_layers.jsonl"
+        self.result_json['layers_file'] = layers_file
+        self.result_json['window'] = window
+        self.flushed_layers = 0
+        gates = iter(gates)
+        num_read = 0
+        max_depth = [0 for _ in range(self.n_q)]
+        t_s = time.time()
+
+        with open(layers_file, 'w') as f:
+            batch = 1
+            while True:
+                # refill the window from the stream
+                new_g_q = []
+                while len(self.g_q) + len(new_g_q) < window:
+                    gate = next(gates, None)
+                    if gate is None:
+                        break
+                    q0, q1 = min(gate), max(gate)
+                    if q0 < 0 or q1 >= self.n_q or q0 == q1:
+                        raise ValueError(
+                            f"gate {num_read} on {tuple(gate)} is invalid "
+                            f"for {self.n_q} qubits.")
+                    new_g_q.append((q0, q1))
+                    # the push-left depth and degree, see setCommutation
+                    depth = max(max_depth[q0], max_depth[q1]) + 1
+                    if self.all_commutable:
+                        max_depth[q0] += 1
+                        max_depth[q1] += 1
+                    else:
+                        max_depth[q0] = max_depth[q1] = depth
+                if new_g_q:
+                    self.g_i = tuple(self.g_i) + tuple(
+                        range(num_read, num_read + len(new_g_q)))
+                    self.g_q = tuple(self.g_q) + tuple(new_g_q)
+                    self.g_s = tuple(self.g_s) + tuple(
+                        'CRZ' for _ in new_g_q)
+                    num_read += len(new_g_q)
+                    self.n_g = len(self.g_q)
+                    self.updateGateIndexMatrix()
+                    self.collisions = collisionExtract(self.g_q)
+                    self.dependencies = dependencyExtract(self.g_q, self.n_q)
+                if not self.g_q:
+                    break
+
+                self.solve_batch(batch)
+                batch += 1
+                # write out the finished layers
+                for layer in self.result_json['layers'][:-1]:
+                    f.write(json.dumps(layer) + '\n')
+                self.flushed_layers += len(self.result_json['layers']) - 1
+                self.result_json['layers'] = self.result_json['layers'][-1:]
+            for layer in self.result_json['layers']:
+                f.write(json.dumps(layer) + '\n')
+            self.flushed_layers += len(self.result_json['layers'])
+            self.result_json['layers'] = []
+
+        self.result_json['n_g'] = num_read
+        self.result_json['lower_bound'] = max(max_depth, default=0)
+        self.result_json['n_t'] = self.flushed_layers
+        self.result_json['optimal'] = self.flushed_layers ==\
+            self.result_json['lower_bound']
+        self.result_json['timestamp'] = str(time.time())
+        self.result_json['duration'] = str(time.time() - t_s)
+        del self.result_json['layers']
+        print(f"streamed {num_read} gates into {self.flushed_layers} layers")
+
+        if save_file:
+            with open(self.dir + f"{self.result_json['name']}.json", 'w') as f:
+                json.dump(self.result_json, f)
+
+        return self.result_json
 
     def solve(self, save_file: bool = True):
         if self.n_q > self.n_x * self.n_y:
             print("#qubits > #sites. There may be a problem.")
         self.writeSettingJson()
         t_s = time.time()
+        if self.solve_budget:
+            self.deadline = t_s + self.solve_budget
+            self.optimal_deadline = self.deadline
+        if self.previous:
+            self.reuse_layers()
+        if self.aggregate:
+            self.aggregate_gates()
         step = 1  # compile for 1 step, or 2 stages each time
         total_g_q = len(self.g_q)
         self.solve_greedy(step)
         if len(self.g_q) > 0:
             if self.print_detail:
                 print(f'final {len(self.g_q)/total_g_q*100} percent')
-            self.solve_optimal(step)
-
+            if not self.solve_optimal(step):
+                # out of time, finish the remaining gates greedily
+                self.setOptimalRatio(0)
+                self.solve_greedy(step)
+        if self.objective == "hardware":
+            self.optimize_hardware()
+
+        self.expandDuplicates()
+        self.restoreLabels()
+        # the number of stages is optimal if it meets the lower bound
+        self.result_json['optimal'] = len(self.result_json['layers']) ==\
+            self.result_json['lower_bound']
+        if self.objective == "hardware":
+            self.hardwareEstimate()
         self.result_json['timestamp'] = str(time.time())
         self.result_json['duration'] = str(time.time() - t_s)
         self.result_json['n_t'] = len(self.result_json['layers'])
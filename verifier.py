@@ -0,0 +1,265 @@
+from typing import Mapping, Sequence, Any, Union, Tuple
+from animation import MachineState, Inst, Init, Move, Activate, Deactivate
+from animation import Rydberg, Raman, Measurement
+from codeformat import readCode, ENTITIES
+from hardware import AOD_SEP
+import numpy as np
+import multiprocessing
+import argparse
+import re
+
+# the code read by a worker process of verifyCode, see _initWorker
+_code = None
+
+
+def instStage(inst: Mapping[str, Any]) -> int:
+    # stage of an instruction from its name, e.g., 2 of Reload_2:ReloadRow_0:Move
+    match = re.match(r"[A-Za-z]+_(\d+)", inst["name"])
+    return int(match.group(1)) if match else 0
+
+
+def checkState(state: MachineState) -> Union[str, None]:
+    """check the invariants of a state: the active cols (rows) are in order
+    and AOD_SEP apart, and the qubits in AOD are at their active col and row.
+
+    Returns:
+        Union[str, None]: the first violation, or None.
+    """
+    for kind, axis, pos, active in [
+        ("col", "x", state.c_x, state.c_active),
+        ("row", "y", state.r_y, state.r_active),
+    ]:
+        ids = np.flatnonzero(active)
+        bad = np.flatnonzero(np.diff(pos[ids]) < AOD_SEP)
+        if len(bad):
+            i, j = ids[bad[0]], ids[bad[0] + 1]
+            return (
+                f"{kind} {i} at {axis}={pos[i]} and {kind} {j} at "
+                f"{axis}={pos[j]} are not {AOD_SEP} apart in order."
+            )
+    aod = np.flatnonzero(state.q_aod)
+    c = state.q_c[aod]
+    r = state.q_r[aod]
+    bad = aod[
+        ~state.c_active[c]
+        | ~state.r_active[r]
+        | (state.q_x[aod] != state.c_x[c])
+        | (state.q_y[aod] != state.r_y[r])
+    ]
+    if len(bad):
+        q = state.qubits[bad[0]]
+        return f"q {q.id} in AOD at x={q.x} y={q.y} is not at col {q.c} row {q.r}."
+    return None
+
+
+def buildInst(inst: Mapping[str, Any], state: MachineState) -> Inst:
+    """build the Inst of an instruction in code_full like CodeGen does: it is
+    verified and it operates on state, the state before the instruction,
+    except for Init, which starts from an empty state of the same size.
+
+    Args:
+        inst (Mapping[str, Any]): the instruction in code_full.
+        state (MachineState): state before the instruction. It is modified.
+
+    Raises:
+        ValueError: the instruction is invalid or of an unknown type.
+
+    Returns:
+        Inst: the instruction built.
+    """
+    prefix = inst["name"].rpartition(":")[0]
+    s = instStage(inst)
+    cols, rows, qubits = state.cols, state.rows, state.qubits
+    if inst["type"] == "Init":
+        return Init(
+            cols,
+            rows,
+            qubits,
+            slm_qubit_idx=inst["slm_qubit_idx"],
+            slm_qubit_xys=inst["slm_qubit_xys"],
+            aod_qubit_idx=inst["aod_qubit_idx"],
+            aod_qubit_crs=inst["aod_qubit_crs"],
+            aod_col_act_idx=inst["aod_col_act_idx"],
+            aod_col_xs=inst["aod_col_xs"],
+            aod_row_act_idx=inst["aod_row_act_idx"],
+            aod_row_ys=inst["aod_row_ys"],
+            data={
+                k: inst[k] for k in ["n_q", "x_high", "y_high", "c_high", "r_high"]
+            },
+        )
+    if inst["type"] == "Move":
+        return Move(
+            s,
+            cols,
+            rows,
+            qubits,
+            col_idx=[col["id"] for col in inst["cols"]],
+            col_begin=[col["begin"] for col in inst["cols"]],
+            col_end=[col["end"] for col in inst["cols"]],
+            row_idx=[row["id"] for row in inst["rows"]],
+            row_begin=[row["begin"] for row in inst["rows"]],
+            row_end=[row["end"] for row in inst["rows"]],
+            prefix=prefix,
+        )
+    if inst["type"] == "Activate":
+        return Activate(
+            s,
+            cols,
+            rows,
+            qubits,
+            col_idx=inst["col_idx"],
+            col_xs=inst["col_xs"],
+            row_idx=inst["row_idx"],
+            row_ys=inst["row_ys"],
+            pickup_qs=inst["pickup_qs"],
+            prefix=prefix,
+        )
+    if inst["type"] == "Deactivate":
+        return Deactivate(
+            s,
+            cols,
+            rows,
+            qubits,
+            col_idx=inst["col_idx"],
+            col_xs=inst["col_xs"],
+            row_idx=inst["row_idx"],
+            row_ys=inst["row_ys"],
+            dropoff_qs=inst["dropoff_qs"],
+            prefix=prefix,
+        )
+    # the other instructions do not change the state
+    if inst["type"] == "Rydberg":
+        return Rydberg(s, cols, rows, qubits, inst["gates"])
+    if inst["type"] == "Raman":
+        return Raman(s, cols, rows, qubits, inst["gate"])
+    if inst["type"] == "Measurement":
+        return Measurement(s, cols, rows, qubits, inst["gate"])
+    raise ValueError(f"{inst['name']}: unknown instruction type {inst['type']}.")
+
+
+def replayInst(
+    inst: Mapping[str, Any],
+    prev: Union[MachineState, None],
+    curr: Mapping[str, Any],
+) -> Union[str, None]:
+    """replay an instruction from the state before it with buildInst, then
+    check the state and compare it with the state in the code.
+
+    Args:
+        inst (Mapping[str, Any]): the instruction in code_full.
+        prev (MachineState | None): state before the instruction, None for
+            Init. It is modified.
+        curr (Mapping[str, Any]): state after the instruction in the code.
+
+    Returns:
+        Union[str, None]: the first error, or None.
+    """
+    if inst["type"] == "Init":
+        state = MachineState(inst["n_q"], inst["c_high"], inst["r_high"])
+    else:
+        state = prev
+        # CodeGen assigns the c/r of qubits before picking them up, this
+        # is not part of any instruction
+        state.q_c[:] = [q["c"] for q in curr["qubits"]]
+        state.q_r[:] = [q["r"] for q in curr["qubits"]]
+    try:
+        replay = buildInst(inst, state)
+    except ValueError as e:
+        return str(e)
+    if inst["type"] == "Move" and not np.isclose(replay.duration, inst["duration"]):
+        return (
+            f"{inst['name']}: duration {inst['duration']} while "
+            f"the move takes {replay.duration}."
+        )
+
+    error = checkState(state)
+    if error:
+        return f"{inst['name']}: {error}"
+    return compareStates(inst, replay.code["state"], curr)
+
+
+def compareStates(
+    inst: Mapping[str, Any], replayed: Mapping[str, Any], curr: Mapping[str, Any]
+) -> Union[str, None]:
+    # the first difference of the replayed state from the state in the code
+    for entity in ENTITIES:
+        for a, b in zip(replayed[entity], curr[entity]):
+            if a != b:
+                return (
+                    f"{inst['name']}: {entity[:-1]} {a['id']} is {b} in the "
+                    f"code, but {a} in the replay."
+                )
+        if len(replayed[entity]) != len(curr[entity]):
+            return f"{inst['name']}: number of {entity} changed."
+    return None
+
+
+def _initWorker(file_name: str):
+    # runs in each worker process of verifyCode
+    global _code
+    _code = readCode(file_name)
+
+
+def _verifyRange(start: int, end: int) -> Sequence[Tuple[int, str]]:
+    # runs in a worker of verifyCode: replay instructions start, ..., end-1
+    errors = []
+    for i in range(start, end):
+        prev = MachineState.from_snapshot(_code.state_at(i - 1)) if i else None
+        error = replayInst(_code.insts[i], prev, _code.state_at(i))
+        if error:
+            errors.append((i, error))
+    return errors
+
+
+def verifyCode(file_name: str, workers: int = 1) -> Sequence[str]:
+    """verify a code_full file of any format by replaying every instruction
+    from the state before it, see replayInst. As every instruction starts
+    from the state in the code, the stages are verified in parallel.
+
+    Args:
+        file_name (str): the code_full file.
+        workers (int, optional): number of processes. Defaults to 1.
+
+    Returns:
+        Sequence[str]: the errors, each starting with the instruction index,
+            empty if the code is valid.
+    """
+    _initWorker(file_name)
+    insts = _code.insts
+    # contiguous ranges of instructions in the same stage
+    starts = [
+        i for i in range(len(insts))
+        if i == 0 or instStage(insts[i]) != instStage(insts[i - 1])
+    ]
+    tasks = list(zip(starts, starts[1:] + [len(insts)]))
+    if workers > 1:
+        if "fork" in multiprocessing.get_all_start_methods():
+            mp = multiprocessing.get_context("fork")
+        else:
+            mp = multiprocessing.get_context()
+        with mp.Pool(workers, _initWorker, (file_name,)) as pool:
+            results = pool.starmap(_verifyRange, tasks)
+    else:
+        results = [_verifyRange(start, end) for start, end in tasks]
+    return [f"{i}: {error}" for result in results for i, error in result]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="verify a code_full file of any format by replaying its "
+        "instructions: AOD order and separation, pickups and dropoffs, move "
+        "durations, and the states in the code."
+    )
+    parser.add_argument("input_file", type=str)
+    parser.add_argument(
+        "--workers", help="processes to verify the stages", type=int, default=1
+    )
+    args = parser.parse_args()
+
+    errors = verifyCode(args.input_file, args.workers)
+    for error in errors:
+        print(error)
+    print(f"{args.input_file}: {'invalid' if errors else 'valid'}, "
+          f"{len(errors)} errors.")
+    if errors:
+        raise SystemExit(1)